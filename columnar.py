@@ -0,0 +1,190 @@
+# encoding: utf-8
+from array import array
+from math import floor
+try:
+    import numpy    # Optional, makes the group functions vectorized
+except ImportError:
+    numpy = None
+try:
+    _inttypecode = array('q').typecode
+except ValueError:
+    _inttypecode = 'l'  # Python 2 has no 'q', 'l' is 64 bit on 64 bit Linux and OSX
+
+"""
+Columnar reads and aggregates, for reports over many rows without making a Model (or even a tuple) for each row.
+
+Columns are read by Models.columns (which uses Columns) into typed arrays - numpy arrays if numpy is installed,
+otherwise array.array for numbers, or lists for anything else - and then summarised by the group functions e.g.
+
+    cols = SMSmessages.columns("status", "gateway")
+    count(cols["status"], cols["gateway"])            { (status, gateway): number of messages }
+    gws = SMSgateways.columns("battery_strength", "charging")
+    mean(gws["battery_strength"])                     mean over all rows
+    percentile(gws["battery_strength"], 95, gws["charging"])   { charging: 95th percentile }
+
+Values are as stored in SQLite, i.e. sqlite3 converters are not applied (so an SMSstatus is its int, a Model its id)
+None in a numeric column is read as NaN, which mean and percentile skip, as SQL's AVG skips NULL.
+"""
+
+class Columns(object):
+    """
+    Builds typed columns from the rows of one or more cursors, a chunk at a time.
+    Each column starts as an int array, and is widened to float if floats or None are seen, or to a list otherwise
+    """
+    _kinds = ("int", "float", "object")
+
+    def __init__(self, names):
+        self.names = names
+        self.data = [ array(_inttypecode) for n in names ]
+        self.kinds = [ "int" for n in names ]
+
+    @staticmethod
+    def _kind(vals):
+        kind = "int"
+        for v in vals:
+            if isinstance(v, (int, long)):
+                continue
+            if v is None or isinstance(v, float):
+                kind = "float"
+            else:
+                return "object"
+        return kind
+
+    def _widen(self, i, kind):
+        if kind == "float":
+            self.data[i] = array('d', self.data[i])
+        else:
+            self.data[i] = list(self.data[i])
+        self.kinds[i] = kind
+
+    def extend(self, cursor, chunk=10000):
+        """
+        Add all the rows of cursor, reading chunk rows at a time
+        """
+        while True:
+            rows = cursor.fetchmany(chunk)
+            if not rows:
+                return
+            for i, vals in enumerate(zip(*rows)):
+                kind = self._kind(vals)
+                if self._kinds.index(kind) > self._kinds.index(self.kinds[i]):
+                    self._widen(i, kind)
+                if self.kinds[i] == "float":
+                    self.data[i].extend(float("nan") if v is None else v for v in vals)
+                else:
+                    self.data[i].extend(vals)
+
+    def result(self):
+        """
+        returns dict of name: column
+        """
+        if numpy:
+            return { name: (numpy.array(d, dtype=object) if kind == "object"
+                            else numpy.frombuffer(d, dtype=numpy.int64 if kind == "int" else numpy.float64) if len(d)    # Without copying
+                            else numpy.zeros(0, dtype=numpy.int64 if kind == "int" else numpy.float64))
+                     for name, d, kind in zip(self.names, self.data, self.kinds) }
+        return dict(zip(self.names, self.data))
+
+
+def _py(v):
+    return v.item() if hasattr(v, "item") else v    # numpy scalars to Python
+
+def _groups(keys):
+    """
+    returns (labels, codes) where labels[g] is the value of keys (a tuple if several) for group g, and codes[i] is the group of row i
+    """
+    if numpy:
+        codes = numpy.zeros(len(keys[0]), dtype=numpy.int64)
+        for k in keys:
+            uniques, inverse = numpy.unique(numpy.asarray(k), return_inverse=True)
+            codes = codes * len(uniques) + inverse
+        groups, first, codes = numpy.unique(codes, return_index=True, return_inverse=True)
+        labels = [ tuple(_py(k[i]) for k in keys) for i in first ]
+    else:
+        index = {}  # label: group
+        labels = []
+        codes = array(_inttypecode)
+        for label in zip(*keys):
+            g = index.get(label)
+            if g is None:
+                g = index[label] = len(labels)
+                labels.append(label)
+            codes.append(g)
+    return [ l[0] if len(keys) == 1 else l for l in labels ], codes
+
+def _pergroup(values, keys, f):
+    """
+    Apply f to the values in each group of keys, or all values if no keys
+    returns f(values), or dict of label: f(values of group)
+    """
+    if not keys:
+        return f(values)
+    labels, codes = _groups(keys)
+    if numpy:
+        values = numpy.asarray(values)
+        order = numpy.argsort(codes, kind="mergesort")
+        bounds = numpy.searchsorted(codes[order], numpy.arange(len(labels) + 1))
+        return { label: f(values[order[bounds[g]:bounds[g + 1]]]) for g, label in enumerate(labels) }
+    groups = [ [] for l in labels ]
+    for g, v in zip(codes, values):
+        groups[g].append(v)
+    return dict(zip(labels, [ f(vv) for vv in groups ]))
+
+def count(*keys):
+    """
+    Number of rows with each value of keys (columns of equal length)
+    returns dict of label: count, where label is the key's value, or a tuple if several keys
+    """
+    labels, codes = _groups(keys)
+    if numpy:
+        return dict(zip(labels, numpy.bincount(codes, minlength=len(labels)).tolist()))
+    counts = [0] * len(labels)
+    for g in codes:
+        counts[g] += 1
+    return dict(zip(labels, counts))
+
+def _notnan(vv):
+    """
+    vv without NaN (i.e. NULL)
+    """
+    if numpy:
+        vv = numpy.asarray(vv, dtype=numpy.float64)
+        return vv[~numpy.isnan(vv)]
+    return [ v for v in vv if v == v ]  # NaN isn't equal to itself
+
+def _mean(vv):
+    vv = _notnan(vv)
+    if numpy:
+        return float(numpy.mean(vv)) if len(vv) else float("nan")
+    return float(sum(vv)) / len(vv) if vv else float("nan")
+
+def mean(values, *keys):
+    """
+    Mean of values, or if keys given, dict of label: mean of values in that group (see count), NaN is skipped
+    """
+    if numpy and keys:
+        labels, codes = _groups(keys)
+        values = numpy.asarray(values, dtype=numpy.float64)
+        valid = ~numpy.isnan(values)
+        sums = numpy.bincount(codes[valid], weights=values[valid], minlength=len(labels))
+        with numpy.errstate(invalid="ignore", divide="ignore"):     # NaN for a group with no values, as _mean
+            return dict(zip(labels, (sums / numpy.bincount(codes[valid], minlength=len(labels))).tolist()))
+    return _pergroup(values, keys, _mean)
+
+def percentile(values, p, *keys):
+    """
+    p'th percentile (0-100) of values, interpolating between the nearest as numpy.percentile does,
+    or if keys given, dict of label: percentile of values in that group (see count), NaN is skipped
+    """
+    def f(vv):
+        vv = _notnan(vv)
+        if numpy:
+            return float(numpy.percentile(vv, p)) if len(vv) else float("nan")
+        vv = sorted(vv)
+        if not vv:
+            return float("nan")
+        k = (len(vv) - 1) * p / 100.0
+        lo = int(floor(k))
+        hi = min(lo + 1, len(vv) - 1)
+        return vv[lo] + (vv[hi] - vv[lo]) * (k - lo)
+    return _pergroup(values, keys, f)
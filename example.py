@@ -1,18 +1,24 @@
 # encoding: utf-8
 import sqlite3
-from model import Model, Models
+from model import Model, Models, EpochMicros, ScaledDecimal, Compressed, CompressedJSON
 from json import loads, dumps
 from datetime import datetime
 from decimal import Decimal
+from migration import ParmPromotion
+import columnar
+import threading
+import time
 from model_exceptions import ModelExceptionRecordNotFound, ModelExceptionInvalidTag, ModelExceptionCantFind
 
 class ModelExample(Model):
     _tablename = "modelexample"
     _createsql = "CREATE TABLE %s (id integer primary key, name text, father modelexample, siblings modelexamples, " \
-                 "kitty Decimal, parms json, lastmod timestamp, tags tags)"
-    _insertsql = "INSERT INTO %s VALUES (NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL)"
+                 "kitty Decimal, wallet scaleddecimal, born epochmicros, parms json, lastmod timestamp, tags tags)"
+    _insertsql = "INSERT INTO %s VALUES (NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL)"
     _validtags = {"FOO"}
-    _parmfields = {"pfield1": unicode, "pfield2": int, "mother": None, "change": Decimal, "parmstime": datetime, "parmsmodels": None}
+    _parmfields = {"pfield1": unicode, "pfield2": int, "mother": None, "change": Decimal, "parmstime": datetime, "parmsmodels": None,
+                   "allowance": Decimal}
+    _typedfields = {"wallet": ScaledDecimal, "born": EpochMicros, "allowance": ScaledDecimal}  # Stored as sortable ints
 
 ModelExample._parmfields["mother"]=ModelExample # Because undefined when defining _parmfields above
 
@@ -27,6 +33,7 @@ class ModelExamples(Models):
     _singular = ModelExample
 
 ModelExample._parmfields["parmsmodels"]=ModelExamples   # Done here as not yet defined during definition of ModelExample
+ModelExample._plural = ModelExamples
 
 def convert_modelexamples(s):
     return ModelExamples(loads(s))
@@ -45,7 +52,8 @@ sqlite3.register_converter("decimal",Decimal)
 # =======
 
 def test():
-    from sqlitewrap import SqliteWrap
+    from sqlitewrap import SqliteWrap, QueryCache
+    ModelExample._parmfields["pfield2"] = int  # In case test run twice, and pfield2 promoted to column
     # Create table
     SqliteWrap.setdb("test.db")
     SqliteWrap.db.connect()
@@ -88,6 +96,15 @@ def test():
     assert not bar.hastag("FOO"), "Should not have tag foo now"
     bar.update(pfield1="Foo", pfield2=123)
     assert ModelExample(1).load().pfield2 == 123, "Should have set and retrieved it"
+    # Promote pfield2 from parms to an indexed column
+    SqliteWrap.db.commit()  # So migration's connection can write
+    promotion = ParmPromotion(ModelExample, "pfield2", "int", batchsize=1)
+    promotion.run()
+    assert "pfield2" not in ModelExample._parmfields, "Should now be a column"
+    assert ModelExample(1).load().pfield2 == 123, "Should have been copied from parms"
+    bar.update(pfield2=124)
+    assert ModelExamples.find(pfield2=124) == [bar], "Should find via column"
+    promotion.run()     # Does nothing once complete
     baz = ModelExample.insert(name="Baz")
     bar.update(father=baz)
     assert ModelExample(1).load().father == baz, "Should have set father, uses __eq__ for comparisom"
@@ -107,12 +124,46 @@ def test():
     brocopy = ModelExample(3)
     sibs.append(brocopy)    # Now got a duplicate
     assert len(sibs.set()) == 2 # set should delete duplicate
+    assert sibs[2] is brother, "Members with the same id should be the same object"
+    assert brocopy in { brother } and { sister: 1 }[ModelExample(sister.id)] == 1, "Should hash by id"
+    lazy = ModelExamples([1, brother.id, sister.id])
+    assert not lazy._objs and lazy.ids.tolist() == [1, brother.id, sister.id], "Should only keep ids until read"
+    assert lazy[0].name == bar.name and 1 in lazy and bar in lazy and baz not in lazy
+    assert (lazy - sibs).ids.tolist() == [1] and (lazy & sibs).ids.tolist() == [brother.id, sister.id]
+    assert (sibs | [bar]).ids.tolist() == [brother.id, sister.id, 1] and isinstance(sibs | [bar], ModelExamples)
+    first = lazy[:1]
+    assert first[0] is lazy[0], "Should share members already made"
+    first.append(ModelExample(sister.id))
+    assert lazy[2] is not first[1] and lazy[2] is lazy[2], "Should not add to the cache of the Models sliced"
     # Test supported type Decimal which is stored as a strong to preserve decimal places
     bar.update(change=Decimal("123.456"))
     assert ModelExample(1).change == Decimal("123.456")
     bar.update(kitty=Decimal("123.456"))
     assert ModelExample(1).kitty == Decimal("123.456")
     # Note cant do arithmetic "finds" on Decimal since stored as a precise string.
+    # but can on fields in _typedfields which are stored as sortable integers, in columns or parms
+    bar.update(wallet=Decimal("12.34"), born="1990-06-01", allowance="2.50")
+    brother.update(wallet=Decimal("9.99"), born=datetime(1992, 3, 4, 5, 6, 7, 890))
+    assert ModelExample(1).wallet == Decimal("12.34"), "Should round trip scaled decimal"
+    assert ModelExample(3).born == datetime(1992, 3, 4, 5, 6, 7, 890), "Should round trip datetime to microsecond"
+    assert ModelExample(1).allowance == Decimal("2.5"), "Should round trip scaled decimal in parms"
+    assert ModelExamples.find(wallet="> 10") == [bar], "Should compare numerically, not as strings"
+    assert ModelExamples.find(born="< 1991-01-01") == [bar], "Should compare dates"
+    assert ModelExamples.find(allowance=">= 2.5") == [bar], "Should compare parms field"
+    # Compressed text is stored as zlib if long, and decompressed in SQL by unzip
+    text = u"Lorem ipsum dolor sit amet \u00e9 " * 20
+    stored = Compressed.adapt(text)
+    assert len(stored) < len(text) and Compressed.fromsql(bytes(stored)) == text and Compressed.adapt(u"short") == u"short"
+    assert SqliteWrap.db.sqlfetch1("SELECT unzip(?), unzip(?)", (stored, u"short"))[0] == text
+    assert CompressedJSON.fromsql(bytes(CompressedJSON.adapt({"k": text}))) == {"k": text}
+    # observer times fetching the rows of a SELECT, not just its execute, and once per query
+    observed = []
+    SqliteWrap.observer = staticmethod(lambda sql, seconds: observed.append(seconds))
+    SqliteWrap.db.conn.create_function("slow", 1, lambda i: time.sleep(0.01) or i)
+    sql = "WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < 5) SELECT slow(i) FROM n"
+    assert len(SqliteWrap.db.sqlfetch(sql)) == 5 and SqliteWrap.db.sqlfetch1(sql)[0] == 1
+    SqliteWrap.observer = None
+    assert len(observed) == 2 and observed[0] >= 0.05, "Should observe each query once, including its fetch"
     # Test find
     assert ModelExamples.find(name="Brian").__class__.__name__ == "ModelExamples"
     assert ModelExamples.find(name="Brian")[0].__class__.__name__ == "ModelExample"
@@ -125,9 +176,115 @@ def test():
         pass
     else:
         assert False,"Should throw ModelExceptionCantFind"
+    # Test prefetch
+    mm = ModelExamples.find(name="%a%", prefetch=["father", "siblings"])
+    assert mm[0].father._loaded and mm[0].siblings[1]._loaded, "Should have loaded references"
+    assert mm[0].father.name == "Baz"
+    assert ModelExample.find(name="Bar", prefetch=["father"]).father._loaded
+    # Test columnar reads and aggregates
+    cols = ModelExamples.columns("id", "name", "father", "pfield1", name="%a%")
+    assert sorted(cols["name"]) == ["Bar", "Baz", "Brian", "Jane"] and len(cols["id"]) == 4, "Should read rows matching"
+    assert columnar.count(cols["father"])[ModelExample.find(name="Baz").id] == 1, "Should read ids not Models"
+    assert columnar.mean([1, 2, 3, 6], ["a", "b", "a", "b"]) == {"a": 2.0, "b": 4.0}
+    assert columnar.percentile([1, 2, 3, 4, 5], 50) == 3 and columnar.percentile([1, 2], 25) == 1.25
+    assert columnar.count([1, 1, 2], ["x", "y", "y"]) == {(1, "x"): 1, (1, "y"): 1, (2, "y"): 1}, "Should group by several keys"
+    nulls = columnar.Columns(["v", "k"])
+    nulls.extend(sqlite3.connect(":memory:").execute("SELECT 1, 'a' UNION ALL SELECT NULL, 'a' UNION ALL SELECT 3, 'b' UNION ALL SELECT 5, 'b'"))
+    nulls = nulls.result()
+    assert columnar.mean(nulls["v"]) == 3.0 and columnar.mean(nulls["v"], nulls["k"]) == {"a": 1.0, "b": 4.0}, "Should skip NULL"
+    assert columnar.percentile(nulls["v"], 50) == 3.0 and columnar.percentile(nulls["v"], 0, nulls["k"]) == {"a": 1.0, "b": 3.0}
+    # Test query
+    q = ModelExamples.query().filter(name="%a%")
+    assert [ m.name for m in q.order_by("-name") ] == ["Jane", "Brian", "Baz", "Bar"], "Should sort descending"
+    assert q.order_by("name").offset(1).limit(2).all() == [baz, brother], "Should page in sql"
+    assert q.exclude(name="Baz").anyof({"name": "Jane"}, {"id": "< 3"}).order_by("id").all() == [bar, sister]
+    assert q.order_by("id").first() == bar and q.count() == 4
+    assert ModelExamples.query().filter(name="Nobody").first() is None
+    # Query cache, invalidated by writes to the table, or by commits on other connections
+    ModelExample._cached = True
+    QueryCache.clear()
+    assert ModelExample.find(name="Brian") == brother and ModelExample.find(name="Brian") == brother
+    assert QueryCache.stats()["hits"] == 1 and QueryCache.stats()["misses"] == 1
+    brother.update(name="Brian2")
+    assert ModelExample.find(name="Brian") is None, "Should be invalidated by update"
+    brother.update(name="Brian")
+    assert ModelExample.find(name="Brian") == brother
+    SqliteWrap.db.commit()
+    other = sqlite3.connect(SqliteWrap.db.databasefile)   # e.g. another process
+    other.execute("UPDATE %s SET name = 'Brian3' WHERE id = ?" % ModelExample._tablename, (brother.id,))
+    other.commit()
+    other.close()
+    assert ModelExample.find(name="Brian") is None, "Should be invalidated by data_version"
+    brother.update(name="Brian")
+    ModelExample._cached = False
     #---
     assert len(ModelExamples.all()) == 4
     bar.delete()
     assert len(ModelExamples.all()) == 3
+    # Async, runs on executor thread with own connection, so commit first so it can see and write
+    SqliteWrap.db.commit()
+    futures = [ ModelExample.ainsert(name="Async%d" % i) for i in range(10) ]  # Batched into one transaction
+    assert [ f.result() for f in futures ][9].name == "Async9"
+    assert len(ModelExamples.afind(name="%Async%").result()) == 10
+    assert ModelExample(2).aload().result().name == "Baz"
+    SqliteWrap.db.disconnect()   # Stops executor
+    SqliteWrap.db.connect()
+    assert len(ModelExamples.all()) == 13, "Should see async inserts committed"
+    SqliteWrap.db.disconnect()
+    # Group commit, writes from several threads are run by one writer thread, sharing commits
+    SqliteWrap.setdb("test.db", shared=True)
+    SqliteWrap.db.connect()
+    SqliteWrap.db.startwriter(maxdelay=0.05)
+    threads = [ threading.Thread(target=ModelExample.insert, kwargs={"name": "Writer%d" % i}) for i in range(10) ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(ModelExamples.find(name="%Writer%")) == 10, "Should be committed when insert returns"
+    assert SqliteWrap.db.writer.batches < 10, "Should share commits, took %d" % SqliteWrap.db.writer.batches
+    assert SqliteWrap.db.sqlfetch1("pragma journal_mode")[0] == "wal"
+    count = len(ModelExamples.all())
+    try:
+        ModelExample.insert(name="Partial", nosuchcolumn=1)
+        assert False, "Should fail to set nosuchcolumn"
+    except sqlite3.OperationalError:
+        pass
+    assert len(ModelExamples.all()) == count, "Should roll back the insert with the failed update"
+    def readlater():    # On the writer, reading through SqliteWrap.db while another thread waits for the writer
+        time.sleep(0.1)
+        return SqliteWrap.db.sqlfetch1("SELECT COUNT(*) FROM modelexample")[0]
+    reader = threading.Thread(target=SqliteWrap.db.transaction, args=(readlater,))
+    reader.daemon = True
+    reader.start()
+    time.sleep(0.05)
+    updater = threading.Thread(target=SqliteWrap.db.sqlfetch, args=("UPDATE modelexample SET name = name WHERE id = 1 RETURNING id",))
+    updater.daemon = True
+    updater.start()
+    updater.join(5)
+    reader.join(5)
+    assert not updater.is_alive() and not reader.is_alive(), "Should not deadlock with a transaction reading through the same SqliteWrap"
+    SqliteWrap.db.disconnect()
+    # In memory, with checkpoints back to the file
+    SqliteWrap.setdb("test.db", inmemory=True, checkpointwrites=5)
+    SqliteWrap.db.connect()
+    assert ModelExample.find(name="Brian") == brother, "Should have loaded file into memory"
+    ModelExample.insert(name="Memory")
+    SqliteWrap.db.commit()
+    SqliteWrap.db._checkpointifchanged()    # As the checkpoint thread does
+    ModelExample.insert(name="Half")    # Not committed, so shouldn't be checkpointed
+    SqliteWrap.db._checkpointifchanged()
+    disk = sqlite3.connect("test.db")
+    assert disk.execute("SELECT name FROM modelexample WHERE name IN ('Memory', 'Half')").fetchall() == [(u"Memory",)], \
+        "Should only checkpoint between transactions"
+    disk.close()
+    SqliteWrap.db.backup("test-backup.db")     # Commits "Half"
+    SqliteWrap.db._checkpointifchanged()
+    disk = sqlite3.connect("test.db")
+    assert disk.execute("SELECT COUNT(*) FROM modelexample WHERE name = 'Half'").fetchone()[0] == 1, "Should checkpoint after backup commits"
+    disk.close()
+    SqliteWrap.db.disconnect()  # Checkpoints
+    SqliteWrap.setdb("test.db")
+    SqliteWrap.db.connect()
+    assert ModelExample.find(name="Memory").name == "Memory", "Should have written back to file"
 
     SqliteWrap.db.disconnect()
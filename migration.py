@@ -0,0 +1,99 @@
+# encoding: utf-8
+import threading
+import time
+from sqlitewrap import SqliteWrap
+
+class ParmPromotion(object):
+    """
+    Online migration of a field from the parms json field to its own indexed column, so finds on it can use the index
+
+    e.g. ParmPromotion(ModelExample, "pfield2", "int").run()
+    Safe to call run() on every startup, it resumes an interrupted migration from its last batch,
+    and once complete, just switches the Model to use the column.
+
+    Steps, on each database the Model is in
+    - add the column, and while migrating, Model.update writes the field to both parms and the column
+    - copy the field from parms to the column in batches of batchsize rows, each in its own short transaction
+      on a separate connection, recording progress in the migrations table
+    - index the column, mark complete, and remove the field from the Model's _parmfields so its read and found as a column
+
+    Note the Model's _insertsql is changed to name only the id, so it works with the extra column.
+    sqltype should be a type that reads correctly what json stores e.g. "int", "text", or a Model's type name
+    """
+    migrationsql = "CREATE TABLE IF NOT EXISTS migrations (name text primary key, lastid int, done boolean)"
+
+    def __init__(self, modelcls, field, sqltype, batchsize=500, pause=0.01):
+        """
+        :param modelcls:    Subclass of Model
+        :param field:       Field currently in modelcls._parmfields
+        :param sqltype:     Type to declare the column as
+        :param batchsize:   Rows per transaction
+        :param pause:       Seconds between transactions, to let other connections write
+        """
+        self.modelcls = modelcls
+        self.field = field
+        self.sqltype = sqltype
+        self.batchsize = batchsize
+        self.pause = pause
+        self.name = "promote %s.%s" % (modelcls._tablename, field)
+
+    def run(self, _verbose=False):
+        """
+        Run (or resume) the migration to completion, blocks until done, see start() to run in background
+        """
+        cls = self.modelcls
+        cls._insertsql = "INSERT INTO %s (id) VALUES (NULL)"     # Independent of number of columns
+        for maindb in cls.dbsfor():
+            db = SqliteWrap(maindb.databasefile)    # Own connection, so can run on any thread
+            db.connect(isolation_level=None)        # Transactions are explicit
+            try:
+                db.sqlsend(self.migrationsql)
+                progress = db.sqlfetch1("SELECT lastid, done FROM migrations WHERE name = ?", (self.name,))
+                if self.field not in [ r["name"] for r in db.sqlfetch("PRAGMA table_info(%s)" % cls._tablename) ]:
+                    progress = None     # Table has been recreated since any previous run, so start again
+                    db.sqlsend("ALTER TABLE %s ADD COLUMN %s %s" % (cls._tablename, self.field, self.sqltype))
+                elif progress and progress["done"]:
+                    continue
+                cls._migrating = set(cls._migrating) | {self.field}     # Double write from now on
+                self._backfill(db, progress["lastid"] if progress else 0, _verbose=_verbose)
+                db.sqlsend("CREATE INDEX IF NOT EXISTS %s_%s ON %s (%s)" % (cls._tablename, self.field, cls._tablename, self.field))
+                db.sqlsend("UPDATE migrations SET done = 1 WHERE name = ?", (self.name,))
+            finally:
+                db.disconnect()
+        self.switch()
+
+    def _backfill(self, db, lastid, _verbose=False):
+        cls = self.modelcls
+        while True:
+            row = db.sqlfetch1("SELECT MAX(id) FROM (SELECT id FROM %s WHERE id > ? ORDER BY id LIMIT ?)" % cls._tablename,
+                               (lastid, self.batchsize))
+            if row[0] is None:
+                break   # Nothing left to copy
+            db.sqlsend("BEGIN IMMEDIATE")
+            try:
+                db.sqlsend("UPDATE %s SET %s = json_extract(parms, ?) WHERE id > ? AND id <= ? AND parms IS NOT NULL"
+                           % (cls._tablename, self.field), ("$." + self.field, lastid, row[0]), _verbose=_verbose)
+                db.sqlsend("INSERT OR REPLACE INTO migrations (name, lastid, done) VALUES (?, ?, 0)", (self.name, row[0]))
+            except Exception:
+                db.sqlsend("ROLLBACK")
+                raise
+            db.sqlsend("COMMIT")
+            lastid = row[0]
+            time.sleep(self.pause)
+
+    def switch(self):
+        """
+        Treat the field as a column, replacing rather than changing the class's dicts so its a single step
+        """
+        cls = self.modelcls
+        cls._parmfields = { k: v for k, v in cls._parmfields.items() if k != self.field }
+        cls._migrating = set(cls._migrating) - {self.field}
+
+    def start(self):
+        """
+        Run in a background thread, returns the thread
+        """
+        t = threading.Thread(target=self.run, name="ParmPromotion")
+        t.daemon = True
+        t.start()
+        return t
@@ -1,8 +1,19 @@
 # encoding: utf-8
 import sqlite3
-from datetime import datetime
+import re
+import zlib
+from copy import copy
+from datetime import datetime, timedelta
+from decimal import Decimal, ROUND_HALF_EVEN
 from json import loads, dumps
-from sqlitewrap import SqliteWrap
+from array import array
+from collections import MutableSequence
+try:
+    _idtypecode = array('q').typecode     # 64 bit ids in Models
+except ValueError:
+    _idtypecode = 'l'   # Python 2 has no 'q', 'l' is 64 bit on 64 bit Linux and OSX
+from sqlitewrap import SqliteWrap, QueryCache
+from columnar import Columns
 
 # Local files
 from model_exceptions import (ModelExceptionRecordNotFound, ModelExceptionUpdateFailure, ModelExceptionInvalidTag,
@@ -48,6 +59,14 @@ class Model(object):
     _lastmodfield = None        # Override to specify where tostore timestamp (usually lastmod)
     _validtags = {}             # No valid tags by default
     _parmfields = ()
+    _typedfields = {}           # Fields (columns or parms) stored compactly, dict of name: TypedStorage subclass
+    _shards = None              # ShardRouter if rows are partitioned across several databases
+    _indexes = ()               # Columns to index e.g. ("status", "gateway, status"), created by createtable
+    _uniques = ()               # Columns with unique indexes, for upsert, optionally partial e.g. ("phonenumber", "device_id WHERE phonenumber IS NULL")
+    _plural = None              # Subclass of Models for this class, set after its defined
+    _migrating = ()             # parms fields being promoted to columns by ParmPromotion
+    _cached = False             # True to cache results of find, all and query in QueryCache, for small, rarely written tables
+    _searchfields = ()          # Text columns to index for full text search, see Models.search
     _deletesql = "DELETE FROM %s WHERE id = ?"  # Unlikely to be subclassed
     _supportedclasses = {}
 
@@ -71,7 +90,13 @@ class Model(object):
         Gets fields of model so can access as e.g. foo = Model(), foo.A
         """
         if not self._loaded:
-            self.load()    """
+            self.load()
+        if name in self.__dict__:
+            return self.__dict__[name]
+        if name in self._parmfields:
+            return None     # parms fields that have never been set
+        raise AttributeError(name)
+    """
     def __setattr__(self, name, value):
         #TODO - may need to do things if set fields and not handled by convertor
         #if name[0] == "_":  # #Write fields starting with _ direct to object e.g. _loaded
@@ -113,15 +138,107 @@ class Model(object):
         else:
             return self.id == other     # Defaults to int comparisom depending on class of other
 
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        """
+        Hash of the id, consistent with __eq__, so can be in sets or dict keys
+        """
+        return hash(self.id)
+
     @classmethod
     def createtable(cls, dropfirst=False):
         """
         Standard creation of table
         relies on a string "_createsql" in each subclass
         """
-        if dropfirst:
-            SqliteWrap.db.sqlsend("DROP TABLE IF EXISTS " + cls._tablename)
-        SqliteWrap.db.sqlsend(cls._createsql % cls._tablename, _verbose=False)
+        for db in cls.dbsfor():
+            if dropfirst:
+                db.sqlsend("DROP TABLE IF EXISTS " + cls._tablename)
+                db.sqlsend("DROP TABLE IF EXISTS %s_fts" % cls._tablename)
+            db.sqlsend(cls._createsql % cls._tablename, _verbose=False)
+        cls.createindexes()
+        if cls._searchfields:
+            cls.createsearch()
+
+    @classmethod
+    def createindexes(cls):
+        """
+        Create the indexes in _indexes and _uniques, called by createtable, call directly to add them to an existing table
+        ERR: IntegrityError if rows already break a unique index
+        """
+        for db in cls.dbsfor():
+            for columns in cls._indexes:
+                db.sqlsend("CREATE INDEX IF NOT EXISTS %s_%s ON %s (%s)"
+                           % (cls._tablename, "_".join(columns.replace(",", " ").split()), cls._tablename, columns))
+            for unique in cls._uniques:
+                columns, where = (unique.split(" WHERE ", 1) + [None])[:2]
+                db.sqlsend("CREATE UNIQUE INDEX IF NOT EXISTS %s_unique_%s ON %s (%s)%s"
+                           % (cls._tablename, "_".join(columns.replace(",", " ").split()), cls._tablename, columns,
+                              " WHERE " + where if where else ""))
+
+    @classmethod
+    def createsearch(cls):
+        """
+        Create the FTS5 index (table <tablename>_fts) of the columns in _searchfields, and index rows already in the table.
+        Triggers keep it in step with inserts, updates and deletes by any connection, indexing the text of Compressed fields.
+        Called by createtable, call directly to add search to an existing table, the index is only created if not there,
+        the triggers are replaced, in case a field has been Compressed since.
+        """
+        table = cls._tablename
+        fts = table + "_fts"
+        fields = ", ".join(cls._searchfields)
+        values = lambda prefix: ", ".join(cls._typedfields[f].sqlcolumn(prefix + f) if f in cls._typedfields else prefix + f
+                                          for f in cls._searchfields)
+        for db in cls.dbsfor():
+            if not db.sqlfetch1("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)):
+                continue
+            created = not db.sqlfetch1("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (fts,))
+            if created:
+                db.sqlsend("CREATE VIRTUAL TABLE %s USING fts5(%s, content='%s', content_rowid='id')" % (fts, fields, table))
+            for op in ("insert", "delete", "update"):
+                db.sqlsend("DROP TRIGGER IF EXISTS %s_%s" % (fts, op))
+            db.sqlsend("CREATE TRIGGER %s_insert AFTER INSERT ON %s BEGIN INSERT INTO %s(rowid, %s) VALUES (new.id, %s); END"
+                       % (fts, table, fts, fields, values("new.")))
+            db.sqlsend("CREATE TRIGGER %s_delete AFTER DELETE ON %s BEGIN INSERT INTO %s(%s, rowid, %s) VALUES ('delete', old.id, %s); END"
+                       % (fts, table, fts, fts, fields, values("old.")))
+            db.sqlsend("CREATE TRIGGER %s_update AFTER UPDATE OF %s ON %s BEGIN "
+                       "INSERT INTO %s(%s, rowid, %s) VALUES ('delete', old.id, %s); INSERT INTO %s(rowid, %s) VALUES (new.id, %s); END"
+                       % (fts, fields, table, fts, fts, fields, values("old."), fts, fields, values("new.")))
+            if created:     # As 'rebuild', which would index what is stored rather than the text
+                db.sqlsend("INSERT INTO %s(rowid, %s) SELECT id, %s FROM %s" % (fts, fields, values(""), table))
+
+    # ========== Which database, only more than one if _shards set ==========
+    @classmethod
+    def dbsfor(cls, kwargs=None):
+        """
+        Return list of databases that could hold rows matching kwargs of a find, all of them if kwargs is None
+        """
+        return cls._shards.dbsfor(kwargs or {}) if cls._shards else [SqliteWrap.current()]
+
+    @classmethod
+    def dbforid(cls, id):
+        return cls._shards.dbforid(id) if cls._shards else SqliteWrap.current()
+
+    @classmethod
+    def sqlfetch(cls, sql, values=None, _verbose=False, kwargs=None):
+        """
+        SqliteWrap.sqlfetch on each database rows matching kwargs could be in, merged in order of id
+        """
+        dbs = cls.dbsfor(kwargs)
+        if len(dbs) == 1:
+            return cls._fetch(dbs[0], sql, values, _verbose=_verbose)
+        return sorted((r for db in dbs for r in cls._fetch(db, sql, values, _verbose=_verbose)), key=lambda r: r["id"])
+
+    @classmethod
+    def _fetch(cls, db, sql, values, _verbose=False):
+        """
+        db.sqlfetch, via QueryCache if this class is _cached
+        """
+        if cls._cached:
+            return QueryCache.fetch(db, sql, values, (cls._tablename,), _verbose=_verbose)
+        return db.sqlfetch(sql, values, _verbose=_verbose)
 
     @classmethod
     def supportedfunction(self, supportedclass, func ):
@@ -142,7 +259,7 @@ class Model(object):
         if row or not self._loaded: # Need to check row first, or recurses if self._loaded not set (e.g. during init)
             if not row: # We haven't been passed an initialize, so try and load from database
                 sql = "SELECT * FROM %s WHERE id = ?" % self._tablename
-                row = SqliteWrap.db.sqlfetch1(sql, (self.id,), _verbose=False)
+                row = self.dbforid(self.id).sqlfetch1(sql, (self.id,), _verbose=False)
                 if row is None:
                     raise ModelExceptionRecordNotFound(table=self._tablename, id=self.id)
             assert isinstance(row, (sqlite3.Row, dict)), \
@@ -151,14 +268,23 @@ class Model(object):
                 # Note that converting types, such as a model, is done by a converter on each type, not here.
                 if key == "tags" and row[key] is None:
                     self.__setattr__(key, Tags())   # Make sure its never None, simplifies operations
+                elif key in self._migrating and isinstance(row, sqlite3.Row):
+                    pass    # Column may not be filled yet, parms is used until migration complete
+                elif key in self._typedfields and isinstance(row[key], buffer):
+                    # Column declared before it was Compressed, so its converter isn't used
+                    self.__setattr__(key, self._typedfields[key].fromsql(row[key]))
                 elif key == "parms":
                     if row[key] is not None: # Field specified as JSON, so will be dict by time gets here
                         parmsdic = row[key]
                         for parmskey in parmsdic: #
                             s = parmsdic[parmskey]
+                            if parmskey not in self._parmfields:    # e.g. promoted to a column by ParmPromotion
+                                continue
                             parmscls=self._parmfields[parmskey]
                             if s is None:   # Catch any None as constructor often wont work on None
                                 self.__setattr__(parmskey, None)
+                            elif parmskey in self._typedfields:   # Stored compactly e.g. as int
+                                self.__setattr__(parmskey, self._typedfields[parmskey].fromsql(s))
                             elif self.supportedfunction(parmscls, "parms2attr"):
                                 # Find types stored in a known format
                                 # See examples in datetime
@@ -179,8 +305,19 @@ class Model(object):
         Standard insert method that uses the insertstr defined in each class
         call this from iinsert(..<class dependent field list>.) in each class
         Note - can pass record as parameters and will auto-convert to id.
+        The blank INSERT and the UPDATE setting kwargs are one transaction (see SqliteWrap.transaction)
         """
-        id = SqliteWrap.db.sqlsend(cls._insertsql % cls._tablename, _verbose=_verbose ).lastrowid
+        num = cls._shards.shardnum(kwargs.get(cls._shards.shardkey)) if cls._shards else None
+        db = SqliteWrap.current() if num is None else cls._shards.dbs[num]
+        return db.transaction(cls._insert, _db=db, _num=num, _verbose=_verbose, **kwargs)
+
+    @classmethod
+    def _insert(cls, _db, _num, _verbose=False, **kwargs):
+        if _num is not None:    # Insert on the shard for the shard key, allocating an id that identifies that shard
+            id = _db.sqlsend(cls._shards.insertsql(cls._insertsql % cls._tablename, _num, cls._maxidsql(_num - len(cls._shards.dbs))),
+                             _verbose=_verbose).lastrowid
+        else:
+            id = _db.sqlsend(cls._insertsql % cls._tablename, _verbose=_verbose ).lastrowid
         obj = cls(id)
         if cls._lastmodfield:
             kwargs[cls._lastmodfield] = timestamp()
@@ -203,11 +340,103 @@ class Model(object):
         obj.update(_skipNone=False, _verbose=_verbose, **kwargs)  # Set if explicitly None, 0 or "" # TODO-LOG _login=_login, bLog=bLog,
         return obj
 
+    @classmethod
+    def insertmany(cls, rows, _verbose=False):
+        """
+        Insert many records with one executemany per database, returning them (loaded) as a list
+        rows: list of dicts of fields, only columns are supported, not parms fields or tags
+
+        ids are allocated from the current maximum (see _maxidsql), so if another connection inserts into the same table at the
+        same time, this will fail with an IntegrityError rather than duplicate ids.
+        """
+        assert not any(k in cls._parmfields or k == "tags" for r in rows for k in r), "insertmany only handles columns"
+        if cls._lastmodfield:
+            rows = [ dict(r, **{cls._lastmodfield: timestamp()}) for r in rows ]
+        keys = sorted({ k for r in rows for k in r })
+        sql = "INSERT INTO %s (id, %s) VALUES (?, %s)" % (cls._tablename, ", ".join(keys), ",".join(["?"] * len(keys)))
+        bydb = {}   # shard number (or None): list of rows
+        for r in rows:
+            bydb.setdefault(cls._shards.shardnum(r.get(cls._shards.shardkey)) if cls._shards else None, []).append(r)
+        objs = []
+        for num, dbrows in bydb.items():
+            if num is None:
+                db, step, first = SqliteWrap.current(), 1, 0
+            else:   # Keep id % number of shards == shard number
+                db, step, first = cls._shards.dbs[num], len(cls._shards.dbs), num - len(cls._shards.dbs)
+            maxid = db.sqlfetch1("SELECT " + cls._maxidsql(first))[0]
+            ids = [ maxid + step * (i + 1) for i in range(len(dbrows)) ]
+            db.sqlsend(sql, [ [id] + [ cls._typedfields[k].adapt(r.get(k)) if k in cls._typedfields else r.get(k) for k in keys ]
+                              for id, r in zip(ids, dbrows) ], _verbose=_verbose, many=True)
+            for id, r in zip(ids, dbrows):
+                obj = cls(id)
+                obj.load(row=dict(r, id=id))
+                objs.append(obj)
+        return objs
+
+    @classmethod
+    def upsert(cls, conflict_keys, _skipNone=False, _verbose=False, **kwargs):
+        """
+        Insert a record, or if one has the same conflict_keys, update its other fields, in one INSERT ... ON CONFLICT
+        DO UPDATE statement, so unlike a find then insert, concurrent upserts can't create duplicates
+
+        conflict_keys:  column, or tuple of columns, of one of _uniques (which must include its WHERE if partial)
+                        e.g. "phonenumber" or "device_id WHERE phonenumber IS NULL"
+        _skipNone:      True to leave out fields that are None, so they aren't changed on update
+        kwargs:         Fields to set, including conflict_keys, only columns are supported, not parms fields or tags
+        returns:        id of the record inserted or updated
+        """
+        assert not cls._shards, "upsert can't allocate ids on shards"
+        assert not any(k in cls._parmfields or k == "tags" for k in kwargs), "upsert only handles columns"
+        if isinstance(conflict_keys, basestring):
+            conflict_keys = (conflict_keys,)
+        columns, where = (", ".join(conflict_keys).split(" WHERE ", 1) + [None])[:2]
+        if _skipNone:
+            kwargs = { k: v for k, v in kwargs.items() if v is not None }
+        if cls._lastmodfield:
+            kwargs[cls._lastmodfield] = timestamp()
+        keys = sorted(kwargs)
+        conflicting = columns.replace(",", " ").split()
+        updates = [ k for k in keys if k not in conflicting ] or conflicting   # Always set something, so RETURNING gives the id
+        sql = "INSERT INTO %s (%s) VALUES (%s) ON CONFLICT (%s)%s DO UPDATE SET %s RETURNING id" \
+              % (cls._tablename, ", ".join(keys), ",".join(["?"] * len(keys)), columns, " WHERE " + where if where else "",
+                 ", ".join("%s = excluded.%s" % (k, k) for k in updates))
+        values = [ cls._typedfields[k].adapt(kwargs[k]) if k in cls._typedfields else kwargs[k] for k in keys ]
+        return SqliteWrap.current().sqlsend(sql, values, _verbose=_verbose).fetchone()[0]
+
+    @classmethod
+    def _maxidsql(cls, first):
+        """
+        SQL for the highest id used in the table, or first if none,
+        including ids of deleted rows if the table is AUTOINCREMENT, so they aren't used again
+        """
+        sql = "IFNULL((SELECT MAX(id) FROM %s), %d)" % (cls._tablename, first)
+        if "AUTOINCREMENT" in cls._createsql.upper():
+            sql = "MAX(%s, IFNULL((SELECT seq FROM sqlite_sequence WHERE name = '%s'), %d))" % (sql, cls._tablename, first)
+        return sql
+
     def delete(self):
         """
         Delete an object
         """
-        SqliteWrap.db.sqlsend(self._deletesql % self._tablename, (self.id,))
+        self.dbforid(self.id).sqlsend(self._deletesql % self._tablename, (self.id,))
+
+    # ========== ASYNC - each returns a Future, run on SqliteWrap.db's executor, see SqliteExecutor ==========
+    def aload(self, **kwargs):
+        return SqliteWrap.db.asubmit(self.load, **kwargs)
+
+    @classmethod
+    def ainsert(cls, **kwargs):
+        return SqliteWrap.db.asubmit(cls.insert, **kwargs)
+
+    def aupdate(self, **kwargs):
+        return SqliteWrap.db.asubmit(self.update, **kwargs)
+
+    def adelete(self):
+        return SqliteWrap.db.asubmit(self.delete)
+
+    @classmethod
+    def afind(cls, **kwargs):
+        return SqliteWrap.db.asubmit(cls.find, **kwargs)
 
     def update(self, _skipNone=False, _lastmod=True, _verbose=False, **kwargs): # _log=True, _login=None,
         """
@@ -228,6 +457,9 @@ class Model(object):
             if isinstance(kwargs[k], Record):
                 classes[k] = kwargs[k].__class__        # TODO-LOG
         """
+        for k in kwargs:
+            if k in self._typedfields and kwargs[k] is not None:  # Coerce e.g. strings to the class stored, so object matches what is read back
+                kwargs[k] = self._typedfields[k].coerce(kwargs[k])
         logkwargs = kwargs.copy()  # Make a copy - needs to be a copy so can manipulate independently,
         if self._lastmodfield and _lastmod:  # Do this after copying to logkwargs as dont want to log the change to lastmod
             kwargs[self._lastmodfield] = timestamp()
@@ -236,19 +468,21 @@ class Model(object):
         # Second round of manipulating kwargs AFTER set into object
         # - parmfields stripped out in keys= below
 
-        keys = [ k for k in kwargs if k not in self._parmfields ]   # Strip out parmfields and send full string
-        values = [ kwargs[k] for k in keys ]
+        # Strip out parmfields and send full string, except fields being promoted to columns are written to both
+        keys = [ k for k in kwargs if k not in self._parmfields or k in self._migrating ]
+        values = [ self._typedfields[k].adapt(kwargs[k]) if k in self._typedfields else kwargs[k] for k in keys ]
         #print "XXX@266",keys,values,values[0].__class__.__name__ if values else None
         if any([k in self._parmfields for k in kwargs]):   # Are there any tag from parmfields (Note kwargs unchanged at this point)
             keys.append("parms")
-            values.append(self.parms())                     # self.parms() handles conversion of different types of parms
+            values.append(self._typedfields["parms"].adapt(self.parms()) if "parms" in self._typedfields   # e.g. CompressedJSON
+                          else self.parms())                     # self.parms() handles conversion of different types of parms
 
         field_update = ", ".join("%s = ?" % k for k in keys)
         # noinspection PyTypeChecker
         where, ids = self.sqlpair("id", id)
         updatesql = "UPDATE %s SET %s WHERE %s" % (self._tablename, field_update, where)
         values = values + ids
-        rowcount = SqliteWrap.db.sqlsend(updatesql, values, _verbose=False).rowcount
+        rowcount = self.dbforid(id).sqlsend(updatesql, values, _verbose=False).rowcount
         if rowcount > 0:
             pass
             """TODO-LOG
@@ -277,20 +511,22 @@ class Model(object):
         return logkwargs  # For reporting to user
 
     @classmethod
-    def find(cls, _skipNone=False, _verbose=False, _nullerr=None, _manyerr=ModelExceptionRecordTooMany, **kwargs):
+    def find(cls, _skipNone=False, _verbose=False, _nullerr=None, _manyerr=ModelExceptionRecordTooMany, prefetch=None, **kwargs):
         """
         Do a SQL SELECT and return all results, see sqlpair for documentation of special arguments
         _skipnone   True if should ignore arguments that are None
         _nullerr    Set to exception if should raise an error on failure, typically ModelExceptionRecordNotFound
         _manyerr    Error to return if more than one (set to None to always return first item found), defaults ModelExceptionRecordTooMany
+        prefetch    List of fields referencing other Models to load at the same time, see Models.prefetch
         Returns a single record
         See Models.find if want a list returned
         """
-        keys, val1 = zip(
-            *[cls.sqlpair(key, val) for key, val in kwargs.iteritems() if not (_skipNone and val is None)])
+        if _skipNone:
+            kwargs = {k: v for k, v in kwargs.iteritems() if v is not None}
+        keys, val1 = zip(*[cls.sqlpair(key, val) for key, val in kwargs.iteritems()])
         vals = flatten2d(val1)
         sql = "SELECT * FROM %s WHERE %s" % (cls._tablename, " AND ".join(keys))
-        rr = SqliteWrap.db.sqlfetch(sql, vals, _verbose=_verbose)
+        rr = cls.sqlfetch(sql, vals, _verbose=_verbose, kwargs=kwargs)
         if len(rr) > 1 and _manyerr:
             raise _manyerr(table=cls._tablename, where=unicode(**kwargs))
         elif len(rr) == 0:
@@ -298,6 +534,8 @@ class Model(object):
                 raise _nullerr(table=cls._tablename, where=unicode(kwargs))
             else:
                 return None
+        elif prefetch:
+            return (cls._plural or Models)([cls(rr[0])]).prefetch(*prefetch)[0]
         else:
              return cls(rr[0])
 
@@ -313,13 +551,18 @@ class Model(object):
         Model               -> id   ( inefficient on parm fields)
         %string%            -> LIKE ( inefficient on parm fields)
         >|<|>=|<=|!=|<> 123 -> operator 123  (doesn't work on parm fields)
+        Fields in _typedfields support all except LIKE on both columns and parms, and compare in the order of the class,
+        except Compressed fields, which also support LIKE, on their text
         """
         if key == "tags":
             return key + " LIKE ?", ["%'" + val + "'%"]
+        if key in cls._typedfields:
+            column = ("json_extract(%s, '$.%s')" % (cls._parmscolumn(), key)) if key in cls._parmfields else key
+            return cls._typedfields[key].sqlpair(column, val)
         # SEE OTHER !ADD-TYPE - check for type in both parmfields and non-parmfields,
         if key not in cls._parmfields:
             # Note this next one is problematic since sqlite3 bug with list as a parameter and cant pass as string or tuple either
-            if isinstance(val, (tuple, list, set)):  # Also handles Models
+            if isinstance(val, (tuple, list, set, Models)):
                 return key + " IN (" + ','.join(['?'] * len(val)) + ")", [v.id if isinstance(v, Model) else v for v
                                                                           in
                                                                           val]
@@ -337,17 +580,22 @@ class Model(object):
             return key + " = ?", [val]
         else:  # key is in parmfields
             if isinstance(val, (basestring,)):
-                return "parms LIKE ?", [
+                return cls._parmscolumn() + " LIKE ?", [
                     '%"' + key + '": "' + val + '"%']  # this is really not an efficient search, if often used then move field from parms to main field
             if isinstance(val, Model):
-                return "parms LIKE ?", ['%"' + key + '": ' + unicode(val.id()) + '%']
+                return cls._parmscolumn() + " LIKE ?", ['%"' + key + '": ' + unicode(val.id()) + '%']
             if cls.supportedfunction(val.__class__,"attr2parms"):
-                return "parms LIKE ?", ['%"' + key + '": ' + cls.supportedfunction(val.__class__,"attr2parms")(val) + '%']
+                return cls._parmscolumn() + " LIKE ?", ['%"' + key + '": ' + cls.supportedfunction(val.__class__,"attr2parms")(val) + '%']
             if isinstance(val, (int, float)):
                 # This is really not an efficient search, and prone to error if not encoded exactly if often used then move field from parms to main field
-                return "parms LIKE ?", ['%"' + key + '": ' + unicode(val) + '%']
+                return cls._parmscolumn() + " LIKE ?", ['%"' + key + '": ' + unicode(val) + '%']
             assert False, ("Syntax unsupported", key, val)
 
+    @classmethod
+    def _parmscolumn(cls):
+        # SQL for the JSON text of parms, e.g. unzip(parms) if Compressed
+        return cls._typedfields["parms"].sqlcolumn("parms") if "parms" in cls._typedfields else "parms"
+
     # ========== TAGS ==(see also Tags class) ========================================
     def hastag(self, tag): return tag in self.tags
 
@@ -372,7 +620,9 @@ class Model(object):
     def forparms(self, name):
         # Convert parameter for storing in parms
         val = self.__getattr__(name)
-        if self.supportedfunction(val.__class__,"attr2parms"):
+        if name in self._typedfields:
+            return self._typedfields[name].adapt(val)
+        elif self.supportedfunction(val.__class__,"attr2parms"):
             # Support extension types that define a way to write to parms
             return self.supportedfunction(val.__class__,"attr2parms")(val)
         elif isinstance(val, Model):
@@ -397,6 +647,207 @@ Model.add_supportedclass(datetime,
                attr2parms=datetime.isoformat, # Convert a datetime to a storable string
                )
 
+class TypedStorage(object):
+    """
+    Opt-in compact storage of a class as an integer, in a column or a parms field (See !ADD-TYPE)
+    Integers sort in the same order as the values, so range finds e.g. find(lastmod="> 2017-02-07T06:28") work,
+    and can use an index, and are cheaper to decode than parsing text.
+
+    To use, list the field in the Model's _typedfields e.g. _typedfields = {"lastmod": EpochMicros}
+    and for a column, declare its type as the decltype e.g. "lastmod epochmicros" so its converter is used
+
+    decltype    Name of column type, the converter is registered against it by register()
+    coerce(val) Convert val (e.g. a string from a find) to the class of the attribute
+    tosql(val)  Convert an instance of the class to the integer stored
+    fromsql(s)  Convert the integer (or its string as passed to converters) back to the class
+    sqlcolumn(column)   SQL for the value to compare in finds, the column itself unless stored encoded (see Compressed)
+    """
+    decltype = None
+
+    @classmethod
+    def register(cls):
+        sqlite3.register_converter(cls.decltype, cls.fromsql)
+
+    @classmethod
+    def coerce(cls, val):
+        return val
+
+    @classmethod
+    def adapt(cls, val):
+        # Convert attribute, or something that can be coerced to it, to the integer stored, None is stored as NULL
+        return None if val is None else cls.tosql(cls.coerce(val))
+
+    @classmethod
+    def sqlcolumn(cls, column):
+        return column
+
+    @classmethod
+    def sqlvalue(cls, val):
+        # Value to compare with sqlcolumn
+        return cls.adapt(val)
+
+    @classmethod
+    def sqlpair(cls, column, val):
+        """
+        Equivalent of Model.sqlpair for a field of this type, supports lists, None, operators and equality
+        """
+        column = cls.sqlcolumn(column)
+        if isinstance(val, (tuple, list, set)):
+            return column + " IN (" + ','.join(['?'] * len(val)) + ")", [cls.sqlvalue(v) for v in val]
+        if val is None:
+            return column + " IS NULL", []
+        if isinstance(val, basestring):
+            ww = val.split(None, 1)
+            if len(ww) > 1 and ww[0] in ('>', '<', '>=', '<=', '!=', '<>'):
+                return column + " " + ww[0] + " ?", [cls.sqlvalue(ww[1])]
+        return column + " = ?", [cls.sqlvalue(val)]
+
+class EpochMicros(TypedStorage):
+    """
+    Store a (naive, local, as from datetime.now()) datetime as integer microseconds since 1970-01-01
+    Aware datetimes are converted to UTC first
+    """
+    decltype = "epochmicros"
+    epoch = datetime(1970, 1, 1)
+    formats = ("%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%dT%H:%M", "%Y-%m-%d %H:%M:%S.%f",
+               "%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d")
+
+    @classmethod
+    def coerce(cls, val):
+        if isinstance(val, basestring):
+            val = val.rstrip("Z")   # As sent by gateways e.g. 2017-02-07T06:28Z
+            for f in cls.formats:
+                try:
+                    return datetime.strptime(val, f)
+                except ValueError:
+                    pass
+            raise ValueError("Can't convert %s to datetime" % val)
+        return val
+
+    @classmethod
+    def tosql(cls, val):
+        if val.tzinfo is not None:
+            val = val.replace(tzinfo=None) - val.utcoffset()
+        d = val - cls.epoch
+        return (d.days * 86400 + d.seconds) * 1000000 + d.microseconds
+
+    @classmethod
+    def fromsql(cls, s):
+        return cls.epoch + timedelta(microseconds=int(s))
+
+EpochMicros.register()
+
+class ScaledDecimal(TypedStorage):
+    """
+    Store a Decimal as an integer number of 10**-places, rounding (half even) any extra places
+    Subclass with a different decltype and places for other precisions e.g. for cents
+    """
+    decltype = "scaleddecimal"
+    places = 4
+
+    @classmethod
+    def coerce(cls, val):
+        return val if isinstance(val, Decimal) else Decimal(unicode(val))
+
+    @classmethod
+    def tosql(cls, val):
+        return int(val.scaleb(cls.places).to_integral_value(rounding=ROUND_HALF_EVEN))
+
+    @classmethod
+    def fromsql(cls, s):
+        return Decimal(int(s)).scaleb(-cls.places)
+
+ScaledDecimal.register()
+
+try:
+    zlib.compressobj(6, zlib.DEFLATED, 15, 9, zlib.Z_DEFAULT_STRATEGY, b"x")
+    _zdict = True
+except TypeError:
+    _zdict = False  # Python 2 zlib has no preset dictionaries
+
+class Compressed(TypedStorage):
+    """
+    Opt-in zlib compression of text in a column declared "zlibtext", e.g. long message bodies.
+    Values of at least threshold bytes (UTF-8) are stored as a blob of a marker then the compressed text, shorter
+    ones as text, so both read back, as do rows written before the column was Compressed.
+    Set dictionary to typical content (e.g. common phrases or JSON keys) to compress short values better, this
+    needs zlib preset dictionaries (Python 3.3+) and can't change once values are written with it.
+
+    SQL sees what is stored, so finds compare unzip(column) (registered on each connection via SqliteWrap.functions),
+    which decompresses every row compared, i.e. scans. Other programs writing the table need unzip if triggers use it.
+    """
+    decltype = "zlibtext"
+    threshold = 256     # Bytes, below which the header and zlib overhead outweigh the saving
+    level = 6
+    dictionary = None
+    marker = b"\x00z"   # Text doesn't start with NUL
+    dictmarker = b"\x00d"
+
+    @classmethod
+    def coerce(cls, val):
+        return val.decode("utf-8") if isinstance(val, bytes) else unicode(val)
+
+    @classmethod
+    def tosql(cls, val):
+        b = val.encode("utf-8")
+        if len(b) < cls.threshold:
+            return val
+        if cls.dictionary and _zdict:
+            c = zlib.compressobj(cls.level, zlib.DEFLATED, 15, 9, zlib.Z_DEFAULT_STRATEGY, cls.dictionary)
+            return sqlite3.Binary(cls.dictmarker + c.compress(b) + c.flush())
+        return sqlite3.Binary(cls.marker + zlib.compress(b, cls.level))
+
+    @classmethod
+    def unzip(cls, s):
+        """
+        Text of a stored value, from a converter (bytes), or SQL (unicode if text, buffer if blob), None if NULL
+        """
+        if s is None or isinstance(s, unicode):
+            return s
+        s = bytes(s)
+        if s.startswith(cls.marker):
+            return zlib.decompress(s[len(cls.marker):]).decode("utf-8")
+        if s.startswith(cls.dictmarker):
+            d = zlib.decompressobj(15, cls.dictionary)
+            return (d.decompress(s[len(cls.dictmarker):]) + d.flush()).decode("utf-8")
+        return s.decode("utf-8")
+
+    @classmethod
+    def fromsql(cls, s):
+        return cls.unzip(s)
+
+    @classmethod
+    def sqlcolumn(cls, column):
+        return "unzip(%s)" % column
+
+    @classmethod
+    def sqlvalue(cls, val):
+        return cls.coerce(val)     # Compared with the text
+
+    @classmethod
+    def sqlpair(cls, column, val):
+        if isinstance(val, basestring) and len(val) >= 3 and val[0] == '%' and val[-1] == '%':
+            return cls.sqlcolumn(column) + " LIKE ?", [val]
+        return super(Compressed, cls).sqlpair(column, val)
+
+class CompressedJSON(Compressed):
+    """
+    Compressed JSON, e.g. for a large parms, declare the column "parms zlibjson" and add "parms" to _typedfields
+    """
+    decltype = "zlibjson"
+
+    @classmethod
+    def coerce(cls, val):
+        return super(CompressedJSON, cls).coerce(val if isinstance(val, basestring) else dumps(val))
+
+    @classmethod
+    def fromsql(cls, s):
+        return loads(cls.unzip(s))
+
+Compressed.register()
+CompressedJSON.register()
+SqliteWrap.functions["unzip"] = (1, Compressed.unzip)   # Markers are the same, and dictionary, if any, is Compressed's
+
 class Tags(set):
     #def adapt_tags(self):
     #   return dumps(list(self))
@@ -450,74 +901,481 @@ sqlite3.register_converter("tags", convert_tags)  # Return JSON, could be dict o
     # ========== JSON OTHER ================================
 
 sqlite3.register_adapter(dict, dumps)
-sqlite3.register_adapter(list, dumps)   # Note this also covers Models which is a list
-sqlite3.register_adapter(tuple, dumps)   # Note this also covers Models which is a list
+sqlite3.register_adapter(list, dumps)   # Models isn't a list, its stored by Models.__conform__
+sqlite3.register_adapter(tuple, dumps)
 sqlite3.register_converter("json", loads)  # Return JSON, could be dict or list
 
-class Models(list):
+class Models(MutableSequence):
     """
     Handle ordered list of Model - all of same class
-    adapter is covered by
+    Stored as an array of ids, with a count of each id, so membership and set operations don't compare objects.
+    Each member is only made a Model when first read, from the Row it was fetched in if any, and then kept so
+    reads return the same object. Members with the same id are the same object.
+    Models derived from another (slices, copies, union etc) start with its Models already made, so share those objects
+    as a list slice shares its elements, but have their own cache, so members made or fetched later aren't shared.
     """
     _singular = Model    # Subclass this to be the singular class
     _selectallsql = "SELECT * FROM %s"
     _parmfields = []
+    __hash__ = None     # Mutable, so not hashable, like list
 
 
-    def __init__(self, ll):
+    def __init__(self, ll=()):
         """
         Initialize an array of Models
         :param ll: iterator that returns a valid arg to the ModelXyz() esp int or sqlite3.Row or single item
         """
-        if not isinstance(ll, (list, tuple, set)):
+        if isinstance(ll, (Model, sqlite3.Row, int, long, basestring)):
             ll = [ ll]
-        super(Models, self).__init__([(l if isinstance(l, Model) else self._singular(l)) for l in ll ])
+        self._ids = array(_idtypecode)
+        self._counts = {}   # id: number of times in _ids
+        self._objs = {}     # id: Model, or Row to make it from, for ids read or fetched
+        if isinstance(ll, Models):
+            self._ids.extend(ll._ids)
+            self._counts.update(ll._counts)
+            self._objs = ll._objsfor(ll._counts)
+        else:
+            for l in ll:
+                self.append(l)
+
+    def _id(self, l):
+        """
+        Remember what l is, and return its id
+        """
+        if isinstance(l, sqlite3.Row):
+            id = l["id"]
+            if not isinstance(self._objs.get(id), Model):
+                self._objs[id] = l
+        elif isinstance(l, Model):
+            id = l.id
+            self._objs.setdefault(id, l)
+        else:
+            id = int(l)
+        return id
+
+    def _obj(self, id):
+        o = self._objs.get(id)
+        if not isinstance(o, Model):
+            o = self._objs[id] = self._singular(id if o is None else o)
+        return o
+
+    @property
+    def ids(self):
+        """
+        array of (64 bit) ids of the members, in order
+        """
+        return self._ids
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            mm = self.__class__(())
+            mm._ids = self._ids[i]
+            for id in mm._ids:
+                mm._add(id)
+            mm._objs = self._objsfor(mm._counts)
+            return mm
+        return self._obj(self._ids[i])
+
+    def __iter__(self):
+        for id in self._ids:
+            yield self._obj(id)
+
+    def _add(self, id, n=1):
+        self._counts[id] = self._counts.get(id, 0) + n
+        if not self._counts[id]:
+            del self._counts[id]
 
+    def __setitem__(self, i, l):
+        if isinstance(i, slice):
+            ids = array(_idtypecode, [ self._id(x) for x in l ])
+            for id in self._ids[i]:
+                self._add(id, -1)
+            self._ids[i] = ids
+        else:
+            ids = array(_idtypecode, [self._id(l)])
+            self._add(self._ids[i], -1)
+            self._ids[i] = ids[0]
+        for id in ids:
+            self._add(id)
+
+    def __delitem__(self, i):
+        for id in (self._ids[i] if isinstance(i, slice) else [self._ids[i]]):
+            self._add(id, -1)
+        del self._ids[i]
+
+    def insert(self, i, l):
+        id = self._id(l)
+        self._ids.insert(i, id)
+        self._add(id)
+
+    def append(self, l):
+        id = self._id(l)
+        self._ids.append(id)
+        self._add(id)
+
+    def __contains__(self, other):
+        """
+        other: Model or id
+        """
+        try:
+            return (other.id if isinstance(other, Model) else int(other)) in self._counts
+        except (TypeError, ValueError):
+            return False
+
+    def count(self, other):
+        return self._counts.get(other.id if isinstance(other, Model) else other, 0)
+
+    def __eq__(self, other):
+        if isinstance(other, Models):
+            return self._ids == other._ids
+        return isinstance(other, (list, tuple)) and len(self) == len(other) and all(a == b for a, b in zip(self, other))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __add__(self, other):
+        mm = self.__class__(self)
+        mm.extend(other)
+        return mm
+
+    def __radd__(self, other):
+        return self.__class__(other) + self
+
+    def sort(self, key=None, reverse=False):
+        self._ids = array(_idtypecode, [ m.id for m in sorted(self, key=key, reverse=reverse) ])
+
+    def __repr__(self):
+        return "%s(%s)" % (self.__class__.__name__, list(self._ids))
 
     def __conform__(self, protocol):
-        # Turn into a int to store in DB
+        # Store in DB as a JSON list of ids
         if protocol is sqlite3.PrepareProtocol:
-            return dumps([ l.id for l in self ])
+            return dumps(list(self._ids))
 
     def contains(self, other):
         return other in self
 
     def set(self):
         """
-        Only return new examples
+        Only return new examples, i.e. without duplicates, in the order first seen
+        """
+        return self.union(())
+
+    def _select(self, keep):
+        """
+        Return new Models of the members for which keep(id) is True, without duplicates
+        """
+        mm = self.__class__(())
+        for id in self._ids:
+            if id not in mm._counts and keep(id):
+                mm._ids.append(id)
+                mm._counts[id] = 1
+        mm._objs = self._objsfor(mm._counts)
+        return mm
+
+    def _objsfor(self, ids):
+        """
+        Copy of the cache of members made or fetched, for ids, for a Models derived from this one
+        """
+        return { id: self._objs[id] for id in ids if id in self._objs }
+
+    def union(self, other):
+        """
+        Members of self then other, without duplicates, also self | other
+        """
+        mm = self._select(lambda id: True)
+        for o in other:
+            id = mm._id(o)
+            if id not in mm._counts:
+                mm._ids.append(id)
+                mm._counts[id] = 1
+        return mm
+
+    def intersection(self, other):
+        """
+        Members of self also in other, without duplicates, also self & other
         """
-        rro = []
-        for r in self:
-            if r not in rro:
-                rro.append(r)
-        return self.__class__(rro)
+        other = other if isinstance(other, Models) else self.__class__(other)
+        return self._select(lambda id: id in other._counts)
+
+    def difference(self, other):
+        """
+        Members of self not in other, without duplicates, also self - other
+        """
+        other = other if isinstance(other, Models) else self.__class__(other)
+        return self._select(lambda id: id not in other._counts)
+
+    __or__ = union
+    __and__ = intersection
+    __sub__ = difference
 
     @classmethod
     def all(cls):
         """
         :return: list of all objects
         """
-        return cls(SqliteWrap.db.sqlfetch(cls._selectallsql % cls._singular._tablename))
+        return cls(cls._singular.sqlfetch(cls._selectallsql % cls._singular._tablename))
 
     @classmethod
-    def find(cls, _skipNone=False, _verbose=False, **kwargs):
+    def find(cls, _skipNone=False, _verbose=False, prefetch=None, **kwargs):
         """
         Do a SQL SELECT and return all results, see sqlpair for documentation of special arguments
         _skipnone   True if should ignore arguments that are None
+        prefetch    List of fields referencing other Models to load at the same time, see prefetch
         Returns a list which may be empty
         See Model.find if want a single item returned
         """
-        keys, val1 = zip(
-            *[cls._singular.sqlpair(key, val) for key, val in kwargs.iteritems() if not (_skipNone and val is None)])
+        if _skipNone:
+            kwargs = {k: v for k, v in kwargs.iteritems() if v is not None}
+        keys, val1 = zip(*[cls._singular.sqlpair(key, val) for key, val in kwargs.iteritems()])
         vals = flatten2d(val1)
         sql = "SELECT * FROM %s WHERE %s" % (cls._singular._tablename, " AND ".join(keys))
-        return cls(SqliteWrap.db.sqlfetch(sql, vals, _verbose=_verbose))
+        mm = cls(cls._singular.sqlfetch(sql, vals, _verbose=_verbose, kwargs=kwargs))
+        return mm.prefetch(*prefetch) if prefetch else mm
+
+    @classmethod
+    def search(cls, field, query, limit=None, _verbose=False, **kwargs):
+        """
+        Full text search, using the FTS5 index (see Model.createsearch), rather than a scan as LIKE does.
+        field       One of the Model's _searchfields
+        query       FTS5 query e.g. "hello", "buy AND free", "win*" or '"buy one"' for a phrase
+        limit       Maximum number to return
+        kwargs      Also match these, as for find
+        returns Models, best match first, each with _rank (lower is better, see FTS5 bm25)
+        """
+        single = cls._singular
+        assert field in single._searchfields, "%s is not in %s._searchfields" % (field, single.__name__)
+        table = single._tablename
+        sql = "SELECT %s.*, f.rank AS _rank FROM %s JOIN (SELECT rowid, rank FROM %s_fts WHERE %s_fts MATCH ?) AS f ON f.rowid = %s.id" \
+              % (table, table, table, table, table)
+        vals = [ "%s : (%s)" % (field, query) ]
+        if kwargs:
+            keys, val1 = zip(*[single.sqlpair(key, val) for key, val in kwargs.iteritems()])
+            sql += " WHERE " + " AND ".join(keys)
+            vals += flatten2d(val1)
+        sql += " ORDER BY f.rank"
+        if limit:
+            sql += " LIMIT %d" % int(limit)
+        dbs = single.dbsfor(kwargs)
+        rr = [ r for db in dbs for r in db.sqlfetch(sql, vals, _verbose=_verbose) ]
+        if len(dbs) > 1:    # Merge best matches from each shard
+            rr = sorted(rr, key=lambda r: r["_rank"])[:limit]
+        return cls(rr)
+
+    @classmethod
+    def columns(cls, *fields, **kwargs):
+        """
+        Read fields (columns or parms fields) of all rows matching kwargs (as for find) as typed columns, without making
+        Models, for reports over many rows, see columnar.py for the functions to summarise them, e.g.
+        cols = SMSmessages.columns("status", "gateway"); columnar.count(cols["status"], cols["gateway"])
+        Values are as stored, i.e. not converted by sqlite3 converters, e.g. ids not Models, and _typedfields as their ints
+        (except Compressed fields, as their text).
+        _verbose    True to print sql
+        _chunk      Rows to read at a time
+        returns dict of field: column
+        """
+        _verbose = kwargs.pop("_verbose", False)
+        chunk = kwargs.pop("_chunk", 10000)
+        single = cls._singular
+        # +column is an expression, so it has no declared type, and sqlite3 doesn't convert it
+        selects = [ ("json_extract(%s, '$.%s')" % (single._parmscolumn(), f)) if f in single._parmfields
+                    else single._typedfields[f].sqlcolumn("+" + f) if f in single._typedfields else ("+" + f) for f in fields ]
+        sql = "SELECT %s FROM %s" % (", ".join(selects), single._tablename)
+        vals = []
+        if kwargs:
+            keys, val1 = zip(*[single.sqlpair(key, val) for key, val in kwargs.iteritems()])
+            sql += " WHERE " + " AND ".join(keys)
+            vals = flatten2d(val1)
+        cols = Columns(fields)
+        for db in single.dbsfor(kwargs):
+            with db.lock:   # Held while reading the cursor
+                cols.extend(db.sqlsend(sql, vals, _verbose=_verbose), chunk=chunk)
+        return cols.result()
+
+    def prefetch(self, *fields):
+        """
+        Load the Models referenced by fields of each member (e.g. msg.gateway, or a Models field like siblings)
+        with one query per class referenced, rather than one for each when first used.
+        returns self so can be chained
+        """
+        unloaded = {}   # class: {id: [unloaded instances]}
+        for m in self:
+            for f in fields:
+                v = getattr(m, f)
+                for o in (v if isinstance(v, Models) else [v]):
+                    if isinstance(o, Model) and not o._loaded:
+                        unloaded.setdefault(o.__class__, {}).setdefault(o.id, []).append(o)
+        for cls, byid in unloaded.items():
+            bydb = {}
+            for id in byid:
+                bydb.setdefault(cls.dbforid(id), []).append(id)
+            for db, ids in bydb.items():
+                for i in range(0, len(ids), 500):   # Stay under sqlite's limit on number of parameters
+                    chunk = ids[i:i+500]
+                    sql = "SELECT * FROM %s WHERE id IN (%s)" % (cls._tablename, ",".join(["?"] * len(chunk)))
+                    for row in db.sqlfetch(sql, chunk):
+                        for o in byid[row["id"]]:
+                            o.load(row=row)
+        return self
+
+    @classmethod
+    def query(cls, _verbose=False):
+        """
+        Return a Query on this table that can be refined e.g. .filter(...).order_by(...).first()
+        """
+        return Query(cls, _verbose=_verbose)
 
     def update(self, _skipNone=False, _lastmod=True, _verbose=False, **kwargs): # _log=True, _login=None,
         # Fairly inefficient update as has to load each one first
         for m in self:
             m.update(_skipNone=_skipNone, _lastmod=_lastmod, _verbose=_verbose, **kwargs)
 
+    # ========== ASYNC - see Model.aload etc ==========
+    @classmethod
+    def aall(cls):
+        return SqliteWrap.db.asubmit(cls.all)
+
+    @classmethod
+    def afind(cls, **kwargs):
+        return SqliteWrap.db.asubmit(cls.find, **kwargs)
+
+    def aupdate(self, **kwargs):
+        return SqliteWrap.db.asubmit(self.update, **kwargs)
+
+
+class Query(object):
+    """
+    A SELECT built up from Models.query(), compiled to one sql statement that is only run when the Query is
+    iterated, or all(), first() or count() called. Each method returns a new Query, so they can be reused.
+
+    filter(**kwargs)        AND conditions, with the same arguments as find (see sqlpair)
+    exclude(**kwargs)       AND NOT (conditions)
+    anyof(dict, dict...)    AND (conditions of first dict OR conditions of second ...)
+    order_by("field", "-field") Sort by fields, - for descending
+    limit(n), offset(n)     Return at most n rows, skipping the first n
+    prefetch("field"...)    Load Models referenced by these fields at the same time, see Models.prefetch
+    """
+    def __init__(self, plural, _verbose=False):
+        self.plural = plural
+        self.where = []     # List of (sql, values) ANDed together
+        self.kwargs = {}    # Arguments to filter, used to choose shards
+        self.orderby = []   # List of (field, descending)
+        self.limitn = None
+        self.offsetn = None
+        self.prefetchfields = ()
+        self._verbose = _verbose
+
+    def _copy(self):
+        q = copy(self)
+        q.where = list(self.where)
+        q.kwargs = dict(self.kwargs)
+        q.orderby = list(self.orderby)
+        return q
+
+    def _and(self, kwargs):
+        pairs = [ self.plural._singular.sqlpair(key, val) for key, val in kwargs.iteritems() ]
+        return " AND ".join(p[0] for p in pairs), flatten2d(p[1] for p in pairs)
+
+    def filter(self, **kwargs):
+        q = self._copy()
+        if kwargs:
+            q.where.append(self._and(kwargs))
+            q.kwargs.update(kwargs)
+        return q
+
+    def exclude(self, **kwargs):
+        q = self._copy()
+        if kwargs:
+            sql, values = self._and(kwargs)
+            q.where.append(("NOT (%s)" % sql, values))
+        return q
+
+    def anyof(self, *conditions):
+        q = self._copy()
+        parts = [ self._and(c) for c in conditions if c ]
+        if parts:
+            q.where.append(("(%s)" % " OR ".join("(%s)" % p[0] for p in parts), flatten2d(p[1] for p in parts)))
+        return q
+
+    def order_by(self, *fields):
+        q = self._copy()
+        for f in fields:
+            assert re.match(r"^-?\w+$", f), "order_by expects field names, not %s" % f
+            q.orderby.append((f.lstrip("-"), f.startswith("-")))
+        return q
+
+    def prefetch(self, *fields):
+        q = self._copy()
+        q.prefetchfields = self.prefetchfields + fields
+        return q
+
+    def limit(self, n):
+        q = self._copy()
+        q.limitn = n
+        return q
+
+    def offset(self, n):
+        q = self._copy()
+        q.offsetn = n
+        return q
+
+    def sql(self, select="*", limit=None, offset=None):
+        """
+        Return (sql, values) for this query
+        """
+        sql = "SELECT %s FROM %s" % (select, self.plural._singular._tablename)
+        if self.where:
+            sql += " WHERE " + " AND ".join(w[0] for w in self.where)
+        if self.orderby:
+            sql += " ORDER BY " + ", ".join(f + (" DESC" if desc else "") for f, desc in self.orderby)
+        if limit is not None or offset:
+            sql += " LIMIT %d" % (-1 if limit is None else limit)
+            if offset:
+                sql += " OFFSET %d" % offset
+        return sql, flatten2d(w[1] for w in self.where)
+
+    def rows(self):
+        """
+        Run the query and return the rows, if the table is sharded each shard is queried and the results merged
+        """
+        singular = self.plural._singular
+        dbs = singular.dbsfor(self.kwargs)
+        if len(dbs) == 1:
+            sql, values = self.sql(limit=self.limitn, offset=self.offsetn)
+            return singular._fetch(dbs[0], sql, values, _verbose=self._verbose)
+        offset = self.offsetn or 0
+        sql, values = self.sql(limit=None if self.limitn is None else offset + self.limitn)  # Enough from each
+        rr = [ r for db in dbs for r in singular._fetch(db, sql, values, _verbose=self._verbose) ]
+        for field, desc in reversed(self.orderby or [("id", False)]):     # Stable, so sort by least significant first
+            rr.sort(key=lambda r: r[field], reverse=desc)
+        return rr[offset:None if self.limitn is None else offset + self.limitn]
+
+    def all(self):
+        mm = self.plural(self.rows())
+        return mm.prefetch(*self.prefetchfields) if self.prefetchfields else mm
+
+    def __iter__(self):
+        return iter(self.all())
+
+    def first(self):
+        """
+        Return the first Model, or None
+        """
+        mm = self.limit(1).all()
+        return mm[0] if mm else None
+
+    def count(self):
+        """
+        Return number of matching rows, ignoring order, limit and offset
+        """
+        q = self._copy()
+        q.orderby = []
+        sql, values = q.sql(select="COUNT(*)")
+        return sum(db.sqlfetch1(sql, values, _verbose=self._verbose)[0] for db in self.plural._singular.dbsfor(self.kwargs))
+
 
 def timestamp():
     """ Seperated out as sometimes implemented as timestamp of the query"""
@@ -0,0 +1,261 @@
+# encoding: utf-8
+import argparse
+import heapq
+import random
+import threading
+import time
+import urllib
+import urllib2
+from json import loads, dumps
+from sms_relay import SMSrelay, SMSHTTPRequestHandler
+
+"""
+Load generator for SMSrelay, simulating a fleet of Android gateways, to size the hardware one relay needs.
+
+Each simulated gateway polls, and sends incoming messages, at random (Poisson) intervals with the given mean rates.
+Incoming messages are a mix of ones that match the dispatch patterns in example_smsrelay.TestDispatcher, spam,
+loops (a message_id already sent by that gateway), and others, and some gateways have several SIMs.
+Requests go to a relay over HTTP (url), or to SMSrelay in this process, and the throughput and p50/p95/p99 latency
+of each endpoint are reported for each interval of the run, and overall.
+
+e.g. to run against a relay started here, serving HTTP on port 4244
+python sms_loadgen.py --gateways 200 --duration 60 --serve 4244
+"""
+
+class SMSsimgateway(object):
+    """
+    One simulated gateway, with one or more SIMs
+    """
+    def __init__(self, num, sims=1):
+        self.device_id = u"load%d" % num
+        self.sims = [ u"+1555%03d%04d" % (num % 1000, i) for i in range(sims) ]
+        self.sent = []      # message_ids of incoming messages sent, for loops
+        self.nextid = 0
+
+    def pollparms(self):
+        return { 'battery_strength': u'50', 'timestamp': time.strftime('%Y-%m-%dT%H:%MZ', time.gmtime()), 'wifi_strength': u'0',
+                 'gsm_strength': u'[38]', 'charging': u'true', 'device_id': self.device_id }
+
+    def incomingparms(self, kind):
+        """
+        kind:   key of SMSloadgen.messages, or "loop" to resend a message_id already sent
+        """
+        if kind == "loop" and self.sent:
+            message_id = random.choice(self.sent)
+        else:
+            self.nextid += 1
+            message_id = u"%s-%d" % (self.device_id, self.nextid)
+            self.sent.append(message_id)
+        return { 'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()), 'from': u'+1617%07d' % random.randrange(10000000),
+                 'sent_to': random.choice(self.sims), 'device_id': self.device_id, 'message_id': message_id,
+                 'message': SMSloadgen.messages.get(kind, SMSloadgen.messages["other"]) }
+
+
+class SMSloadgen(object):
+    """
+    Drives a fleet of SMSsimgateway against a relay, and collects the latency of each request
+    """
+    messages = {    # Text of incoming messages of each kind in mix
+        "hello": u"hello there",                        # STRINGIN pattern
+        "name": u"Hi my name is Fred from London",      # REGEX pattern
+        "spam": u"BUY ONE get one free",                # SMSdispatcher.spam
+        "other": u"no pattern matches this",
+    }
+    mix = { "hello": 0.4, "name": 0.2, "spam": 0.1, "loop": 0.1, "other": 0.2 }    # Fraction of incoming of each kind
+
+    def __init__(self, gateways=10, duration=10, pollrate=1.0, incomingrate=0.2, mix=None, multisim=0.2, maxmessages=None,
+                 url=None, interval=5, threads=None):
+        """
+        :param gateways:        Number of gateways to simulate
+        :param duration:        Seconds to run for
+        :param pollrate:        Mean sms_poll per second from each gateway
+        :param incomingrate:    Mean sms_incoming per second from each gateway
+        :param mix:             dict of kind: fraction of incoming messages (see mix)
+        :param multisim:        Fraction of gateways with two SIMs
+        :param maxmessages:     If set, poll for up to this many messages and sms_ack them, else one message per poll
+        :param url:             Base url of a relay e.g. "http://localhost:4243", None to call SMSrelay in this process
+        :param interval:        Seconds in each interval reported
+        :param threads:         Threads sending requests, each handles some of the gateways, default one per gateway up to 50
+        """
+        self.gateways = [ SMSsimgateway(i, sims=2 if random.random() < multisim else 1) for i in range(gateways) ]
+        self.duration = duration
+        self.pollrate = pollrate
+        self.incomingrate = incomingrate
+        self.mix = mix or self.mix
+        self.maxmessages = maxmessages
+        self.url = url
+        self.interval = interval
+        self.threads = threads or min(gateways, 50)
+        self.samples = {}       # (interval number, endpoint): list of latencies in seconds
+        self.errors = {}        # endpoint: number of failed requests
+        self.lock = threading.Lock()
+        self.start = None
+
+    def call(self, endpoint, **parms):
+        """
+        Make one request, recording its latency, returns the response
+        """
+        start = time.time()
+        try:
+            if self.url:
+                res = urllib2.urlopen("%s/%s?%s" % (self.url, endpoint, urllib.urlencode(parms))).read()
+                res = loads(res) if res else {}
+            else:
+                res = SMSrelay.dispatch(endpoint, **parms)
+        except Exception as e:
+            print "SMSloadgen", endpoint, "failed", e
+            with self.lock:
+                self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+            return None
+        end = time.time()
+        with self.lock:
+            self.samples.setdefault((int((end - self.start) / self.interval), endpoint), []).append(end - start)
+        return res
+
+    def poll(self, gw):
+        if not self.maxmessages:
+            return self.call("sms_poll", **gw.pollparms())
+        res = self.call("sms_poll", max_messages=self.maxmessages, **gw.pollparms())
+        if res and res.get("messages"):
+            self.call("sms_ack", device_id=gw.device_id, acks=dumps({ m["id"]: "SENT" for m in res["messages"] }))
+
+    def incoming(self, gw):
+        r = random.random() * sum(self.mix.values())
+        for kind, fraction in sorted(self.mix.items()):
+            r -= fraction
+            if r < 0:
+                break
+        self.call("sms_incoming", **gw.incomingparms(kind))
+
+    def _run(self, gws):
+        """
+        Send requests for gws until the end of the run, in order of when each is due
+        """
+        end = self.start + self.duration
+        due = []    # Heap of (time, gateway number, action, rate)
+        for i, gw in enumerate(gws):
+            for action, rate in ((self.poll, self.pollrate), (self.incoming, self.incomingrate)):
+                if rate:
+                    heapq.heappush(due, (self.start + random.expovariate(rate), i, action, rate))
+        while due:
+            t, i, action, rate = heapq.heappop(due)
+            if t >= end:
+                return
+            if t > time.time():
+                time.sleep(t - time.time())
+            action(gws[i])
+            heapq.heappush(due, (t + random.expovariate(rate), i, action, rate))
+
+    def run(self):
+        """
+        Run for duration, returns the report
+        """
+        self.start = time.time()
+        threads = [ threading.Thread(target=self._run, args=(self.gateways[i::self.threads],), name="SMSloadgen-%d" % i)
+                    for i in range(self.threads) ]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            t.join()
+        return self.report()
+
+    @staticmethod
+    def percentile(values, p):
+        """
+        Nearest rank percentile of values, p between 0 and 100
+        """
+        values = sorted(values)
+        return values[max(0, int(round(p / 100.0 * len(values))) - 1)] if values else None
+
+    def stats(self, latencies, seconds):
+        return { "requests": len(latencies), "persecond": len(latencies) / float(seconds),
+                 "p50": self.percentile(latencies, 50), "p95": self.percentile(latencies, 95), "p99": self.percentile(latencies, 99) }
+
+    def report(self):
+        """
+        returns { intervals: [ { start: seconds, endpoint: stats, ... }, ... ], total: { endpoint: stats, ... }, errors: { endpoint: n } }
+        where stats is { requests, persecond, p50, p95, p99 } with latencies in seconds
+        """
+        endpoints = sorted({ endpoint for n, endpoint in self.samples })
+        intervals = []
+        for n in range(int(self.duration / self.interval + 0.999)):
+            seconds = min(self.interval, self.duration - n * self.interval)
+            interval = { "start": n * self.interval }
+            for endpoint in endpoints:
+                interval[endpoint] = self.stats(self.samples.get((n, endpoint), []), seconds)
+            intervals.append(interval)
+        total = { endpoint: self.stats([ l for (n, ep), ll in self.samples.items() if ep == endpoint for l in ll ], self.duration)
+                  for endpoint in endpoints }
+        return { "intervals": intervals, "total": total, "errors": dict(self.errors) }
+
+    @classmethod
+    def printreport(cls, report):
+        def line(label, endpoint, s):
+            ms = lambda l: "%8.1f" % (l * 1000) if l is not None else "%8s" % "-"
+            print "%-8s %-20s %8d %8.1f %s %s %s" % (label, endpoint, s["requests"], s["persecond"], ms(s["p50"]), ms(s["p95"]), ms(s["p99"]))
+        print "%-8s %-20s %8s %8s %8s %8s %8s" % ("from", "endpoint", "requests", "per sec", "p50 ms", "p95 ms", "p99 ms")
+        for interval in report["intervals"]:
+            for endpoint in sorted(k for k in interval if k != "start"):
+                line("%gs" % interval["start"], endpoint, interval[endpoint])
+        for endpoint, s in sorted(report["total"].items()):
+            line("total", endpoint, s)
+        if report["errors"]:
+            print "errors", report["errors"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate a fleet of gateways against SMSrelay")
+    parser.add_argument("--gateways", type=int, default=10)
+    parser.add_argument("--duration", type=float, default=10, help="seconds")
+    parser.add_argument("--pollrate", type=float, default=1.0, help="polls per second per gateway")
+    parser.add_argument("--incomingrate", type=float, default=0.2, help="incoming messages per second per gateway")
+    parser.add_argument("--multisim", type=float, default=0.2, help="fraction of gateways with two SIMs")
+    parser.add_argument("--maxmessages", type=int, default=None, help="poll for up to this many messages, and ack them")
+    parser.add_argument("--interval", type=float, default=5, help="seconds per interval reported")
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--url", default=None, help="relay to send to e.g. http://localhost:4243, else in this process")
+    parser.add_argument("--serve", type=int, default=None, help="start a relay here serving HTTP on this port, and send to it")
+    parser.add_argument("--databasefile", default="smsloadtest.db", help="for the relay started here")
+    args = parser.parse_args()
+    url = args.url
+    if not url:
+        setup(args.databasefile)
+        if args.serve:
+            serve(args.serve)
+            url = "http://localhost:%d" % args.serve
+    load = SMSloadgen(gateways=args.gateways, duration=args.duration, pollrate=args.pollrate, incomingrate=args.incomingrate,
+                      multisim=args.multisim, maxmessages=args.maxmessages, url=url, interval=args.interval, threads=args.threads)
+    SMSloadgen.printreport(load.run())
+    if not args.url:
+        SMSrelay.done()
+
+def setup(databasefile="smsloadtest.db"):
+    """
+    Start a relay in this process, with a fresh database, and the patterns of example_smsrelay
+    """
+    from example_smsrelay import TestDispatcher
+    SMSrelay.setup(databasefile=databasefile, createTables=True, dropTablesFirst=True, dispatcher=TestDispatcher, threaded=True)
+
+def serve(port):
+    """
+    Serve the relay over HTTP on a background thread
+    """
+    t = threading.Thread(target=SMSHTTPRequestHandler.httpserver, args=(('', port), SMSrelay), name="SMSloadgen-server")
+    t.daemon = True
+    t.start()
+    time.sleep(0.1)     # Let it start listening
+
+def test():
+    print "Testing SMS load generator"
+    setup()
+    load = SMSloadgen(gateways=4, duration=1, pollrate=5, incomingrate=5, interval=0.5, maxmessages=2)
+    report = load.run()
+    assert len(report["intervals"]) == 2, "Should report each interval"
+    assert report["total"]["sms_poll"]["requests"] and report["total"]["sms_incoming"]["requests"], "Should send both"
+    assert report["total"]["sms_poll"]["p50"] <= report["total"]["sms_poll"]["p99"]
+    assert not report["errors"], "Should succeed %s" % report["errors"]
+    SMSrelay.done()
+
+if __name__ == "__main__":
+    main()
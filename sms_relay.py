@@ -1,12 +1,22 @@
 # encoding: utf-8
 
 import sqlite3
-from model import Model, Models, timestamp
+from model import Model, Models, Compressed, timestamp
 from aenum import Enum # From aenum
 from json import loads, dumps
 import re                           # Regex
-from sqlitewrap import SqliteWrap
+import random
+import Queue
+import bisect                       # For SMShistogram buckets
+from contextlib import contextmanager
+from collections import OrderedDict     # For LRU in SMSdedupe
+import threading
+import time
+from datetime import timedelta
+from sqlitewrap import SqliteWrap, ShardRouter
+from model_exceptions import SMSRelayExceptionInvalidRequest
 import BaseHTTPServer       # See https://docs.python.org/2/library/basehttpserver.html for docs on how servers work
+import SocketServer         # For ThreadingMixIn
 import urlparse             # See https://docs.python.org/2/library/urlparse.html
 
 #from enum import Enum # From flufl.enum
@@ -19,8 +29,6 @@ GOALS
 TODO
 - add phonenumber as a type in SMSmessage and SMSgateway, and maybe use google phonenumbers library store in intl
 - ignore spam numbers and short codes (maybe after get google phonenumbers working)
-- handle expired
-- Add priorities to dispatch patterns
 - Match final version of SMSrelay android app
 - http return errors using send_error
 
@@ -31,9 +39,11 @@ class SMSstatus(Enum):
     SENT=3
     DELIVERED=4
     FAILED=5
+    EXPIRED=6
     INCOMING=10
     LOOP=11
     SPAM=12
+    DISPATCHED=13   # INCOMING once handled by the dispatcher
 
     def __conform__(self, protocol):
         if protocol is sqlite3.PrepareProtocol:
@@ -55,11 +65,27 @@ class SMSdispatchtype(Enum):
 
 class SMSmessage(Model):
     _tablename = "smsqueue"
-    _createsql = "CREATE TABLE %s (id integer primary key, status smsmessagestatus, gateway smsgateway, " \
-                 "phonenumber text, message text, message_id text, timestamp datetime, tags tags )"
-    _insertsql = "INSERT INTO %s VALUES (NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL)"
+    # AUTOINCREMENT so ids of archived messages aren't reused, as they are kept in smsarchive
+    _createsql = "CREATE TABLE %s (id integer primary key AUTOINCREMENT, status smsmessagestatus, gateway smsgateway, " \
+                 "phonenumber text, message zlibtext, message_id text, timestamp datetime, tags tags, " \
+                 "priority integer NOT NULL DEFAULT 0, sender text, vtime integer NOT NULL DEFAULT 0, " \
+                 "received datetime )"   # See SMSscheduler, received is set by the relay, timestamp may be from the gateway
+    _insertsql = "INSERT INTO %s (id) VALUES (NULL)"
     _validtags = {}
     _parmfields = {}
+    _typedfields = {"message": Compressed}  # Long messages (e.g. concatenated SMS) stored compressed
+    _indexes = ("status", "gateway, message_id", "status, gateway, priority DESC, vtime")
+    _searchfields = ("message",)    # e.g. SMSarchivedmessages.search("message", '"buy one"') for a spam sweep
+
+    @classmethod
+    def insert(cls, **kwargs):
+        kwargs.setdefault("received", timestamp())
+        if kwargs.get("status") == SMSstatus.QUEUED:
+            SMSscheduler.enqueue(kwargs)
+        msg = super(SMSmessage, cls).insert(**kwargs)
+        if kwargs.get("status") == SMSstatus.QUEUED:
+            SMSnotifier.notify(kwargs.get("gateway"))  # Wake any sms_poll waiting for this gateway
+        return msg
 
     @property
     def _isloop(self):  # Check if its a loop, defined as message_id already seen
@@ -74,17 +100,660 @@ class SMSmessages(Models):
 
     @classmethod
     def nextmessage(self,  gws, _verbose=False):
-        mm = self.find(gateway=gws, status=SMSstatus.QUEUED, _verbose=_verbose)  # Look for queued on any of gateways
-        if mm:
-            return mm[0] if mm else None
-        mm = self.find(gateway=gws, status=SMSstatus.FAILED, _verbose=_verbose)  # Look for failed and retry
+        msg = SMSscheduler.next(gws, _verbose=_verbose)
+        if msg:
+            return msg
+        allowed = SMSscheduler.allowed(gws)     # Retries count against rate caps too
+        mm = allowed and self.find(gateway=allowed, status=SMSstatus.FAILED, _verbose=_verbose)  # Look for failed and retry
         if mm:
-            return random.choice(mm) if mm else None   #Fairly dumb way to do retries, from random FAILED
+            msg = random.choice(mm)     #Fairly dumb way to do retries, from random FAILED
+            SMSscheduler.served(msg)
+            return msg
+
+    @classmethod
+    def claim(cls, gws, n, _verbose=False):
+        """
+        Atomically mark up to n of the next QUEUED messages for any of gws (in SMSscheduler order) as GATEWAY, and return them,
+        taking no more from each gateway than its rate cap allows.
+        A single UPDATE ... RETURNING statement per database, so concurrent polls can't claim the same message
+        """
+        table = cls._singular._tablename
+        limits = SMSscheduler.allowance(gws, n)     # gateway id: most can claim from it
+        if not limits:
+            return cls()
+        pergw = "SELECT * FROM (SELECT id, priority, vtime FROM %s WHERE status = ? AND gateway = ? " \
+                "ORDER BY priority DESC, vtime, id LIMIT ?)" % table    # Each uses the index
+        sql = "UPDATE %s SET status = ? WHERE id IN (SELECT id FROM (%s) ORDER BY priority DESC, vtime, id LIMIT ?) RETURNING *" \
+              % (table, " UNION ALL ".join([pergw] * len(limits)))
+        rows = []
+        for db in cls._singular.dbsfor({"gateway": gws}):
+            if len(rows) < n:
+                rows += db.sqlfetch(sql, [SMSstatus.GATEWAY] + [ v for gwid, limit in sorted(limits.items()) for v in (SMSstatus.QUEUED, gwid, limit) ]
+                                    + [n - len(rows)], _verbose=_verbose)
+        mm = cls(sorted(rows, key=lambda r: (-r["priority"], r["vtime"], r["id"])))
+        for msg in mm:
+            SMSscheduler.served(msg)
+        return mm
+
+    @classmethod
+    def setstatuses(cls, statuses, fromstatus=None, gateways=None, _verbose=False):
+        """
+        Set status of many messages, in one UPDATE per database
+        statuses: dict of id: SMSstatus
+        fromstatus: If set, only update messages currently with this status
+        gateways: If set, only update messages on these gateways
+        returns dict of SMSstatus: number updated
+        """
+        table = cls._singular._tablename
+        bydb = {}
+        for id, status in statuses.items():
+            bydb.setdefault(cls._singular.dbforid(id), []).append((id, status))
+        where = ""
+        parms = []
+        if fromstatus is not None:
+            where += " AND status = ?"
+            parms.append(fromstatus)
+        if gateways is not None:
+            where += " AND gateway IN (%s)" % ",".join(["?"] * len(gateways))
+            parms += [ gw.id for gw in gateways ]
+        updated = {}
+        for db, pairs in bydb.items():
+            sql = "UPDATE %s SET status = CASE id %s END WHERE id IN (%s)%s RETURNING id" \
+                  % (table, " ".join(["WHEN ? THEN ?"] * len(pairs)), ",".join(["?"] * len(pairs)), where)
+            for row in db.sqlsend(sql, [ v for pair in pairs for v in pair ] + [ id for id, status in pairs ] + parms,
+                                  _verbose=_verbose).fetchall():
+                updated[statuses[row[0]]] = updated.get(statuses[row[0]], 0) + 1
+        return updated
 
 def convert_smsmessages(s): return SMSmessages(loads(s))
 sqlite3.register_converter("smsmessages", convert_smsmessages)
 SMSmessage._plural = SMSmessages
 
+class SMSarchivedmessage(SMSmessage):
+    """
+    Messages moved out of smsqueue by SMSretention, so its not searched by nextmessage or _isloop
+    """
+    _tablename = "smsarchive"
+
+class SMSarchivedmessages(SMSmessages):
+    _singular = SMSarchivedmessage
+
+SMSarchivedmessage._plural = SMSarchivedmessages
+
+class SMSscheduler(object):
+    """
+    Decides which QUEUED message a gateway sends next, used by SMSmessages.nextmessage and claim.
+    - Higher priority first (sms_queue(priority=n), default 0, or the priority of the dispatch pattern replying)
+    - Then fair between senders (sms_queue(sender=...)), by start-time fair queuing: each message is given a virtual
+      time (vtime) when queued, one after the sender's previous queued message, but no earlier than the vtime of
+      the message last sent, so a sender who queues 10,000 at once is interleaved with those who queue later.
+    - Gateways over their rate cap (maxrate, or ratecaps for a gateway) are skipped until they have capacity.
+    - Of a device's gateways (SIMs), the least recently used with a message goes first, and if balance is set
+      (and smsqueue isn't sharded) a message queued on one SIM may be sent by the device's least recently used one.
+    Ties go to the oldest (lowest id). Each choice is one query per gateway on the index (status, gateway, priority DESC, vtime)
+    which SQLite extends with id, so O(log n) in queue size.
+    The vtimes of senders are kept in memory, so after a restart a sender's new messages start at the current vtime.
+    """
+    vtime = 0           # vtime of the last message sent
+    lastvtime = {}      # sender: vtime of its last queued message, if later than vtime
+    maxrate = None      # Default messages per second per gateway, None for no cap
+    ratecaps = {}       # gateway id: messages per second, overrides maxrate
+    burst = 5           # Messages a gateway can send at once after being idle, when rate capped
+    balance = False     # True to move messages between the SIMs of a device
+    tokens = {}         # gateway id: (messages can send, time calculated)
+    lastserved = {}     # gateway id: time of last message
+    lock = threading.RLock()
+
+    @classmethod
+    def install(cls):
+        """
+        Add the scheduling columns and index to smsqueue (and smsarchive) if created before they existed, and set vtime
+        """
+        for modelcls in (SMSmessage, SMSarchivedmessage):
+            for db in modelcls.dbsfor():
+                columns = [ row["name"] for row in db.sqlfetch("pragma table_info(%s)" % modelcls._tablename) ]
+                if columns and "vtime" not in columns:
+                    for column in ("priority integer NOT NULL DEFAULT 0", "sender text", "vtime integer NOT NULL DEFAULT 0"):
+                        db.sqlsend("ALTER TABLE %s ADD COLUMN %s" % (modelcls._tablename, column))
+        for db in SMSmessage.dbsfor():
+            if db.sqlfetch1("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (SMSmessage._tablename,)):
+                db.sqlsend("CREATE INDEX IF NOT EXISTS smsqueue_status_gateway_priority_DESC_vtime ON %s (status, gateway, priority DESC, vtime)"
+                           % SMSmessage._tablename)
+        with cls.lock:
+            cls.lastvtime = {}
+            cls.tokens = {}
+            cls.lastserved = {}
+            cls.vtime = min([ row[0] for db in SMSmessage.dbsfor() if db.sqlfetch1("SELECT 1 FROM sqlite_master WHERE name = ?", (SMSmessage._tablename,))
+                              for row in db.sqlfetch("SELECT MIN(vtime) FROM %s WHERE status = ?" % SMSmessage._tablename, (SMSstatus.QUEUED,))
+                              if row[0] is not None ] or [0])
+
+    @classmethod
+    def enqueue(cls, kwargs):
+        """
+        Set priority and vtime in kwargs of a message being queued
+        """
+        if kwargs.get("priority") is None:
+            kwargs["priority"] = 0
+        with cls.lock:
+            sender = kwargs.get("sender") or kwargs.get("phonenumber")     # Replies are fair between who they go to
+            kwargs["vtime"] = max(cls.lastvtime.get(sender, cls.vtime) + 1, cls.vtime)
+            cls.lastvtime[sender] = kwargs["vtime"]
+            if len(cls.lastvtime) > 10000:    # Forget senders with nothing queued after vtime, they'd start at vtime anyway
+                cls.lastvtime = { s: v for s, v in cls.lastvtime.items() if v > cls.vtime }
+
+    @classmethod
+    def _available(cls, gwid, now):
+        """
+        Number of messages gateway can send now under its rate cap, None if not capped
+        """
+        rate = cls.ratecaps.get(gwid, cls.maxrate)
+        if not rate:
+            return None
+        tokens, then = cls.tokens.get(gwid, (cls.burst, now))
+        tokens = min(cls.burst, tokens + (now - then) * rate)
+        cls.tokens[gwid] = (tokens, now)
+        return max(0, int(tokens))
+
+    @classmethod
+    def allowance(cls, gws, n):
+        """
+        returns dict of gateway id: number of messages, up to n, it can send now under its rate cap, for those of gws that can send
+        """
+        now = time.time()
+        with cls.lock:
+            available = { gw.id: cls._available(gw.id, now) for gw in gws }
+        return { gwid: n if a is None else min(n, a) for gwid, a in available.items() if a is None or a > 0 }
+
+    @classmethod
+    def allowed(cls, gws):
+        """
+        returns those of gws that can send now under their rate caps, least recently used first
+        """
+        now = time.time()
+        with cls.lock:
+            gws = sorted(gws, key=lambda gw: cls.lastserved.get(gw.id, 0))
+            return [ gw for gw in gws if cls._available(gw.id, now) != 0 ]     # None if not capped
+
+    @classmethod
+    def served(cls, msg):
+        """
+        Record that msg is being sent
+        """
+        gwid = msg.gateway.id
+        with cls.lock:
+            cls.vtime = max(cls.vtime, msg.vtime)
+            cls.lastserved[gwid] = time.time()
+            if gwid in cls.tokens:
+                tokens, then = cls.tokens[gwid]
+                cls.tokens[gwid] = (tokens - 1, then)
+
+    @classmethod
+    def next(cls, gws, _verbose=False):
+        """
+        returns the next QUEUED message for any of gws (e.g. the SIMs of a device) or None
+        """
+        allowed = cls.allowed(gws)
+        best = None
+        for gw in allowed:
+            msg = SMSmessages.query(_verbose=_verbose).filter(gateway=gw, status=SMSstatus.QUEUED).order_by("-priority", "vtime", "id").first()
+            if msg and (best is None or (-msg.priority, msg.vtime, msg.id) < (-best.priority, best.vtime, best.id)):
+                best = msg
+        if best and cls.balance and not SMSmessage._shards and best.gateway != allowed[0]:
+            best.update(gateway=allowed[0])     # Send from the least recently used SIM of the device
+        if best:
+            cls.served(best)
+        return best
+
+
+class SMSdedupe(object):
+    """
+    Detects incoming messages already received, i.e. loops or retries by a gateway, before they are inserted.
+    The key is (gateway, message_id), checked against an LRU of recently seen keys, and then via the
+    index on (gateway, message_id) of smsqueue and then smsarchive (as SMSretention archives LOOP, SPAM and
+    older DISPATCHED messages), so none needs a table scan.
+    """
+    tables = (SMSmessage, SMSarchivedmessage)   # Searched in order
+    maxrecent = 10000       # Keys kept in memory
+    recent = OrderedDict()  # (gateway id, message_id): True, most recent last
+
+    @classmethod
+    def seen(cls, gateway, message_id):
+        """
+        Return True if message_id has already been received on gateway
+        """
+        if message_id is None:
+            return False
+        key = (gateway.id, unicode(message_id))
+        if key in cls.recent:
+            return True
+        for modelcls in cls.tables:
+            sql = "SELECT 1 FROM %s WHERE gateway = ? AND message_id = ? LIMIT 1" % modelcls._tablename
+            if modelcls.dbsfor({"gateway": gateway})[0].sqlfetch1(sql, (gateway.id, message_id)):
+                cls.add(gateway, message_id)
+                return True
+        return False
+
+    @classmethod
+    def seenmany(cls, gateway, message_ids):
+        """
+        Return the set of message_ids (as unicode) already received on gateway, with one index query per table for those not in the LRU
+        """
+        ids = { unicode(m) for m in message_ids if m is not None }
+        seen = { m for m in ids if (gateway.id, m) in cls.recent }
+        for modelcls in cls.tables:
+            rest = sorted(ids - seen)
+            db = modelcls.dbsfor({"gateway": gateway})[0]
+            for i in range(0, len(rest), 500):  # Stay under SQLite's limit on parameters
+                chunk = rest[i:i+500]
+                sql = "SELECT DISTINCT message_id FROM %s WHERE gateway = ? AND message_id IN (%s)" % (modelcls._tablename, ",".join(["?"] * len(chunk)))
+                for row in db.sqlfetch(sql, [gateway.id] + chunk):
+                    cls.add(gateway, row["message_id"])
+                    seen.add(unicode(row["message_id"]))
+        return seen
+
+    @classmethod
+    def add(cls, gateway, message_id):
+        if message_id is not None:
+            cls.recent[(gateway.id, unicode(message_id))] = True
+            while len(cls.recent) > cls.maxrecent:
+                cls.recent.popitem(last=False)
+
+    @classmethod
+    def clear(cls):
+        cls.recent = OrderedDict()
+
+
+class SMSretention(object):
+    """
+    Keeps smsqueue small, so the queries by each request stay fast and in cache, however long the relay runs.
+    Messages in a final state are moved to smsarchive, and those QUEUED or FAILED for longer than expiry
+    are marked EXPIRED and archived. DISPATCHED incoming messages are kept for dedupewindow after they were received
+    (by the relay, not the gateway's timestamp, which may be missing), as most repeats come soon after, and SMSdedupe
+    looks in smsqueue first, and then archived, where SMSdedupe still finds them.
+
+    Work is done in transactions of at most batchsize messages, on its own connection to each database
+    (each shard if sharded), so it only holds the write lock briefly, and then incremental vacuum is run
+    Runs in a background thread started by start(), or call run() to do a single pass.
+    """
+    archivestatuses = (SMSstatus.SENT, SMSstatus.DELIVERED, SMSstatus.SPAM, SMSstatus.LOOP, SMSstatus.EXPIRED)
+    expirestatuses = (SMSstatus.QUEUED, SMSstatus.FAILED)
+    expiry = timedelta(days=2)  # How long before an unsent message expires
+    dedupewindow = timedelta(days=7)    # How long to keep DISPATCHED messages in smsqueue, where repeats are found quickest
+    batchsize = 100             # Maximum messages per transaction
+    pause = 0.01                # Seconds between transactions to let requests in
+    vacuumpages = 100           # Pages to free after each pass
+    interval = 60               # Seconds between passes in background
+    _thread = None
+    _stop = None
+
+    @classmethod
+    def expire(cls, db):
+        """
+        Mark up to batchsize messages that have been waiting longer than expiry as EXPIRED, return number marked
+        """
+        sql = "UPDATE %s SET status = ? WHERE id IN (SELECT id FROM %s WHERE status IN (%s) AND timestamp < ? LIMIT ?)" \
+              % (SMSmessage._tablename, SMSmessage._tablename, ",".join(["?"] * len(cls.expirestatuses)))
+        return db.sqlsend(sql, [SMSstatus.EXPIRED] + list(cls.expirestatuses) + [timestamp() - cls.expiry, cls.batchsize]).rowcount
+
+    @classmethod
+    def archive(cls, db):
+        """
+        Move up to batchsize messages in archivestatuses, or DISPATCHED before dedupewindow, to smsarchive,
+        in one transaction, return number moved
+        """
+        ids = [ r[0] for r in db.sqlfetch("SELECT id FROM %s WHERE status IN (%s) OR (status = ? AND (received < ? OR received IS NULL)) LIMIT ?"
+                                          % (SMSmessage._tablename, ",".join(["?"] * len(cls.archivestatuses))),
+                                          list(cls.archivestatuses) + [SMSstatus.DISPATCHED, timestamp() - cls.dedupewindow,
+                                                                       cls.batchsize]) ]
+        if ids:
+            where = "id IN (%s)" % ",".join(["?"] * len(ids))
+            db.sqlsend("BEGIN IMMEDIATE")
+            try:    # Fails if already archived, as ids aren't reused (see install)
+                db.sqlsend("INSERT INTO %s SELECT * FROM %s WHERE %s"
+                           % (SMSarchivedmessage._tablename, SMSmessage._tablename, where), ids)
+                db.sqlsend("DELETE FROM %s WHERE %s" % (SMSmessage._tablename, where), ids)
+            except Exception:
+                db.sqlsend("ROLLBACK")
+                raise
+            db.sqlsend("COMMIT")
+        return len(ids)
+
+    @classmethod
+    def install(cls):
+        """
+        Make smsqueue (if created before it was) AUTOINCREMENT, by copying it to a new table, and make sure new ids are
+        above those in smsarchive, which may already have been reused. Indexes and triggers are recreated by setup.
+        Adds the received column (to smsarchive too), set to now on existing messages, so they are kept for dedupewindow.
+        """
+        table = SMSmessage._tablename
+        for modelcls in (SMSmessage, SMSarchivedmessage):
+            for db in modelcls.dbsfor():
+                columns = [ row["name"] for row in db.sqlfetch("pragma table_info(%s)" % modelcls._tablename) ]
+                if columns and "received" not in columns:
+                    db.sqlsend("ALTER TABLE %s ADD COLUMN received datetime" % modelcls._tablename)
+                    if modelcls is SMSmessage:
+                        db.sqlsend("UPDATE %s SET received = ?" % table, (timestamp(),))
+        rebuilt = False
+        for db in SMSmessage.dbsfor():
+            row = db.sqlfetch1("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table,))
+            if not row:
+                continue    # Not created yet
+            if "AUTOINCREMENT" not in row[0].upper():
+                columns = ", ".join(r["name"] for r in db.sqlfetch("pragma table_info(%s)" % table))
+                db.sqlsend(SMSmessage._createsql % (table + "_new"))
+                db.sqlsend("INSERT INTO %s_new (%s) SELECT %s FROM %s" % (table, columns, columns, table))
+                db.sqlsend("DROP TABLE %s" % table)
+                db.sqlsend("ALTER TABLE %s_new RENAME TO %s" % (table, table))
+                rebuilt = True
+            if db.sqlfetch1("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (SMSarchivedmessage._tablename,)):
+                maxid = db.sqlfetch1("SELECT MAX(id) FROM %s" % SMSarchivedmessage._tablename)[0]
+                if maxid is not None:
+                    if not db.sqlfetch1("SELECT 1 FROM sqlite_sequence WHERE name = ?", (table,)):
+                        db.sqlsend("INSERT INTO sqlite_sequence (name, seq) VALUES (?, 0)", (table,))
+                    db.sqlsend("UPDATE sqlite_sequence SET seq = ? WHERE name = ? AND seq < ?", (maxid, table, maxid))
+        if rebuilt:
+            SMSmessage.createindexes()
+
+    @classmethod
+    def run(cls):
+        """
+        Expire and archive everything due, on every database smsqueue is in, returns number of messages archived
+        """
+        archived = 0
+        for maindb in SMSmessage.dbsfor():
+            db = SqliteWrap(maindb.databasefile)    # Own connection, so can run on any thread
+            db.connect(isolation_level=None)        # Autocommit, so each statement is its own short transaction
+            try:
+                while cls.expire(db) == cls.batchsize and not (cls._stop and cls._stop.is_set()):
+                    time.sleep(cls.pause)
+                while not (cls._stop and cls._stop.is_set()):
+                    n = cls.archive(db)
+                    archived += n
+                    if n < cls.batchsize:
+                        break
+                    time.sleep(cls.pause)
+                db.sqlsend("PRAGMA incremental_vacuum(%d)" % cls.vacuumpages)
+            finally:
+                db.disconnect()
+        return archived
+
+    @classmethod
+    def start(cls, interval=None):
+        """
+        Start a background thread running a pass every interval seconds
+        """
+        if interval:
+            cls.interval = interval
+        cls._stop = threading.Event()
+        cls._thread = threading.Thread(target=cls._run, name="SMSretention")
+        cls._thread.daemon = True
+        cls._thread.start()
+
+    @classmethod
+    def _run(cls):
+        while not cls._stop.wait(cls.interval):
+            try:
+                cls.run()
+            except Exception as e:     # Keep running, e.g. if database was locked for longer than sqlsend waits
+                print "SMSretention failed", e
+
+    @classmethod
+    def stop(cls):
+        if cls._thread:
+            cls._stop.set()
+            cls._thread.join()
+            cls._thread = None
+
+
+class SMSnotifier(object):
+    """
+    Lets a long sms_poll wait for a message to be queued for one of its gateways, without querying the database.
+    Each waiting poll registers a Condition against each of its gateway ids, notified by SMSmessage.insert.
+    The Conditions use HTTPdispatcher.lock, which is held while handling a request, and released while waiting,
+    so a poll wakes once the request that queued the message is complete.
+    """
+    waiters = {}    # gateway id: set of Conditions of polls waiting for it
+
+    @classmethod
+    def wait(cls, gws, timeout):
+        """
+        Wait up to timeout seconds for a message to be queued for any of gws, returns True if one was
+        """
+        with HTTPdispatcher.lock:
+            cond = threading.Condition(HTTPdispatcher.lock)
+            cond.queued = False
+            for gw in gws:
+                cls.waiters.setdefault(gw.id, set()).add(cond)
+            try:
+                end = time.time() + timeout
+                while not cond.queued and time.time() < end:
+                    cond.wait(end - time.time())
+            finally:
+                for gw in gws:
+                    cls.waiters[gw.id].discard(cond)
+                    if not cls.waiters[gw.id]:
+                        del cls.waiters[gw.id]
+            return cond.queued
+
+    @classmethod
+    def notify(cls, gateway):
+        if gateway is None:
+            return
+        with HTTPdispatcher.lock:
+            for cond in cls.waiters.get(gateway.id if isinstance(gateway, Model) else int(gateway), ()):
+                cond.queued = True
+                cond.notify()
+
+
+class SMSdispatchpool(object):
+    """
+    Dispatches incoming messages on worker threads, so a slow dispatch pattern doesn't hold up the gateway's
+    request or the server, sms_incoming returns as soon as the message is stored.
+    The INCOMING messages in smsqueue are the durable queue, each is marked DISPATCHED (or SPAM) once handled,
+    and start() queues any left from before a restart.
+    Each sender's messages go to the same worker, so are dispatched in the order received.
+    The dispatcher runs without HTTPdispatcher.lock held, loading the message, queueing replies (including by sms_queue
+    from a pattern's function) and setting its status hold it, so the dispatcher shouldn't otherwise write to the database.
+    """
+    queues = []     # Queue of message ids for each worker
+    _threads = []
+
+    @classmethod
+    def start(cls, workers=4):
+        """
+        Start workers threads, requires the database to be shared between threads (see SqliteWrap)
+        """
+        cls.queues = [ Queue.Queue() for i in range(workers) ]
+        cls._threads = [ threading.Thread(target=cls._run, args=(q,), name="SMSdispatch-%d" % i) for i, q in enumerate(cls.queues) ]
+        for t in cls._threads:
+            t.daemon = True
+            t.start()
+        with HTTPdispatcher.lock:
+            for msg in SMSmessages.find(status=SMSstatus.INCOMING):   # In order of id
+                cls.put(msg)
+
+    @classmethod
+    def put(cls, msg):
+        cls.queues[hash(msg.phonenumber) % len(cls.queues)].put(msg.id)
+
+    @classmethod
+    def _run(cls, q):
+        while True:
+            id = q.get()
+            try:
+                if id is None:
+                    return
+                cls.dispatchone(id)
+            except Exception as e:     # Keep running, message stays INCOMING so is retried after a restart
+                print "SMSdispatchpool failed", id, e
+            finally:
+                q.task_done()
+
+    @classmethod
+    def dispatchone(cls, id):
+        with HTTPdispatcher.lock:   # Waits for the request that stored it to commit
+            msg = SMSmessage(id).load()
+        if msg.status != SMSstatus.INCOMING:
+            return      # Already handled, e.g. queued again by start()
+        response = SMSrelay.dispatcher.dispatch(msg=msg, gateway=[msg.gateway])
+        with HTTPdispatcher.lock:
+            try:
+                SMSrelay._handled(msg, response)
+            except Exception:
+                SMSrelay.rollback()     # Leave it INCOMING without any of its replies
+                raise
+            SqliteWrap.commitall()
+
+    @classmethod
+    def join(cls):
+        """
+        Wait until all queued messages are dispatched
+        """
+        for q in cls.queues:
+            q.join()
+
+    @classmethod
+    def stop(cls):
+        for q in cls.queues:
+            q.put(None)
+        for t in cls._threads:
+            t.join()
+        cls.queues = []
+        cls._threads = []
+
+
+class SMShistogram(object):
+    """
+    Counts of observed durations in fixed buckets, with their sum, as used by SMSmetrics
+    """
+    buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 60)   # Upper bounds in seconds
+
+    def __init__(self):
+        self.counts = [0] * (len(self.buckets) + 1)   # Last is above all buckets
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.sum += seconds
+
+
+class SMSmetrics(object):
+    """
+    Metrics of the relay, served in Prometheus text format by SMSrelay.metrics, without scanning any table.
+    Counters and latency histograms (per exposed method, dispatch pattern and SQL statement type) are kept in memory.
+    Queue depth per status and gateway is kept in the smsdepth table by triggers on smsqueue, so it is updated in the same
+    transaction as the message, by whichever connection changes it (e.g. SMSretention), and survives a restart.
+    """
+    counters = {}       # (name, labels): count, where labels is a tuple of (label, value) pairs
+    histograms = {}     # (name, labels): SMShistogram
+    lock = threading.Lock()     # Held while changing counters or histograms, they are updated from several threads
+    _depthsql = (
+        "CREATE TABLE IF NOT EXISTS smsdepth (status integer, gateway integer, n integer, PRIMARY KEY (status, gateway))",
+        "CREATE TRIGGER IF NOT EXISTS smsdepth_insert AFTER INSERT ON %(table)s WHEN NEW.status IS NOT NULL BEGIN "
+        "INSERT INTO smsdepth VALUES (NEW.status, IFNULL(NEW.gateway, 0), 1) ON CONFLICT (status, gateway) DO UPDATE SET n = n + 1; END",
+        "CREATE TRIGGER IF NOT EXISTS smsdepth_delete AFTER DELETE ON %(table)s WHEN OLD.status IS NOT NULL BEGIN "
+        "UPDATE smsdepth SET n = n - 1 WHERE status = OLD.status AND gateway = IFNULL(OLD.gateway, 0); END",
+        "CREATE TRIGGER IF NOT EXISTS smsdepth_update AFTER UPDATE OF status, gateway ON %(table)s BEGIN "
+        "UPDATE smsdepth SET n = n - 1 WHERE status = OLD.status AND gateway = IFNULL(OLD.gateway, 0); "
+        "INSERT INTO smsdepth SELECT NEW.status, IFNULL(NEW.gateway, 0), 1 WHERE NEW.status IS NOT NULL "
+        "ON CONFLICT (status, gateway) DO UPDATE SET n = n + 1; END",
+    )
+
+    @classmethod
+    def install(cls):
+        """
+        Add the smsdepth triggers to each database holding smsqueue, counting the messages already there if they were missing
+        """
+        table = SMSmessage._tablename
+        for db in SMSmessage.dbsfor():
+            if not db.sqlfetch1("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)):
+                continue    # Not created yet
+            if not db.sqlfetch1("SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = 'smsdepth_insert'"):
+                for sql in cls._depthsql:
+                    db.sqlsend(sql % {"table": table})
+                db.sqlsend("DELETE FROM smsdepth")
+                db.sqlsend("INSERT INTO smsdepth SELECT status, IFNULL(gateway, 0), COUNT(*) FROM %s "
+                           "WHERE status IS NOT NULL GROUP BY 1, 2" % table)
+        SqliteWrap.observer = cls._observesql
+
+    @classmethod
+    def inc(cls, name, n=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with cls.lock:
+            cls.counters[key] = cls.counters.get(key, 0) + n
+
+    @classmethod
+    def observe(cls, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with cls.lock:
+            if key not in cls.histograms:
+                cls.histograms[key] = SMShistogram()
+            cls.histograms[key].observe(seconds)
+
+    @classmethod
+    @contextmanager
+    def timed(cls, name, **labels):
+        """
+        with SMSmetrics.timed("sms_request_seconds", method="sms_poll"):  observes how long the block takes
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            cls.observe(name, time.time() - start, **labels)
+
+    @classmethod
+    def _observesql(cls, sql, seconds):
+        cls.observe("sms_db_seconds", seconds, statement=sql.split(None, 1)[0].upper())
+
+    @classmethod
+    def depth(cls):
+        """
+        returns dict of (SMSstatus, gateway id): number of messages in smsqueue, summed across shards
+        """
+        depth = {}
+        for db in SMSmessage.dbsfor():
+            for row in db.sqlfetch("SELECT status, gateway, n FROM smsdepth WHERE n != 0"):
+                key = (SMSstatus(row["status"]), row["gateway"])
+                depth[key] = depth.get(key, 0) + row["n"]
+        return depth
+
+    @staticmethod
+    def _labels(labels, **extra):
+        labels = list(labels) + sorted(extra.items())
+        return "{%s}" % ",".join('%s="%s"' % (k, unicode(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels) if labels else ""
+
+    @classmethod
+    def text(cls):
+        """
+        returns all metrics in Prometheus text format
+        """
+        lines = ["# TYPE sms_queue_depth gauge"]
+        for (status, gateway), n in sorted(cls.depth().items(), key=lambda item: (item[0][0].value, item[0][1])):
+            lines.append("sms_queue_depth%s %d" % (cls._labels((), status=status.name, gateway=gateway), n))
+        with cls.lock:
+            for name in sorted({ name for name, labels in cls.counters }):
+                lines.append("# TYPE %s counter" % name)
+                lines += [ "%s%s %d" % (name, cls._labels(labels), n) for (nm, labels), n in sorted(cls.counters.items()) if nm == name ]
+            for name in sorted({ name for name, labels in cls.histograms }):
+                lines.append("# TYPE %s histogram" % name)
+                for (nm, labels), h in sorted(cls.histograms.items()):
+                    if nm == name:
+                        total = 0
+                        for le, n in zip(list(h.buckets) + ["+Inf"], h.counts):
+                            total += n
+                            lines.append("%s_bucket%s %d" % (name, cls._labels(labels, le=le), total))
+                        lines.append("%s_sum%s %f" % (name, cls._labels(labels), h.sum))
+                        lines.append("%s_count%s %d" % (name, cls._labels(labels), total))
+        return "\n".join(lines) + "\n"
+
+    @classmethod
+    def clear(cls):
+        with cls.lock:
+            cls.counters = {}
+            cls.histograms = {}
+
+
 class SMSgateway(Model):
     _tablename = "gateway"
     _createsql = "CREATE TABLE %s (id integer primary key, name text, phonenumber text, battery_strength int, timestamp datetime, " \
@@ -92,6 +761,8 @@ class SMSgateway(Model):
     _insertsql = "INSERT INTO %s VALUES (NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL)"
     _validtags = {}
     _parmfields = {}
+    _indexes = ("device_id", "ipaddr")
+    _uniques = ("phonenumber", "device_id WHERE phonenumber IS NULL")  # One gateway per SIM, and one per device before it knows its SIM
     _plural = None  # Set to SMSgateways after its definition
 
 def convert_smsgateway(s):  return SMSgateway(s)
@@ -100,33 +771,168 @@ sqlite3.register_converter("smsgateway", convert_smsgateway)
 class SMSgateways(Models):
     _singular = SMSgateway
 
+    # The range skips device_ids that are strings (which sort after numbers), and uses the index on device_id
+    _nextidsql = "SELECT IFNULL(MAX(device_id), 1000) + 1 FROM %s WHERE device_id BETWEEN 1000 AND 9223372036854775807"
+
     @classmethod
     def nextid(cls):
-        return max([gw.device_id for gw in cls.all() if gw.device_id] or [1000]) + 1
+        return SqliteWrap.current().sqlfetch1(cls._nextidsql % cls._singular._tablename)[0]
 
     @classmethod
     def findOrCreateAndUpdate(cls, _verbose=False, device_id=None, phonenumber=None, ipaddr=None, **kwargs):
         """
+        Each step is one statement, so concurrent requests from a new gateway can't create it twice
+        - with phonenumber (one gateway per SIM), upsert on phonenumber, first giving it to the gateway
+          of device_id created by polls before it was known, if any
+        - else update the gateways with device_id (or ipaddr), or if none, upsert on device_id (or insert)
+        Gateways created without a device_id are given the next one, in SQL.
+
         :param device_id:   Aribtrary string for hte device
         :param phonenumber: In international format +12345678901
         :param kwargs:      Any other args will be used to update the record
         :return: SMSGateways    List of matching gateways, creating one if non exist
         """
-        gws = (phonenumber and cls.find(phonenumber=phonenumber, _verbose=_verbose)
-               or (device_id and cls.find(device_id=device_id))
-               or (ipaddr and cls.find(ipaddr=ipaddr))
-               )
-        if gws:
-            for g in gws:
-                g.update(_verbose=_verbose, device_id=device_id or g.device_id, phonenumber=phonenumber or g.phonenumber, ipaddr=ipaddr or g.ipaddr, **kwargs)
-            return gws
+        table = cls._singular._tablename
+        db = SqliteWrap.current()
+        fields = { k: v for k, v in dict(kwargs, device_id=device_id, phonenumber=phonenumber, ipaddr=ipaddr).items() if v is not None }
+        if phonenumber:
+            if device_id:
+                db.sqlsend("UPDATE %s SET phonenumber = ? WHERE id = (SELECT id FROM %s WHERE device_id = ? AND phonenumber IS NULL LIMIT 1) "
+                           "AND NOT EXISTS (SELECT 1 FROM %s WHERE phonenumber = ?)" % (table, table, table),
+                           (phonenumber, device_id, phonenumber), _verbose=_verbose)
+            ids = [ cls._singular.upsert("phonenumber", _verbose=_verbose, **fields) ]
         else:
-            return cls(cls._singular.insert(_verbose=_verbose, device_id=device_id or SMSgateways.nextid(), phonenumber=phonenumber, **kwargs))
+            key = "device_id" if device_id else "ipaddr" if ipaddr else None
+            ids = key and [ row[0] for row in db.sqlsend("UPDATE %s SET %s WHERE %s = ? RETURNING id"
+                                                         % (table, ", ".join("%s = ?" % k for k in fields), key),
+                                                         list(fields.values()) + [fields[key]], _verbose=_verbose).fetchall() ]
+            if not ids:
+                ids = [ cls._singular.upsert("device_id WHERE phonenumber IS NULL", _verbose=_verbose, **fields) if device_id
+                        else cls._singular.insert(_verbose=_verbose, **fields).id ]
+        if not device_id:
+            db.sqlsend("UPDATE %s SET device_id = (%s) WHERE id IN (%s) AND device_id IS NULL"
+                       % (table, cls._nextidsql % table, ",".join(["?"] * len(ids))), ids, _verbose=_verbose)
+        return cls.find(id=ids, _verbose=_verbose)   # Loaded, as the registry and heartbeat expect
 
 SMSgateway._plural = SMSgateways    # Set plural, can't do this before SMSgateways is defined.
 def convert_smsgateways(s): return SMSgateways(loads(s))
 sqlite3.register_converter("smsgateways", convert_smsgateways)
 
+class SMSgatewayregistry(object):
+    """
+    Resident index of all gateways by phonenumber, device_id and ipaddr, so polls don't need to query them.
+    Only changes to those identity fields are written immediately, heartbeat fields (everything else e.g.
+    battery_strength, lastpolled) are set on the objects in memory and written by flush() in a batch,
+    at most flushinterval seconds later, and on SMSrelay.done()
+    Gateways shouldn't be changed except via this while its in use, or call clear() after doing so.
+    """
+    identityfields = ("phonenumber", "device_id", "ipaddr")
+    flushinterval = 10      # Seconds
+    gateways = None         # id: SMSgateway, None until loaded
+    index = {}              # (field, unicode(value)): set of ids
+    dirty = {}              # id: dict of heartbeat fields changed since flush
+    columns = None          # Columns of the gateway table, other fields sent by gateways are ignored
+    _lastflush = 0
+
+    @classmethod
+    def clear(cls):
+        cls.gateways = None
+        cls.index = {}
+        cls.dirty = {}
+        cls.columns = None
+
+    @classmethod
+    def _columnsonly(cls, kwargs):
+        if cls.columns is None:
+            cls.columns = { r["name"] for r in SqliteWrap.current().sqlfetch("pragma table_info(%s)" % SMSgateway._tablename) }
+        return { k: v for k, v in kwargs.items() if k in cls.columns }
+
+    @classmethod
+    def _load(cls):
+        if cls.gateways is None:
+            cls.gateways = {}
+            cls.index = {}
+            for gw in SMSgateways.all():
+                cls._add(gw)
+
+    @classmethod
+    def _add(cls, gw):
+        cls.gateways[gw.id] = gw
+        for f in cls.identityfields:
+            if getattr(gw, f) is not None:
+                cls.index.setdefault((f, unicode(getattr(gw, f))), set()).add(gw.id)
+
+    @classmethod
+    def _remove(cls, gw):
+        for f in cls.identityfields:
+            cls.index.get((f, unicode(getattr(gw, f))), set()).discard(gw.id)
+
+    @classmethod
+    def find(cls, field, val):
+        cls._load()
+        return SMSgateways([ cls.gateways[id] for id in sorted(cls.index.get((field, unicode(val)), ())) ])
+
+    @classmethod
+    def findOrCreateAndUpdate(cls, _verbose=False, device_id=None, phonenumber=None, ipaddr=None, **kwargs):
+        """
+        Equivalent of SMSgateways.findOrCreateAndUpdate, returning the resident gateways
+        """
+        cls._load()
+        kwargs = cls._columnsonly(kwargs)   # e.g. a newer app sending app_version
+        if phonenumber:     # A new phonenumber may be a device's first SIM, or another, so leave to SMSgateways
+            gws = cls.find("phonenumber", phonenumber)
+        else:
+            gws = (device_id and cls.find("device_id", device_id)) or (ipaddr and cls.find("ipaddr", ipaddr))
+        if gws:
+            for g in gws:
+                identity = { f: v for f, v in (("device_id", device_id), ("ipaddr", ipaddr))
+                             if v and unicode(v) != unicode(getattr(g, f)) }
+                if identity:
+                    cls._remove(g)
+                    g.update(_verbose=_verbose, **identity)
+                    cls._add(g)
+            cls.heartbeat(gws, **kwargs)
+        else:
+            gws = SMSgateways.findOrCreateAndUpdate(_verbose=_verbose, device_id=device_id, phonenumber=phonenumber,
+                                                    ipaddr=ipaddr, **kwargs)
+            for g in gws:
+                if g.id in cls.gateways:    # e.g. given its phonenumber
+                    cls._remove(cls.gateways[g.id])
+                    g.load(row=cls.dirty.get(g.id, {}))     # Heartbeat fields not flushed yet
+                cls._add(g)
+        return gws
+
+    @classmethod
+    def heartbeat(cls, gws, **kwargs):
+        """
+        Set fields on gws in memory, to be written by flush, fields that aren't columns are ignored
+        """
+        kwargs = cls._columnsonly(kwargs)
+        if kwargs:
+            for g in gws:
+                g.load(row=kwargs)
+                cls.dirty.setdefault(g.id, {}).update(kwargs)
+        if time.time() - cls._lastflush > cls.flushinterval:
+            cls.flush()
+
+    @classmethod
+    def flush(cls, _verbose=False):
+        """
+        Write all heartbeat changes, with one executemany for each combination of fields changed
+        """
+        dirty, cls.dirty = cls.dirty, {}    # Cleared first, so changes that fail are dropped rather than failing every flush
+        cls._lastflush = time.time()
+        byfields = {}
+        for id, fields in dirty.items():
+            keys = tuple(sorted(fields))
+            byfields.setdefault(keys, []).append([ fields[k] for k in keys ] + [id])
+        for keys, values in byfields.items():
+            try:
+                SqliteWrap.current().sqlsend("UPDATE %s SET %s WHERE id = ?" % (SMSgateway._tablename, ", ".join("%s = ?" % k for k in keys)),
+                                             values, _verbose=_verbose, many=True)
+            except sqlite3.Error as e:
+                print "SMSgatewayregistry.flush failed", keys, e
+
 
 class SMSdispatcher(object):
     spam = [ "BUY ONE",]
@@ -137,36 +943,53 @@ class SMSdispatcher(object):
         return any([sp in message.message for sp in cls.spam])
 
     @classmethod
-    def update(self, **kwargs):
+    def update(cls, **kwargs):
+        """
+        Add a pattern, kwargs: type, strings or regex, f, and optionally priority, higher is tried first and its
+        replies are queued with that priority (see SMSscheduler)
+        Can be called while SMSdispatchpool workers are dispatching, as the new list replaces patterns in one assignment
+        """
         if kwargs["type"] == SMSdispatchtype.REGEX:
             # Regex are compiled once to make them more efficient
             kwargs["regex"]=[re.compile(r) for r in kwargs["regex"]]    # Array of compiled regex
-        self.patterns.append(kwargs)    # Append kwargs as a dict
+        cls.patterns = sorted(cls.patterns + [kwargs], key=lambda p: -p.get("priority", 0))   # Stable, so same priority in order added
 
     @classmethod
     def dispatch(cls, msg, gateway, **kwargs ):
         """
         A basic dispatcher, can be replaced in subclasses,
-        returns array of dicts with response to queue
+        returns array of dicts with response to queue, or an SMSstatus (e.g. SPAM) to set on msg instead of DISPATCHED.
+        Its run without HTTPdispatcher.lock by SMSdispatchpool, so shouldn't write to the database, the caller does
         See https://docs.python.org/3/howto/regex.html for syntax of regex
         """
         verbose = True
         if verbose: print "SMSdispatcher.dispatch",msg,kwargs
         if cls.isspam(msg):
-            msg.update(status=SMSstatus.SPAM)
-            return None
+            return SMSstatus.SPAM
         for p in cls.patterns:
             if p["type"]==SMSdispatchtype.STRINGIN:
                 for s in p["strings"]:
                     if s in msg.message:
                         if verbose: print "SMSdispatcher matched",s
-                        return p["f"](msg)
+                        with SMSmetrics.timed("sms_dispatch_seconds", pattern=s):
+                            return cls._prioritised(p, p["f"](msg))
             if p["type"]==SMSdispatchtype.REGEX:
                 for s in p["regex"]:
                     m = s.search(msg.message)
                     if m:
                         if verbose: print "SMSdispatcher matched",m.group()
-                        return p["f"](msg, m)
+                        with SMSmetrics.timed("sms_dispatch_seconds", pattern=s.pattern):
+                            return cls._prioritised(p, p["f"](msg, m))
+
+    @staticmethod
+    def _prioritised(pattern, response):
+        """
+        Set the pattern's priority on response dicts that don't set their own
+        """
+        if pattern.get("priority"):
+            for r in SMSrelay._responses(response):
+                r.setdefault("priority", pattern["priority"])
+        return response
 
 class SMSHTTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     # NOTE this is a code also in dweb (and more developed there) may want to pull changes from there if working on this
@@ -178,12 +1001,15 @@ class SMSHTTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
             o = urlparse.urlparse(self.path)
             res = self.dispatchclass.dispatch(o.path[1:],
                                     **dict(urlparse.parse_qsl(o.query)))
-            if verbose: print "do_GET",res
             if isinstance(res, dict):   # It should be, for returning via JSON
                 res = dumps(res)
+            if isinstance(res, unicode):
+                res = res.encode("utf-8")   # So Content-Length is in bytes
+            if verbose: print "do_GET",res
+            res = res or ""
             self.send_response(200)
-            self.send_header('Content-type', 'text/json')
-            self.send_header('Content-Length', str(len(res)) if res else 0)
+            self.send_header('Content-type', self.dispatchclass.contenttypes.get(o.path[1:], 'text/json'))
+            self.send_header('Content-Length', str(len(res)))
             self.end_headers()
             self.wfile.write(res)
         except Exception as e:
@@ -196,14 +1022,23 @@ class SMSHTTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         Run a server that uses this class as its handler.
         """
         cls.dispatchclass = dispatchclass       # Stops circular reference
-        BaseHTTPServer.HTTPServer( ipandport, cls).serve_forever()
+        ThreadingHTTPServer( ipandport, cls).serve_forever()
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Handles each request on a thread, so long polls don't hold up other requests, see HTTPdispatcher.lock
+    """
+    daemon_threads = True
 
 class HTTPdispatcher():
     """
     Simple HTTPdispatcher,
     Subclasses should define "exposed" as a list of exposed methods
+    Requests are handled one at a time, as they share a database connection, except while waiting (see SMSnotifier)
     """
     exposed = []
+    contenttypes = {}           # method: Content-type of its response if not JSON
+    lock = threading.RLock()    # Held while handling a request
 
     @classmethod
     def dispatch(cls, req, **kwargs):
@@ -212,43 +1047,117 @@ class HTTPdispatcher():
         #"sms_incoming": sms_incoming
         if verbose: print "HTTPdispatcher.dispatch",req,kwargs
         if req in cls.exposed:
-            return getattr(cls, req)(**kwargs)
+            with SMSmetrics.timed("sms_request_seconds", method=req), cls.lock:
+                try:
+                    res = getattr(cls, req)(**kwargs)
+                except Exception:
+                    cls.rollback()      # So none of a failed request is committed by the next one
+                    raise
+                SqliteWrap.commitall()  # Each request is a transaction, so other connections e.g. SMSretention can write
+            return res
         else:
             if verbose: print "HTTPdispatcher.dispatch unimplemented:"+req
             raise SMSRelayExceptionInvalidRequest(req=req)
 
+    @classmethod
+    def rollback(cls):
+        """
+        Discard the writes of a request that failed, called with lock held
+        """
+        SqliteWrap.rollbackall()
+
 
 
 class SMSrelay(HTTPdispatcher):   # Encapsulation of class methods that define this
     dispatcher = None       # Set to class to dispatch messages to
-    exposed = ("sms_poll", "sms_incoming")
+    _backupstop = None      # Event to stop background backups
+    maxwait = 60            # Longest sms_poll will wait for a message
+    exposed = ("sms_poll", "sms_incoming", "sms_incoming_batch", "sms_ack", "metrics")
+    contenttypes = { "metrics": "text/plain; version=0.0.4; charset=utf-8" }   # Prometheus text format
+    ackstatuses = (SMSstatus.SENT, SMSstatus.DELIVERED, SMSstatus.FAILED)    # Outcomes a gateway can report
 
     @classmethod
-    def sms_poll(cls, _verbose=False, sim_num=None, **kwargs):
+    def sms_poll(cls, _verbose=False, sim_num=None, wait=None, max_messages=None, **kwargs):
         """
         sms_poll {'battery_strength': u'50', 'timestamp': u'2017-02-07T06:28Z', 'wifi_strength': u'0', 'gsm_strength': u'[38]',
          'charging': u'true', 'device_id': u'1007', 'sim_num': u'[14159969138]'}
+        wait: If no message is queued, seconds (up to maxwait) to wait for one before returning, without using the database
+        max_messages: If set, claim up to this many messages, and return them as { messages: [ {...}, ...] }
+            these are left with status GATEWAY until acknowledged with sms_ack using the "id" in each.
 
         #TODO will need wrapping in simple HTTP server to generate json string and http headers, or calling from cherrypy
         # sim_num was sent as u'[1234,5678]', so not expanded properly, now not sent, was doing sim_num=loads(sim_num), before passing to findOrCreateAndUpdate
         """
-        gws = SMSgateways.findOrCreateAndUpdate(_verbose=False, **kwargs)    # All matching gateways (multiple if multi-sim
-        gws.update(lastpolled=timestamp())
+        gws = SMSgatewayregistry.findOrCreateAndUpdate(_verbose=False, **kwargs)    # All matching gateways (multiple if multi-sim
+        SMSgatewayregistry.heartbeat(gws, lastpolled=timestamp())
+        if max_messages:
+            mm = SMSmessages.claim(gws, int(max_messages), _verbose=_verbose)
+            if not mm and wait:
+                SqliteWrap.commitall()  # Don't hold the write lock while waiting
+                if SMSnotifier.wait(gws, min(float(wait), cls.maxwait)):
+                    mm = SMSmessages.claim(gws, int(max_messages), _verbose=_verbose)
+            return { 'messages': [ cls._pollresponse(msg) for msg in mm.prefetch("gateway") ] } if mm else {}
         msg = SMSmessages.nextmessage(gws, _verbose=_verbose)
+        if not msg and wait:
+            SqliteWrap.commitall()  # Don't hold the write lock while waiting
+            if SMSnotifier.wait(gws, min(float(wait), cls.maxwait)):
+                msg = SMSmessages.nextmessage(gws, _verbose=_verbose)
         if not msg:
             return {}
         else:
             msg.update(status=SMSstatus.GATEWAY)
-            msg.update(status=SMSstatus.SENT)  # Simulate sent TODO replace with response from gateway when that function available in Android SMSRelay
-            gw = msg.gateway
-            return {
-                'timestamp': timestamp().strftime('%Y-%m-%dT%H:%MZ'),  # Can change the format if the Relay needs a different type
-                'message_id': msg.message_id,
-                'message': msg.message,
-                'to': msg.phonenumber,          # TODO field name might change
-                'send_from': gw.phonenumber,
-                'device_id': gw.device_id
-            }
+            msg.update(status=SMSstatus.SENT)  # Simulate sent, gateways that use sms_ack should poll with max_messages
+            return cls._pollresponse(msg)
+
+    @classmethod
+    def _pollresponse(cls, msg):
+        gw = msg.gateway
+        SMSmetrics.inc("sms_polled_total", gateway=gw.id)
+        return {
+            'timestamp': timestamp().strftime('%Y-%m-%dT%H:%MZ'),  # Can change the format if the Relay needs a different type
+            'id': msg.id,                   # For sms_ack
+            'message_id': msg.message_id,
+            'message': msg.message,
+            'to': msg.phonenumber,          # TODO field name might change
+            'send_from': gw.phonenumber,
+            'device_id': gw.device_id
+        }
+
+    @classmethod
+    def sms_ack(cls, acks, _verbose=False, device_id=None, **kwargs):
+        """
+        Report outcome of messages returned by sms_poll, in one update
+        acks: dict, or json string of it, of id: "SENT" | "DELIVERED" | "FAILED"  e.g. {"12": "SENT", "13": "FAILED"}
+        device_id: Of the gateway acknowledging, only its messages still with status GATEWAY are updated
+        returns { acked: number of messages updated }
+        """
+        try:
+            if isinstance(acks, basestring):
+                acks = loads(acks)
+            statuses = {}
+            for id, status in acks.items():
+                statuses[int(id)] = SMSstatus[status]
+        except (KeyError, ValueError, TypeError, AttributeError) as e:
+            raise SMSRelayExceptionInvalidRequest(req="sms_ack %s" % e)
+        for id, status in statuses.items():
+            if status not in cls.ackstatuses:
+                raise SMSRelayExceptionInvalidRequest(req="sms_ack %s=%s" % (id, status.name))
+        if not device_id:
+            raise SMSRelayExceptionInvalidRequest(req="sms_ack without device_id")
+        gws = SMSgatewayregistry.find("device_id", device_id)
+        if not gws or not statuses:
+            return { 'acked': 0 }
+        updated = SMSmessages.setstatuses(statuses, fromstatus=SMSstatus.GATEWAY, gateways=gws, _verbose=_verbose)
+        for status, n in updated.items():
+            SMSmetrics.inc("sms_acks_total", n, status=status.name)
+        return { 'acked': sum(updated.values()) }
+
+    @classmethod
+    def metrics(cls, **kwargs):
+        """
+        returns SMSmetrics in Prometheus text format, e.g. for scraping from /metrics
+        """
+        return SMSmetrics.text()
 
     @classmethod
     def sms_incoming(cls, **kwargs):
@@ -257,53 +1166,179 @@ class SMSrelay(HTTPdispatcher):   # Encapsulation of class methods that define t
         verbose=True
         kwargs["phonenumber"] = kwargs["from"]    # SMSmessage uses phonenumber for both incoming and outgoing
         del(kwargs["from"])
-        gws = SMSgateways.findOrCreateAndUpdate(device_id=kwargs.get("device_id"), phonenumber=kwargs.get("sent_to"))
+        gws = SMSgatewayregistry.findOrCreateAndUpdate(device_id=kwargs.get("device_id"), phonenumber=kwargs.get("sent_to"))
         gw = gws[0] # Should always be just 1
-        gw.update(lastincoming=timestamp())
+        SMSgatewayregistry.heartbeat([gw], lastincoming=timestamp())
         del(kwargs["sent_to"])  # Dont store on message, use gw
         del(kwargs["device_id"])  # Dont store on message, use gw
-        msg = SMSmessage.insert(gateway=gw, status=SMSstatus.INCOMING, **kwargs)
-        if msg._isloop:
-            msg.update(status=SMSstatus.LOOP)
+        SMSmetrics.inc("sms_incoming_total", gateway=gw.id)
+        if SMSdedupe.seen(gw, kwargs.get("message_id")):
+            SMSmetrics.inc("sms_loops_total", gateway=gw.id)
+            if verbose: print "sms_incoming ignoring loop", kwargs.get("message_id")
+        else:
+            msg = SMSmessage.insert(gateway=gw, status=SMSstatus.INCOMING, **kwargs)
+            SMSdedupe.add(gw, msg.message_id)
+            if SMSdispatchpool.queues:
+                SMSdispatchpool.put(msg)    # A worker will send it to the app
+            else:   # Send it the app
+                response = cls.dispatcher.dispatch(msg=msg, gateway=gws)
+                if verbose: print "sms_incoming resp=",response
+                cls._handled(msg, response)
+
+    @classmethod
+    def rollback(cls):
+        """
+        As HTTPdispatcher.rollback, and forget recently seen message_ids, which may include those of messages rolled back
+        """
+        SqliteWrap.rollbackall()
+        SMSdedupe.clear()
+
+    @classmethod
+    def _handled(cls, msg, response):
+        """
+        Queue any response from the dispatcher to incoming msg, and mark msg DISPATCHED, or the status the dispatcher returned
+        """
+        for r in cls._responses(response):
+            cls.sms_queue(gateway=msg.gateway, **r)   # Queue on gateway it arrived on
+        if isinstance(response, SMSstatus):
+            msg.update(status=response)
+        elif msg.status == SMSstatus.INCOMING:
+            msg.update(status=SMSstatus.DISPATCHED)
+
+    @classmethod
+    def sms_incoming_batch(cls, messages, sent_to=None, device_id=None, _verbose=False, **kwargs):
+        """
+        Receive many messages from one gateway in one request, e.g. after it has been offline.
+        The gateway is resolved once, messages already received are dropped with one query, the rest inserted with
+        one bulk statement in the request's transaction, and any replies queued the same way.
+
+        messages: list, or JSON string of list, of dicts as for sms_incoming e.g. [{"from": "+1234", "message": "Hi", "message_id": "12", "timestamp": ...}]
+        sent_to, device_id: identify the gateway as for sms_incoming
+        returns: { received: number of messages, inserted: number new }
+        Raises SMSRelayExceptionInvalidRequest, before storing any, if a message isn't a dict with "from"
+        """
+        try:
+            if isinstance(messages, basestring):
+                messages = loads(messages)
+        except ValueError as e:
+            raise SMSRelayExceptionInvalidRequest(req="sms_incoming_batch %s" % e)
+        if not isinstance(messages, list):
+            raise SMSRelayExceptionInvalidRequest(req="sms_incoming_batch messages should be a list")
+        for i, m in enumerate(messages):
+            if not isinstance(m, dict) or not m.get("from"):
+                raise SMSRelayExceptionInvalidRequest(req="sms_incoming_batch message %d has no from" % i)
+        gws = SMSgatewayregistry.findOrCreateAndUpdate(device_id=device_id, phonenumber=sent_to)
+        gw = gws[0]
+        received = timestamp()
+        SMSgatewayregistry.heartbeat([gw], lastincoming=received)
+        seen = SMSdedupe.seenmany(gw, [ m.get("message_id") for m in messages ])
+        rows = []
+        for m in messages:
+            message_id = m.get("message_id")
+            if message_id is not None:
+                if unicode(message_id) in seen:
+                    if _verbose: print "sms_incoming_batch ignoring loop", message_id
+                    continue
+                seen.add(unicode(message_id))  # Catch duplicates within the batch
+            rows.append({"gateway": gw, "status": SMSstatus.INCOMING, "phonenumber": m["from"], "message": m.get("message"),
+                         "message_id": message_id, "timestamp": m.get("timestamp"), "received": received})
+        msgs = SMSmessage.insertmany(rows, _verbose=_verbose)
+        SMSmetrics.inc("sms_incoming_total", len(messages), gateway=gw.id)
+        SMSmetrics.inc("sms_loops_total", len(messages) - len(msgs), gateway=gw.id)
+        for msg in msgs:
+            SMSdedupe.add(gw, msg.message_id)
+        if SMSdispatchpool.queues:
+            for msg in msgs:
+                SMSdispatchpool.put(msg)
         else:
-            # Send it the app
-            response = cls.dispatcher.dispatch(msg=msg, gateway=gws)
-            if verbose: print "sms_incoming resp=",response
-            # The dispatcher can send messages directly through sms_queue OR return one or more dicts { phonenumber="+1234", message="Hello"}
-            if isinstance(response, (list, tuple)):
-                for r in response:
-                    cls.sms_queue(gateway=gw, **response)
-            elif isinstance(response,(dict)):
-                cls.sms_queue(gateway=gws[0], **response)   # Always queue on first gateway if multiple (shouldnt be multiple since sms_incoming specifies phone number
-            else:
-                pass    # Nothing to send out
+            replies = []
+            statuses = {}
+            for msg in msgs:
+                response = cls.dispatcher.dispatch(msg=msg, gateway=gws)
+                replies += [ dict(r, gateway=gw, status=SMSstatus.QUEUED, timestamp=r.get("timestamp") or received, received=received)
+                             for r in cls._responses(response) ]
+                if isinstance(response, SMSstatus):
+                    statuses[msg.id] = response
+                elif msg.status == SMSstatus.INCOMING:
+                    statuses[msg.id] = SMSstatus.DISPATCHED
+            SMSmessages.setstatuses(statuses)
+            if replies:
+                for r in replies:
+                    SMSscheduler.enqueue(r)
+                SMSmessage.insertmany(replies, _verbose=_verbose)
+                SMSnotifier.notify(gw)
+        return {"received": len(messages), "inserted": len(msgs)}
+
+    @staticmethod
+    def _responses(response):
+        """
+        The dispatcher can send messages directly through sms_queue OR return one or more dicts { phonenumber="+1234", message="Hello"}
+        returns: list of those dicts
+        """
+        if isinstance(response, (list, tuple)):
+            return list(response)
+        elif isinstance(response, dict):
+            return [response]
+        return []   # Nothing to send out
 
     @classmethod
     def sms_queue(self, **kwargs):
+        SMSmetrics.inc("sms_queued_total")
         kwargs["status"] = SMSstatus.QUEUED
-        return SMSmessage.insert(**kwargs)
+        kwargs.setdefault("timestamp", timestamp())  # For expiry
+        with HTTPdispatcher.lock:   # Already held in a request, not when called by a pattern on an SMSdispatchpool worker
+            return SMSmessage.insert(**kwargs)
 
     @classmethod
-    def setup(cls, databasefile=None, createTables=False, dropTablesFirst=False, dispatcher=None, httpserver=None):
+    def setup(cls, databasefile=None, createTables=False, dropTablesFirst=False, dispatcher=None, httpserver=None, shards=None,
+              retention=None, backupdir=None, backupinterval=3600, threaded=None, dispatchworkers=None):
         """
         :param databasefile:        Database file to connect to
+        :param shards:              Number of files to partition smsqueue across by gateway, e.g. foo-0.db, foo-1.db
+        :param retention:           Seconds between runs of SMSretention in background, None to not run it
+        :param backupdir:           Directory to backup databases to in background, every backupinterval seconds
+        :param threaded:            True if requests will be on several threads, defaults True if httpserver or dispatchworkers
+        :param dispatchworkers:     Number of threads to dispatch incoming messages on (SMSdispatchpool), None to dispatch in the request
         :param createTables:        True if should create tables in file
         :param dropTablesFirst:     True to clear tables first
         :param dispatcher:          Class to handle incoming SMS
         :return:
         :exception:                 sqlite3.OperationalError if SQL fails e.g. if don't drop tables but they exist already
         """
+        if threaded is None:
+            threaded = bool(httpserver or dispatchworkers)
         if databasefile:
-            SqliteWrap.setdb(databasefile)
-            SqliteWrap.db.connect()
+            SMSgatewayregistry.clear()
+            SMSdedupe.clear()
+            SqliteWrap.setdb(databasefile, shared=threaded)
+            SMSmessage._shards = ShardRouter.fromfile(databasefile, shards, "gateway", shared=threaded) if shards else None
+            SqliteWrap.connectall()
         if createTables:
             try:
                 SMSmessage.createtable(dropfirst=dropTablesFirst)
+                SMSarchivedmessage.createtable(dropfirst=dropTablesFirst)
                 SMSgateway.createtable(dropfirst=dropTablesFirst)
             except sqlite3.OperationalError as e:
                 print e
+        if databasefile:
+            SMSscheduler.install()  # Before SMSmetrics, as may alter smsqueue
+            SMSretention.install()  # After SMSscheduler has added its columns, before triggers are added
+            try:
+                SMSgateway.createindexes()  # If database created before gateways had unique indexes, needed by findOrCreateAndUpdate
+            except sqlite3.IntegrityError as e:
+                print "SMSrelay.setup: duplicate gateways, merge them before using this database", e
+            SMSmetrics.install()    # Needs smsqueue, so after createTables
+            SMSmessage.createsearch()   # If database created before search was added
+            SMSarchivedmessage.createsearch()
+            SMSarchivedmessage.createindexes()  # If created before SMSdedupe searched it
         if dispatcher:
             SMSrelay.dispatcher=dispatcher  # Setup for testing
+        if retention:
+            SMSretention.start(interval=retention)
+        if backupdir:
+            cls._backupstop = SqliteWrap.startbackups(backupdir, interval=backupinterval)
+        if dispatchworkers:
+            SMSdispatchpool.start(workers=dispatchworkers)
         if httpserver:
             SMSHTTPRequestHandler.httpserver(httpserver, cls)
 
@@ -311,7 +1346,13 @@ class SMSrelay(HTTPdispatcher):   # Encapsulation of class methods that define t
 
     @classmethod
     def done(cls):
-        SqliteWrap.db.disconnect()
+        SMSdispatchpool.stop()
+        SMSgatewayregistry.flush()
+        SMSretention.stop()
+        if cls._backupstop:
+            cls._backupstop.set()
+            cls._backupstop = None
+        SqliteWrap.disconnectall()
 
 
 
@@ -334,6 +1375,12 @@ def test():
      'charging': u'true', 'device_id': u'1007'})
     assert resp["message"] == "Hello world", "Expect to find the message queued above"
     assert len(SMSgateways.all()) == 1
+    # Heartbeats are written behind
+    SMSrelay.sms_poll(battery_strength=u'42', device_id=u'1007', app_version=u'2')
+    assert SMSgatewayregistry.find("device_id", 1007)[0].battery_strength == u'42', "Should be updated in memory"
+    assert SMSgateway(1).load().battery_strength == 50, "Should not be written yet"
+    SMSgatewayregistry.flush()
+    assert SMSgateway(1).load().battery_strength == 42, "Should be written by flush, ignoring app_version"
     # Set up dispatcher for a trivial response
     SMSdispatcher.update(strings = ["hello","bonjour"], type=SMSdispatchtype.STRINGIN,
                          f=lambda msg: { "phonenumber": msg.phonenumber, "message": "Thanks a bunch" } )
@@ -362,6 +1409,9 @@ def test():
     resp = SMSrelay.sms_poll(_verbose=False, **{'battery_strength': u'50', 'timestamp': u'2017-02-07T06:28Z', 'wifi_strength': u'0', 'gsm_strength': u'[38]',
            'charging': u'true', 'device_id': u'1007', 'sim_num': u'[14159969138]'})
     assert len(resp) == 0, "Should ignore loops"
+    assert len(SMSmessages.find(message_id=u'100001')) == 1, "Should not insert loops"
+    SMSdedupe.clear()
+    assert SMSdedupe.seen(gw1, u'100001'), "Should find via index when not in memory"
 
     # Test spam
     resp = SMSrelay.sms_incoming(**{'timestamp': u'2017-02-08T05:37:06Z', 'message': u'BUY ONE', 'from': u'+16177179014',
@@ -369,6 +1419,242 @@ def test():
     resp = SMSrelay.sms_poll(_verbose=False, **{'battery_strength': u'50', 'timestamp': u'2017-02-07T06:28Z', 'wifi_strength': u'0', 'gsm_strength': u'[38]',
            'charging': u'true', 'device_id': u'1007', 'sim_num': u'[14159969138]'})
     assert len(resp) == 0, "Should ignore spam"
+    assert SMSmessages.search("message", "buy")[0].status == SMSstatus.SPAM, "Should find case insensitive word"
+    assert not SMSmessages.search("message", "buy", status=SMSstatus.INCOMING), "Should combine with find"
+    found = SMSmessages.search("message", "hello OR name")
+    assert len(found) == 3 and found[0]._rank <= found[1]._rank <= found[2]._rank, "Should rank best first"
+
+    # Test batched incoming, with a duplicate within the batch and one already received
+    batch = [ {'timestamp': u'2017-02-08T05:38:00Z', 'message': u'bonjour', 'from': u'+16177179015', 'message_id': u'100010'},
+              {'timestamp': u'2017-02-08T05:38:01Z', 'message': u'just saying', 'from': u'+16177179015', 'message_id': u'100011'},
+              {'timestamp': u'2017-02-08T05:38:00Z', 'message': u'bonjour', 'from': u'+16177179015', 'message_id': u'100010'},
+              {'timestamp': u'2017-02-08T05:37:06Z', 'message': u'hello', 'from': u'+16177179014', 'message_id': u'100001'} ]
+    resp = SMSrelay.sms_incoming_batch(messages=dumps(batch), sent_to=u'+14159969138', device_id=u'1007')
+    assert resp == {"received": 4, "inserted": 2}, "Should drop duplicates %s" % resp
+    SqliteWrap.commitall()  # A rejected request rolls back whatever isn't committed
+    for messages in (dumps(batch[:1] + [{'message': u'no sender', 'message_id': u'100012'}]), dumps({}), '[{"from"', '[1]'):
+        try:
+            SMSrelay.dispatch("sms_incoming_batch", messages=messages, sent_to=u'+14159969138', device_id=u'1007')
+            assert False, "Should reject %s" % messages
+        except SMSRelayExceptionInvalidRequest:
+            pass
+    assert not SMSmessages.find(message_id=u'100012'), "Should store none of an invalid batch"
+    assert SMSmessages.find(message_id=u'100011')[0].gateway.id == gw1.id, "Should be on the gateway"
+    resp = SMSrelay.sms_poll(_verbose=False, **{'battery_strength': u'50', 'timestamp': u'2017-02-07T06:28Z', 'wifi_strength': u'0', 'gsm_strength': u'[38]',
+           'charging': u'true', 'device_id': u'1007', 'sim_num': u'[14159969138]'})
+    assert resp["message"] == "Thanks a bunch" and resp["to"] == "+16177179015", "Should queue reply to batch"
+
+    # Test retention
+    SMSrelay.sms_queue(gateway=gw1, phonenumber="+12345678901", message="Too late", timestamp=timestamp() - timedelta(days=3))
+    SMSrelay.sms_incoming(**{'timestamp': u'2017-02-08T05:39:00Z', 'message': u'recent', 'from': u'+16177179016',
+                             'sent_to': u'+14159969138', 'device_id': u'1007', 'message_id': u'100020'})
+    SMSrelay.sms_incoming(**{'message': u'recent without timestamp', 'from': u'+16177179016',
+                             'sent_to': u'+14159969138', 'device_id': u'1007', 'message_id': u'100021'})
+    SqliteWrap.db.sqlsend("UPDATE smsqueue SET received = ? WHERE status = ? AND message_id NOT IN ('100020', '100021')",
+                          (timestamp() - SMSretention.dedupewindow - timedelta(hours=1), SMSstatus.DISPATCHED))
+    SqliteWrap.commitall()  # So SMSretention's connection can write
+    SMSretention.run()
+    assert not SMSmessages.find(status=[SMSstatus.SENT, SMSstatus.LOOP, SMSstatus.SPAM]), "Should have archived these"
+    assert len(SMSarchivedmessages.find(status=SMSstatus.SENT)) == 4, "Should be in archive"
+    assert SMSarchivedmessages.find(status=SMSstatus.EXPIRED)[0].message == "Too late", "Should have expired message"
+    assert SMSarchivedmessages.search("message", "bunch") and not SMSmessages.search("message", "bunch"), "Should move in index"
+    assert [ m.message for m in SMSmessages.find(status=SMSstatus.DISPATCHED) ] == ["recent", "recent without timestamp"], \
+        "Should keep dispatched incoming for loop detection, only within dedupewindow"
+    assert SMSarchivedmessages.find(status=SMSstatus.DISPATCHED, message_id=u'100001'), "Should archive older dispatched"
+    SMSdedupe.clear()
+    assert SMSdedupe.seen(gw1, u'100001') and SMSdedupe.seenmany(gw1, [u'100010', u'100020', u'999999']) == {u'100010', u'100020'}, \
+        "Should detect repeats of archived messages"
+    last = SMSmessage.insert(gateway=gw1, status=SMSstatus.SENT, phonenumber="+12345678901", message="After archive")
+    assert last.id > max(SMSarchivedmessages.all().ids), "Should not reuse ids of archived messages"
+    last.delete()
+
+    # Test metrics, queue depth kept by triggers including changes by SMSretention's connection
+    depth = SMSmetrics.depth()
+    for status in SMSstatus:
+        assert sum(n for (st, gw), n in depth.items() if st == status) == len(SMSmessages.find(status=status)), "Should match %s" % status
+    text = SMSrelay.dispatch("metrics")
+    assert 'sms_queue_depth{gateway="%d",status="DISPATCHED"}' % gw1.id in text, "Should serve depth"
+    assert 'sms_request_seconds_count{method="metrics"}' not in text and 'sms_polled_total{gateway="%d"}' % gw1.id in text
+    assert 'sms_dispatch_seconds_bucket{pattern="hello",le="+Inf"}' in text and 'sms_db_seconds_sum{statement="SELECT"}' in text
+
+    # Test backup
+    SqliteWrap.commitall()
+    mode = sqlite3.connect("smsmessagetest.db").execute("pragma journal_mode").fetchone()[0]
+    SqliteWrap.db.backup("smsmessagetest-backup.db")
+    assert len(sqlite3.connect("smsmessagetest-backup.db").execute("SELECT * FROM smsarchive").fetchall()) == len(SMSarchivedmessages.all())
+    assert sqlite3.connect("smsmessagetest.db").execute("pragma journal_mode").fetchone()[0] == mode, "Should not change journal mode"
+    try:
+        SqliteWrap.backupall(".")
+        assert False, "Should refuse to back up over the database"
+    except ValueError:
+        pass
+    # Test loading into memory, including the search index and AUTOINCREMENT sequence
+    SqliteWrap.commitall()
+    mem = SqliteWrap("smsmessagetest.db", inmemory=True, checkpointinterval=0)
+    mem.connect()
+    assert mem.sqlfetch1("SELECT COUNT(*) FROM smsarchive_fts WHERE smsarchive_fts MATCH 'bunch'")[0], "Should copy search index"
+    assert mem.sqlfetch1("SELECT seq FROM sqlite_sequence WHERE name = 'smsqueue'")[0] == \
+        SqliteWrap.db.sqlfetch1("SELECT seq FROM sqlite_sequence WHERE name = 'smsqueue'")[0]
+    mem.conn.close()    # Not disconnect, which would checkpoint over the file
+    SMSrelay.done()
+
+    # Test long poll, waits for message queued on another thread
+    SMSrelay.done()
+    SMSrelay.setup(databasefile="smsmessagetest.db", threaded=True)
+    def queuelater():
+        time.sleep(0.2)
+        SMSrelay.dispatch("sms_incoming", **{'timestamp': u'2017-02-08T05:37:06Z', 'message': u'bonjour', 'from': u'+16177179014',
+                                    'sent_to': u'+14159969138', 'device_id': u'1007', 'message_id': u'100005'})
+    threading.Thread(target=queuelater).start()
+    start = time.time()
+    resp = SMSrelay.dispatch("sms_poll", device_id=u'1007', wait=u'5')
+    assert resp["message"] == "Thanks a bunch" and time.time() - start < 4, "Should return as soon as queued"
+    assert SMSrelay.dispatch("sms_poll", device_id=u'1007', wait=u'0.1') == {}, "Should time out"
+
+    # Test serving over HTTP, metrics as Prometheus text with Content-Length in bytes
+    import urllib2
+    SMSHTTPRequestHandler.dispatchclass = SMSrelay
+    server = ThreadingHTTPServer(("127.0.0.1", 0), SMSHTTPRequestHandler)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    SMSmetrics.inc("sms_test_total", label=u"caf\xe9")
+    resp = urllib2.urlopen("http://127.0.0.1:%d/metrics" % server.server_address[1])
+    body = resp.read()
+    assert resp.info()["Content-type"] == "text/plain; version=0.0.4; charset=utf-8", "Should be Prometheus text format"
+    assert int(resp.info()["Content-Length"]) == len(body) and u"caf\xe9" in body.decode("utf-8"), "Should count bytes"
+    resp = urllib2.urlopen("http://127.0.0.1:%d/sms_poll?device_id=1007" % server.server_address[1])
+    assert resp.info()["Content-type"] == "text/json" and loads(resp.read()) == {}
+    server.shutdown()
+    server.server_close()
+
+    # Test a failed request is rolled back, not committed by the next request, and can be retried
+    def explode(msg):
+        SMSrelay.sms_queue(gateway=msg.gateway, phonenumber=msg.phonenumber, message="Never sent")
+        if not msg.message.endswith("again"):
+            raise ValueError("Failed after queueing")
+    SMSdispatcher.update(strings = ["explode"], type=SMSdispatchtype.STRINGIN, f=explode)
+    incoming = {'timestamp': u'2017-02-08T05:39:00Z', 'message': u'explode', 'from': u'+15550007',
+                'sent_to': u'+14159969138', 'device_id': u'1007', 'message_id': u'100030'}
+    try:
+        SMSrelay.dispatch("sms_incoming", **dict(incoming))
+        assert False, "Should raise"
+    except ValueError:
+        pass
+    SMSrelay.dispatch("metrics")
+    assert not SMSmessages.find(phonenumber="+15550007"), "Should roll back the failed request"
+    SMSrelay.dispatch("sms_incoming", **dict(incoming, message=u'explode again'))
+    assert [ m.message for m in SMSmessages.find(phonenumber="+15550007") ] == ["explode again", "Never sent"], "Should accept a retry"
+    SMSdispatcher.patterns = [ p for p in SMSdispatcher.patterns if p.get("strings") != ["explode"] ]
+    for m in SMSmessages.find(phonenumber="+15550007"):
+        m.delete()  # So the reply isn't polled by the tests below
+
+    # Test multi-message poll and acknowledgement
+    mm = [ SMSrelay.sms_queue(gateway=gw1, phonenumber="+12345678901", message="Batch %d" % i) for i in range(3) ]
+    resp = SMSrelay.dispatch("sms_poll", device_id=u'1007', max_messages=u'2')
+    assert [ m["message"] for m in resp["messages"] ] == ["Batch 0", "Batch 1"], "Should claim oldest first"
+    assert SMSmessage(mm[0].id).status == SMSstatus.GATEWAY, "Should be claimed until acknowledged"
+    SMSrelay.dispatch("sms_poll", device_id=u'1008')
+    assert SMSrelay.dispatch("sms_ack", device_id=u'1008', acks=dumps({ mm[0].id: "SENT" }))["acked"] == 0, \
+        "Should only ack the device's own messages"
+    resp = SMSrelay.dispatch("sms_ack", device_id=u'1007', acks=dumps({ mm[0].id: "SENT", mm[1].id: "FAILED", mm[2].id: "SENT" }))
+    assert resp["acked"] == 2, "Should only ack messages claimed by sms_poll"
+    assert [ SMSmessage(m.id).load().status for m in mm ] == [SMSstatus.SENT, SMSstatus.FAILED, SMSstatus.QUEUED]
+    assert SMSrelay.dispatch("sms_ack", device_id=u'1007', acks=dumps({ mm[0].id: "DELIVERED" }))["acked"] == 0, \
+        "Should not ack twice"
+    for acks in ('{"x": "SENT"}', dumps({ mm[2].id: "LOST" }), dumps({ mm[2].id: "QUEUED" }), '[1]', 'not json'):
+        try:
+            SMSrelay.dispatch("sms_ack", device_id=u'1007', acks=acks)
+            assert False, "Should reject %s" % acks
+        except SMSRelayExceptionInvalidRequest:
+            pass
+    SMSrelay.done()
+
+    # Test dispatch on worker threads, including a message left INCOMING from before a restart
+    SMSrelay.setup(databasefile="smsmessagetest.db", threaded=True)
+    SMSdispatcher.update(strings = ["slowly"], type=SMSdispatchtype.STRINGIN,
+                         f=lambda msg: (time.sleep(0.2), { "phonenumber": msg.phonenumber, "message": "Reply to " + msg.message })[1])
+    left = SMSmessage.insert(gateway=gw1, status=SMSstatus.INCOMING, phonenumber="+15550001", message="slowly 0", message_id=u'200000')
+    SMSdispatchpool.start(workers=2)
+    start = time.time()
+    for i in range(50):     # While a worker is dispatching "slowly 0"
+        SMSdispatcher.update(strings = ["directly"] if i == 0 else ["unused %d" % i], type=SMSdispatchtype.STRINGIN,
+                             f=lambda msg: SMSrelay.sms_queue(gateway=msg.gateway, phonenumber="+15550009", message="Queued directly") and None)
+    for i in (1, 2):
+        SMSrelay.dispatch("sms_incoming", **{'timestamp': u'2017-02-08T05:40:00Z', 'message': u'slowly %d' % i, 'from': u'+15550001',
+                                             'sent_to': u'+14159969138', 'device_id': u'1007', 'message_id': u'20000%d' % i})
+    for i, message in enumerate((u'BUY ONE now', u'directly please')):
+        SMSrelay.dispatch("sms_incoming", **{'timestamp': u'2017-02-08T05:40:00Z', 'message': message, 'from': u'+15550008',
+                                             'sent_to': u'+14159969138', 'device_id': u'1007', 'message_id': u'30000%d' % i})
+    assert time.time() - start < 0.2, "Should return before dispatched"
+    SMSdispatchpool.join()
+    assert SMSmessage(left.id).load().status == SMSstatus.DISPATCHED, "Should dispatch message left from before start"
+    assert [ m.status for m in SMSmessages.query().filter(phonenumber="+15550008").order_by("id").all() ] == \
+        [SMSstatus.SPAM, SMSstatus.DISPATCHED], "Should set status returned by the dispatcher"
+    assert SMSmessages.find(phonenumber="+15550009", status=SMSstatus.QUEUED), "Should queue from a pattern on a worker"
+    replies = SMSmessages.query().filter(phonenumber="+15550001", status=SMSstatus.QUEUED).order_by("id").all()
+    assert [ m.message for m in replies ] == ["Reply to slowly 0", "Reply to slowly 1", "Reply to slowly 2"], "Should keep order per sender"
+    SMSrelay.done()
+
+    # Test scheduling, priority first, then fair between senders, within rate caps
+    SMSrelay.setup(databasefile="smsmessagetest.db", createTables=True, dropTablesFirst=True)
+    gw = SMSgateways.findOrCreateAndUpdate(device_id=3001)[0]
+    for i in range(4):
+        SMSrelay.sms_queue(gateway=gw, phonenumber="+15550002", sender="bulk", message="Bulk %d" % i)
+    SMSrelay.sms_queue(gateway=gw, phonenumber="+15550003", sender="app", message="Reply")
+    SMSrelay.sms_queue(gateway=gw, phonenumber="+15550004", message="Urgent", priority=5)
+    sent = []
+    for i in range(3):
+        sent.append(SMSmessages.nextmessage([gw]))
+        sent[-1].update(status=SMSstatus.SENT)
+    assert [ m.message for m in sent ] == ["Urgent", "Bulk 0", "Reply"], "Should send priority first, then interleave senders"
+    SMSscheduler.ratecaps = { gw.id: 0.001 }
+    SMSscheduler.burst = 1
+    assert SMSmessages.nextmessage([gw]).message == "Bulk 1" and SMSmessages.nextmessage([gw]) is None, "Should hold at rate cap"
+    sims = [ SMSgateways.findOrCreateAndUpdate(device_id=2999, phonenumber=p)[0] for p in ("+15550201", "+15550202") ]
+    for i in range(5):
+        SMSrelay.sms_queue(gateway=sims[1], phonenumber="+15550002", message="Capped %d" % i)
+    SMSscheduler.ratecaps = { sims[0].id: 0.001, sims[1].id: 0.001 }
+    SMSscheduler.burst = 3
+    assert len(SMSmessages.claim(sims, 10)) == 3 and SMSmessages.nextmessage(sims) is None, "Should cap each SIM, not the device"
+    SMSscheduler.ratecaps = {}
+    SMSscheduler.burst = 5
+    SMSdispatcher.update(strings=["bonjour"], type=SMSdispatchtype.STRINGIN, priority=1, f=lambda msg: { "phonenumber": msg.phonenumber, "message": "Salut" })
+    assert SMSdispatcher.patterns[0]["strings"] == ["bonjour"], "Should try higher priority pattern first"
+    SMSrelay.sms_incoming(**{'message': u'bonjour', 'from': u'+16177179016', 'sent_to': u'+14159969138', 'device_id': u'3001', 'message_id': u'300000'})
+    assert SMSmessages.nextmessage([gw]).message == "Salut", "Should queue reply with priority of pattern"
+    SMSdispatcher.patterns.pop(0)
+
+    # Test long messages are stored compressed, and still found
+    long = SMSmessage.insert(gateway=gw, status=SMSstatus.SENT, phonenumber="+15550005", message=u"A long story " * 30 + u"zebra")
+    stored = SqliteWrap.current().sqlfetch1("SELECT +message FROM %s WHERE id = ?" % SMSmessage._tablename, (long.id,))[0]
+    assert isinstance(stored, buffer) and len(stored) < len(long.message), "Should compress"
+    assert SMSmessage(long.id).load().message.endswith("zebra"), "Should decompress"
+    assert SMSmessages.find(message="%zebra%") == [long] and SMSmessages.search("message", "zebra") == [long], "Should find text"
 
+    # Test registering gateways by upsert
+    ids = { SMSgateway.upsert("phonenumber", phonenumber="+15550100", battery_strength=i) for i in (10, 20) }
+    assert len(ids) == 1 and SMSgateway(ids.pop()).battery_strength == 20, "Should update gateway with same phonenumber"
+    gws = SMSgateways.findOrCreateAndUpdate(phonenumber="+15550100")
+    assert len(gws) == 1 and gws[0].device_id == 3002, "Should allocate next device_id"
+    new = SMSgateways.findOrCreateAndUpdate(device_id=3003)
+    assert SMSgateways.findOrCreateAndUpdate(device_id=3003, phonenumber="+15550101") == new, "Should name gateway its polls created"
+    second = SMSgateways.findOrCreateAndUpdate(device_id=3003, phonenumber="+15550102")
+    assert second != new and len(SMSgateways.findOrCreateAndUpdate(device_id=3003)) == 2, "Should add a gateway for another SIM"
+    SMSrelay.done()
 
-    SqliteWrap.db.disconnect()
\ No newline at end of file
+    # Test sharding smsqueue by gateway
+    SMSrelay.setup(databasefile="smsmessagetest.db", createTables=True, dropTablesFirst=True, shards=3)
+    gws = [ SMSgateways.findOrCreateAndUpdate(device_id=d)[0] for d in (2001, 2002, 2003) ]
+    for gw in gws:
+        SMSrelay.sms_queue(gateway=gw, phonenumber="+12345678901", message="Hello %s" % gw.device_id)
+    assert { SMSmessage._shards.dbforid(m.id) for m in SMSmessages.all() } == set(SMSmessage._shards.dbs), "Should use all shards"
+    assert len(SMSmessages.find(status=SMSstatus.QUEUED)) == 3, "Should merge find across shards"
+    resp = SMSrelay.sms_poll(device_id=2002)
+    assert resp["message"] == "Hello 2002", "Should find message on shard for gateway"
+    assert SMSmessages.find(gateway=gws[1])[0].status == SMSstatus.SENT
+    router = SMSmessage._shards
+    assert router.dbsfor({"gateway": gws[1]}) == [router.dbforid(gws[1].id)], "Should route an exact key to one shard"
+    assert router.dbsfor({"gateway": "%2%"}) == router.dbs, "Should fan out a LIKE pattern to all shards"
+    assert router.dbsfor({"gateway": "> 1"}) == router.dbs and router.dbsfor({"gateway": ""}) == [router.dbforval("")]
+    SMSrelay.done()
\ No newline at end of file
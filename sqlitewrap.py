@@ -1,44 +1,364 @@
 # encoding: utf-8
 import sqlite3
 import time  # For sleep
+import threading
+from collections import Sequence, Set, OrderedDict
+import re
+import sys   # For getsizeof
+import Queue
+import zlib  # For crc32 as a hash that is stable between processes
+import os
 from datetime import datetime
+try:
+    from concurrent.futures import Future   # Python 3, or the "futures" backport, works with asyncio.wrap_future
+except ImportError:
+    Future = None   # Defined below
 
 # Referenced externally
 
 class SqliteWrap(object):
     db = None       # Accessable if working single DB
+    databases = {}  # Registry of all databases by name, including db as "default", see adddb
+    _threaddb = threading.local()   # .db overrides db on threads with their own connection e.g. SqliteExecutor
+    observer = None     # Optional f(sql, seconds) called after each statement is executed (and fetched by sqlfetch*), e.g. for metrics
+    functions = {}      # name: (number of args, f), SQL functions added to each connection e.g. unzip by model.Compressed
 
-    def __init__(self, databasefile):
+    def __init__(self, databasefile, inmemory=False, checkpointinterval=60, checkpointwrites=1000, shared=False):
+        """
+        shared:             Connection may be used from several threads, each use is serialised by lock
+        inmemory:           Serve all queries from a copy of databasefile in memory, written back by checkpoint()
+                            every checkpointinterval seconds, or on commit after checkpointwrites changes, and on disconnect,
+                            but only between transactions, so the file never holds part of one.
+                            So at most that much work is lost on a crash.
+                            Only this connection sees changes, so don't use with SqliteExecutor or SMSretention.
+        """
         self.databasefile = databasefile
         self.conn = None
         self.isconnected = False
+        self.executor = None    # SqliteExecutor, started by startexecutor or first asubmit
+        self.writer = None      # SqliteExecutor that writes are sent to, started by startwriter
+        self.inmemory = inmemory
+        self.shared = shared
+        self.checkpointinterval = checkpointinterval
+        self.checkpointwrites = checkpointwrites
+        self.lock = threading.RLock()   # Held while using conn, so checkpoint thread can use it
+        self._checkpointchanges = 0     # conn.total_changes at last checkpoint
+        self._committedchanges = 0      # conn.total_changes at last commit()
+        self._checkpointstop = None
+
+    @classmethod
+    def current(cls):
+        """
+        Return the SqliteWrap to use on this thread, model.py always accesses the database via this
+        """
+        return getattr(cls._threaddb, "db", None) or cls.db
+
+    @classmethod
+    def setdb(cls, databasefile, **kwargs):
+        """
+        Called by applications to set the db pointer used by model.py, kwargs as for __init__ e.g. inmemory=True
+        """
+        cls.db = cls.adddb("default", databasefile, **kwargs)
 
     @classmethod
-    def setdb(cls, databasefile):
+    def adddb(cls, name, databasefile, **kwargs):
         """
-        Called by applications to set the db pointer used by model.py
+        Add a database to the registry, e.g. for each shard of a ShardRouter, returns the (unconnected) SqliteWrap
         """
-        cls.db=cls(databasefile)
+        cls.databases[name] = cls(databasefile, **kwargs)
+        return cls.databases[name]
+
+    @classmethod
+    def connectall(cls):
+        for db in cls.databases.values():
+            if not db.isconnected:
+                db.connect()
+
+    @classmethod
+    def commitall(cls):
+        for db in cls.databases.values():
+            if db.isconnected:
+                db.commit()
+
+    @classmethod
+    def rollbackall(cls):
+        for db in cls.databases.values():
+            if db.isconnected:
+                db.rollback()
+
+    @classmethod
+    def disconnectall(cls):
+        for db in cls.databases.values():
+            if db.isconnected:
+                db.disconnect()
 
-    def connect(self):
+    def connect(self, isolation_level=""):
         """
         Connect to sqlite DB, configure, assign to cherrypy.thread_data
         This is similar to connect_db in utils.py
+        isolation_level: passed to sqlite3, None for autocommit where transactions are explicit (e.g. SqliteExecutor)
         """
-        self.conn = sqlite3.connect(self.databasefile, detect_types=sqlite3.PARSE_DECLTYPES)
+        isnew = self.inmemory or not os.path.exists(self.databasefile) or not os.path.getsize(self.databasefile)
+        self.conn = sqlite3.connect(":memory:" if self.inmemory else self.databasefile,
+                                    detect_types=sqlite3.PARSE_DECLTYPES, isolation_level=isolation_level,
+                                    check_same_thread=not (self.inmemory or self.shared))  # Used under lock
+        if self.inmemory:
+            self._loadfromfile()
         self.conn.execute('pragma foreign_keys = on')
+        if isnew:   # Can only be set on a new database file, allows incremental_vacuum to return free pages to the OS
+            self.conn.execute('pragma auto_vacuum = incremental')
         # Dont wait for operating system http://www.sqlite.org/pragma.html#pragma_synchronous
         self.conn.execute('pragma synchronous = off')
         self.conn.row_factory = sqlite3.Row
+        for name, (nargs, f) in self.functions.items():
+            self.conn.create_function(name, nargs, f)
         # self.curs = self.conn.cursor() # Dont create curs, use the conn's execute method
         self.isconnected = True
 
     def disconnect(self):
-        self.conn.commit()
+        if self.executor:
+            self.executor.stop()
+            self.executor = None
+        if self.writer:
+            self.writer.stop()
+            self.writer = None
+        if self.inmemory:
+            self._checkpointstop.set()
+            self.checkpoint()
+        self.commit()
         self.conn.close()
         self.isconnected = False
 
-    def sqlsend(self, sql, values=None, _verbose=False, maxretrytime=60):
+    def _loadfromfile(self):
+        """
+        Copy databasefile (if it exists) into the in memory database and start checkpointing
+        """
+        if os.path.exists(self.databasefile):
+            disk = sqlite3.connect(self.databasefile)
+            try:
+                if hasattr(disk, "backup"):     # Python 3.7+
+                    disk.backup(self.conn)
+                else:
+                    self.conn.execute("ATTACH DATABASE ? AS disk", (self.databasefile,))
+                    # Virtual tables first, as they create their shadow tables (e.g. FTS5's _data), then other tables,
+                    # then indexes etc so they are built once, and triggers don't fire on the copy
+                    schema = disk.execute("SELECT type, name, sql FROM sqlite_master WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%' "
+                                          "ORDER BY type != 'table', sql NOT LIKE 'CREATE VIRTUAL TABLE%'").fetchall()
+                    for type, name, sql in schema:
+                        if sql.startswith("CREATE VIRTUAL TABLE"):
+                            self.conn.execute(sql)      # Its rows are in its shadow tables
+                        elif type == "table":
+                            if self.conn.execute("SELECT 1 FROM main.sqlite_master WHERE name = ?", (name,)).fetchone():
+                                self.conn.execute('DELETE FROM main."%s"' % name)   # Shadow table, copy its rows
+                            else:
+                                self.conn.execute(sql)
+                            self.conn.execute('INSERT INTO main."%s" SELECT * FROM disk."%s"' % (name, name))
+                        else:
+                            self.conn.execute(sql)
+                    if disk.execute("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_sequence'").fetchone():   # AUTOINCREMENT
+                        self.conn.execute("DELETE FROM main.sqlite_sequence")
+                        self.conn.execute("INSERT INTO main.sqlite_sequence SELECT * FROM disk.sqlite_sequence")
+                    self.conn.commit()
+                    self.conn.execute("DETACH DATABASE disk")
+            finally:
+                disk.close()
+        self._checkpointchanges = self._committedchanges = self.conn.total_changes
+        self._checkpointstop = threading.Event()
+        if self.checkpointinterval:
+            t = threading.Thread(target=self._checkpointthread, name="SqliteWrapCheckpoint")
+            t.daemon = True
+            t.start()
+
+    def _checkpointthread(self):
+        stop = self._checkpointstop     # Keep own reference, in case reconnected
+        while not stop.wait(self.checkpointinterval):
+            self._checkpointifchanged()
+
+    def _intransaction(self):
+        if hasattr(self.conn, "in_transaction"):    # Python 3
+            return self.conn.in_transaction
+        return self.conn.total_changes != self._committedchanges    # Changes not committed yet
+
+    def _checkpointifchanged(self):
+        """
+        Checkpoint if there are changes, and no transaction is open, so the file never holds part of a request's work
+        """
+        with self.lock:
+            if self.conn.total_changes != self._checkpointchanges and not self._intransaction():
+                try:
+                    self.checkpoint()
+                except sqlite3.OperationalError as e:   # e.g. a cursor still being read, will try again later
+                    print "Checkpoint deferred", e
+
+    def checkpoint(self):
+        """
+        Write an inmemory database to databasefile, replacing it atomically, so its always a complete copy
+        Commits any open transaction first, see _checkpointifchanged to only checkpoint between transactions
+        """
+        with self.lock:
+            self.conn.commit()
+            self._committedchanges = self.conn.total_changes
+            self._copyto(self.conn, self.databasefile)
+            self._checkpointchanges = self.conn.total_changes
+
+    def commit(self):
+        """
+        Commit any open transaction, so other connections (e.g. SqliteExecutor threads) can see changes and write,
+        then if inmemory and there have been checkpointwrites changes, checkpoint
+        """
+        with self.lock:
+            self.conn.commit()
+            self._committedchanges = self.conn.total_changes
+            if self.inmemory and self.conn.total_changes - self._checkpointchanges >= self.checkpointwrites:
+                self._checkpointifchanged()
+
+    def rollback(self):
+        """
+        Discard any open transaction e.g. of a request that failed, so the next commit() doesn't commit part of it
+        """
+        with self.lock:
+            self.conn.rollback()
+            self._committedchanges = self.conn.total_changes
+            QueryCache.bump(self, "*")  # Results read in the transaction may include its changes
+
+    def backup(self, dest, pages_per_step=100, sleep=0.25, progress=None, _verbose=False):
+        """
+        Copy a consistent snapshot of the database to file dest while it is in use,
+        on its own connection so can be called from any thread and doesn't block this connection.
+        Written to dest.tmp and then renamed, so dest is always a complete backup.
+
+        Uses the incremental backup API where sqlite3 has it (Python 3.7+), copying pages_per_step pages,
+        then sleeping so other connections can write. Otherwise falls back to "VACUUM INTO", a single step that
+        reads the whole database in one transaction, so pages_per_step and sleep do nothing. Its journal mode is
+        left as it is: in WAL mode (e.g. see startwriter) other connections can still commit while it runs, with a
+        rollback journal they wait until it finishes.
+        progress: called as progress(status, remaining, total) after each step
+        """
+        if self.inmemory:   # The file may be out of date, back up from memory instead
+            with self.lock:
+                self.commit()
+                self._copyto(self.conn, dest, progress=progress)
+        else:
+            src = sqlite3.connect(self.databasefile)
+            try:
+                if not hasattr(src, "backup"):
+                    mode = src.execute("pragma journal_mode").fetchone()[0]
+                    if mode != "wal" and _verbose:
+                        print "Backup of", self.databasefile, "in journal_mode", mode, "writers will wait for it"
+                self._copyto(src, dest, pages_per_step=pages_per_step, sleep=sleep, progress=progress)
+            finally:
+                src.close()
+        if _verbose:
+            print "Backed up", self.databasefile, "to", dest
+
+    @staticmethod
+    def _copyto(src, dest, pages_per_step=-1, sleep=0.25, progress=None):
+        """
+        Copy database open on connection src to dest.tmp, flush to disk, and rename to dest
+        """
+        tmp = dest + ".tmp"
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        if hasattr(src, "backup"):  # Python 3.7+
+            dst = sqlite3.connect(tmp)
+            try:
+                src.backup(dst, pages=pages_per_step, sleep=sleep, progress=progress)
+            finally:
+                dst.close()
+        else:
+            src.execute("VACUUM INTO ?", (tmp,))
+            if progress:
+                progress(0, 0, 1)   # status SQLITE_OK, remaining, total
+        fd = os.open(tmp, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.rename(tmp, dest)    # Atomic replacement of any previous copy
+
+    @classmethod
+    def backupall(cls, destdir, **kwargs):
+        """
+        Backup every registered database to a file of the same name in destdir, see backup
+        destdir can't be the directory of a database, as the backup would replace it
+        """
+        for db in cls.databases.values():
+            if os.path.realpath(destdir) == os.path.dirname(os.path.realpath(db.databasefile)):
+                raise ValueError("Backup directory %s would overwrite %s" % (destdir, db.databasefile))
+            db.backup(os.path.join(destdir, os.path.basename(db.databasefile)), **kwargs)
+
+    @classmethod
+    def startbackups(cls, destdir, interval=3600, **kwargs):
+        """
+        Start a background thread calling backupall every interval seconds, returns a threading.Event to set to stop it
+        """
+        stop = threading.Event()
+        def run():
+            while not stop.wait(interval):
+                try:
+                    cls.backupall(destdir, **kwargs)
+                except Exception as e:  # Try again next time e.g. if disk was full
+                    print "Backup failed", e
+        t = threading.Thread(target=run, name="SqliteWrapBackup")
+        t.daemon = True
+        t.start()
+        return stop
+
+    def startexecutor(self, threads=1, maxbatch=100):
+        """
+        Start threads to run database operations for asubmit, see SqliteExecutor
+        Commit first if this connection has written, otherwise the executor will wait for its lock
+        """
+        if not self.executor:
+            self.executor = SqliteExecutor(self, threads=threads, maxbatch=maxbatch)
+        return self.executor
+
+    def asubmit(self, f, *args, **kwargs):
+        """
+        Run f(*args, **kwargs) on an executor thread, and return a Future for its result
+        The call is a transaction, all its changes are committed or, if it raises an exception, rolled back.
+        """
+        return self.startexecutor().submit(f, *args, **kwargs)
+
+    atransaction = asubmit      # Name for clarity when submitting a function making several changes
+
+    _writestatements = ("INSERT", "UPDATE", "DELETE", "REPLACE")   # Sent to the writer if started
+
+    def startwriter(self, maxbatch=100, maxdelay=0.002):
+        """
+        Send writes (INSERT, UPDATE, DELETE or REPLACE) from sqlsend on any thread, to one writer thread, that runs those
+        arriving within maxdelay seconds (up to maxbatch) in one transaction, so many requests share each commit.
+        That makes it affordable to use synchronous = normal, with the database in WAL mode, so a commit survives
+        a crash of the process or OS once sqlsend returns.
+        Each write is then committed when sqlsend returns, rather than by commit(), and rolled back alone if it fails,
+        use transaction() for writes that must be committed together e.g. Model.insert.
+        Explicit transactions (BEGIN ... COMMIT) on this connection aren't sent to the writer so should not be used with it.
+        Commits this connection first, so the writer can get the write lock. Not supported for inmemory databases.
+        """
+        assert not self.inmemory, "The writer would write to the file, not the in-memory copy"
+        if not self.writer:
+            self.commit()
+            self.writer = SqliteExecutor(self, threads=1, maxbatch=maxbatch, maxdelay=maxdelay,
+                                         pragmas=("journal_mode = wal", "synchronous = normal"))
+        return self.writer
+
+    def transaction(self, f, *args, **kwargs):
+        """
+        Run f(*args, **kwargs) so its writes are committed together, or not at all.
+        If the writer is started, f is one submission to it, so runs in its own savepoint on the writer's thread,
+        where sqlsend on this database goes to the writer's connection. Otherwise f runs here, in this connection's
+        transaction (committed by commit()).
+        """
+        if self.writer and not self.writer.onthread():
+            return self.writer.submit(f, *args, **kwargs).result()
+        return f(*args, **kwargs)
+
+    @staticmethod
+    def _write(sql, values, _verbose, many):
+        # Runs on the writer's thread, where current() is its connection
+        return WriteResult(SqliteWrap.current().sqlsend(sql, values, _verbose=_verbose, many=many))
+
+    def sqlsend(self, sql, values=None, _verbose=False, maxretrytime=60, many=False, fetch=None):
         """
         Encapsulate most access to the sql server
         Send a sql string to a server, with values if supplied
@@ -46,11 +366,21 @@ class SqliteWrap(object):
         sql: sql statement that may contain usual "?" characters
         _verbose: set to true to print or log sql executed
         values[]: array or list of parameters to sql
+        many: True if values is a list of parameter lists, to execute sql once for each
+        fetch: optional f(cursor) e.g. to fetch its rows, run and timed for observer along with the execute
         ERR: IntegrityError (FOREIGN KEY constraint failed)
         should catch database is locked errors and delay - may need to catch other errors but watch logs for them
-        returns cursor which can be used as an iterator, or queried esp rowcount an lastrowid
+        returns cursor which can be used as an iterator, or queried esp rowcount an lastrowid, or result of fetch if supplied
         """
         # TODO-LOG - move prints to logs
+        if self.writer and self.writer.onthread():    # In a transaction() on the writer, use its connection for reads too
+            return SqliteWrap.current().sqlsend(sql, values, _verbose=_verbose, maxretrytime=maxretrytime, many=many, fetch=fetch)
+        written = QueryCache.written(sql)   # Table changed, if any, to invalidate cached results of after sending
+        if self.writer and sql.lstrip()[:7].upper().startswith(self._writestatements):
+            res = self.writer.submit(self._write, sql, values, _verbose, many).result()
+            if written:
+                QueryCache.bump(self, written)
+            return fetch(res) if fetch else res   # Rows already fetched, and timed, on the writer
         retrytime = 0.001  # Start with 1mS, might be far too short
         e = None
         if _verbose:
@@ -58,10 +388,21 @@ class SqliteWrap(object):
         while retrytime < maxretrytime:  # Allows up to about 60 seconds of delay - enough for a long OVP generation
             # noinspection PyBroadException,PyBroadException
             try:
-                if values is None:
-                    return self.conn.execute(sql)
-                else:  # values supplied as array
-                    return self.conn.execute(sql, values)
+                with self.lock:
+                    start = time.time()
+                    if many:
+                        curs = self.conn.executemany(sql, values)
+                    elif values is None:
+                        curs = self.conn.execute(sql)
+                    else:  # values supplied as array
+                        curs = self.conn.execute(sql, values)
+                    if fetch:   # For a SELECT most of the work is stepping through the rows, not the execute
+                        curs = fetch(curs)
+                    if SqliteWrap.observer:
+                        SqliteWrap.observer(sql, time.time() - start)
+                    if written:
+                        QueryCache.bump(self, written)
+                    return curs
             except sqlite3.OperationalError as e:
                 if 'database is locked' not in str(e):
                     break  # Drop out of loop and raise error
@@ -81,8 +422,11 @@ class SqliteWrap(object):
         values[]: array or list of parameters to sql
         returns iterator (possibly empty) of Rows (each of which behaves like a dict)
         """
-        curs = self.sqlsend(sql, values, _verbose=_verbose)
-        return curs.fetchmany(limit) if limit else curs.fetchall()
+        fetch = (lambda curs: curs.fetchmany(limit)) if limit else (lambda curs: curs.fetchall())
+        if self._viawriter(sql):    # Not holding lock while waiting for the writer, which may need it
+            return self.sqlsend(sql, values, _verbose=_verbose, fetch=fetch)
+        with self.lock:
+            return self.sqlsend(sql, values, _verbose=_verbose, fetch=fetch)
 
     def sqlfetch1(self, sql, values=None, _verbose=False):
         """
@@ -92,5 +436,358 @@ class SqliteWrap(object):
         values[]: array or list of parameters to sql
         returns iterator (possibly empty) of Rows (each of which behaves like a dict)
         """
-        return self.sqlsend(sql, values, _verbose=_verbose).fetchone()
+        fetch = lambda curs: curs.fetchone()
+        if self._viawriter(sql):
+            return self.sqlsend(sql, values, _verbose=_verbose, fetch=fetch)
+        with self.lock:
+            return self.sqlsend(sql, values, _verbose=_verbose, fetch=fetch)
+
+    def _viawriter(self, sql):
+        """
+        True if sqlsend runs sql on the writer's connection, rather than this one, see startwriter
+        """
+        return bool(self.writer) and (self.writer.onthread() or sql.lstrip()[:7].upper().startswith(self._writestatements))
 
+
+
+class ShardRouter(object):
+    """
+    Partition the rows of a table across several databases, by the value of a shard key (e.g. gateway)
+    so that writes to different shards don't wait for the same lock.
+    Set as _shards on a Model, it routes insert by the shard key, load/update/delete by id, and
+    find to just the shards that the shard key in the find could be on, otherwise to all of them merged by id.
+
+    ids are allocated so that id % len(dbs) is the shard, so ids are unique across all of them,
+    and a row can be found from just its id.
+    Note that sharded tables use the connections of the SqliteWrap in dbs, so can't be used via SqliteExecutor.
+    """
+    def __init__(self, dbs, shardkey):
+        """
+        :param dbs:         list of SqliteWrap, one per shard, the order must not change once rows are stored
+        :param shardkey:    field whose value decides the shard
+        """
+        self.dbs = dbs
+        self.shardkey = shardkey
+
+    @classmethod
+    def fromfile(cls, databasefile, shards, shardkey, **kwargs):
+        """
+        Create and register shards databasefile with -0, -1 etc inserted before the extension, kwargs as for SqliteWrap
+        """
+        base, dot, ext = databasefile.rpartition(".")
+        files = [ "%s-%d.%s" % (base, i, ext) if dot else "%s-%d" % (databasefile, i) for i in range(shards) ]
+        return cls([ SqliteWrap.adddb(f, f, **kwargs) for f in files ], shardkey)
+
+    def shardnum(self, val):
+        if val is None:
+            return 0
+        if hasattr(val, "id"):    # A Model
+            val = val.id
+        if isinstance(val, (int, long)):
+            return val % len(self.dbs)
+        if isinstance(val, unicode):
+            val = val.encode('utf-8')
+        return (zlib.crc32(str(val)) & 0xffffffff) % len(self.dbs)
+
+    def dbforval(self, val):
+        return self.dbs[self.shardnum(val)]
+
+    def dbforid(self, id):
+        return self.dbs[id % len(self.dbs)]
+
+    def dbsfor(self, kwargs):
+        """
+        Return list of databases that could contain rows matching kwargs of a find
+        Only an exact value (=) or a list (IN) of them on the shardkey picks shards, anything else - absent, a comparison,
+        or a string with a % which find may treat as a LIKE pattern - could match on any shard, so returns all of them
+        """
+        val = kwargs.get(self.shardkey, self)   # self as a marker for absent since None is a valid value
+        if val is self or not self._exact(val):
+            return self.dbs
+        if isinstance(val, (Sequence, Set)) and not isinstance(val, basestring):   # Includes Models
+            return [ self.dbs[i] for i in sorted({ self.shardnum(v) for v in val }) ]
+        return [ self.dbforval(val) ]
+
+    @staticmethod
+    def _exact(val):
+        # True unless find would treat val as a comparison or a LIKE pattern rather than matching it with = or IN
+        if not isinstance(val, basestring):
+            return True
+        ww = val.split(None, 1)
+        return "%" not in val and not (ww and ww[0] in ('>', '<', '>=', '<=', '!=', '<>'))
+
+    def insertsql(self, insertsql, num, maxidsql):
+        """
+        Convert an _insertsql (with its table filled in) so it allocates an id in shard num, i.e. the next id where
+        id % len(dbs) == num
+        maxidsql: SQL for the highest id used in the shard, or num - len(dbs) if none, see Model._maxidsql
+        """
+        return insertsql.replace("VALUES (NULL", "VALUES ((%s + %d)" % (maxidsql, len(self.dbs)), 1)
+
+
+if Future is None:
+    class Future(object):
+        """
+        Minimal subset of concurrent.futures.Future used by SqliteExecutor, when that is not installed
+        """
+        def __init__(self):
+            self._event = threading.Event()
+            self._result = None
+            self._exception = None
+            self._callbacks = []
+
+        def done(self):
+            return self._event.is_set()
+
+        def set_result(self, result):
+            self._result = result
+            self._finish()
+
+        def set_exception(self, exception):
+            self._exception = exception
+            self._finish()
+
+        def _finish(self):
+            self._event.set()
+            for f in self._callbacks:
+                f(self)
+
+        def add_done_callback(self, f):
+            if self.done():
+                f(self)
+            else:
+                self._callbacks.append(f)
+
+        def exception(self, timeout=None):
+            if not self._event.wait(timeout):
+                raise RuntimeError("Timed out waiting for database")
+            return self._exception
+
+        def result(self, timeout=None):
+            e = self.exception(timeout)
+            if e is not None:
+                raise e
+            return self._result
+
+
+class QueryCache(object):
+    """
+    Results of SELECTs, for tables whose contents rarely change between the same queries e.g. Model._cached = True
+    Entries are rows, keyed by database, sql and values, and are only used while the write count of each table
+    they were read from, and the database's data_version, are the same as when they were read.
+    Writes through sqlsend by any connection in this process count against the table written,
+    and data_version changes when another connection (e.g. another process) commits.
+    Writes by triggers to other tables aren't counted, so don't cache tables written by triggers.
+    The least recently used entries are evicted to keep the estimated size of rows under budget bytes.
+    """
+    budget = 16 * 1024 * 1024   # Bytes
+    entries = OrderedDict()     # (SqliteWrap, sql, values): (stamp, rows, size), least recently used first
+    size = 0                    # Estimated bytes of rows in entries
+    versions = {}               # (databasefile, table): number of writes, "*" counts for all tables e.g. for DROP
+    hits = 0
+    misses = 0
+    evictions = 0
+    lock = threading.Lock()
+    _writere = re.compile(r"\s*(?:(?:INSERT|REPLACE)(?:\s+OR\s+\w+)?\s+INTO|UPDATE(?:\s+OR\s+\w+)?|DELETE\s+FROM)\s+[\"`\[]?(\w+)", re.I)
+
+    @classmethod
+    def written(cls, sql):
+        """
+        returns table name written by sql, "*" if it might change any (e.g. DROP or ROLLBACK), or None
+        """
+        word = sql.lstrip()[:8].upper()
+        if word.startswith(("SELECT", "PRAGMA", "BEGIN", "COMMIT", "SAVEPOINT", "RELEASE")):
+            return None
+        m = cls._writere.match(sql)
+        return m.group(1).lower() if m else "*"
+
+    @classmethod
+    def bump(cls, db, table):
+        with cls.lock:
+            key = (db.databasefile, table)
+            cls.versions[key] = cls.versions.get(key, 0) + 1
+
+    @classmethod
+    def _stamp(cls, db, tables):
+        dataversion = db.sqlfetch1("pragma data_version")[0]  # Not under lock, as bump is called with db.lock held
+        with cls.lock:
+            return tuple(cls.versions.get((db.databasefile, t.lower()), 0) for t in tables + ("*",)), dataversion
+
+    @classmethod
+    def fetch(cls, db, sql, values, tables, _verbose=False):
+        """
+        db.sqlfetch(sql, values) from the cache if still valid, else from the database
+        tables: tuple of names of tables the sql reads
+        returns list of rows
+        """
+        try:
+            key = (db, sql, tuple(values or ()))
+            hash(key)
+        except TypeError:   # Unhashable values, can't cache
+            return db.sqlfetch(sql, values, _verbose=_verbose)
+        stamp = cls._stamp(db, tables)
+        with cls.lock:
+            entry = cls.entries.pop(key, None)
+            if entry and entry[0] == stamp:
+                cls.entries[key] = entry    # Now most recently used
+                cls.hits += 1
+                return list(entry[1])
+            if entry:
+                cls.size -= entry[2]
+            cls.misses += 1
+        rows = db.sqlfetch(sql, values, _verbose=_verbose)
+        size = sys.getsizeof(rows) + sum(sys.getsizeof(r) + sum(sys.getsizeof(v) for v in r) for r in rows)
+        with cls.lock:
+            if size <= cls.budget:
+                cls.entries[key] = (stamp, rows, size)
+                cls.size += size
+                while cls.size > cls.budget:
+                    k, (st, rr, sz) = cls.entries.popitem(last=False)
+                    cls.size -= sz
+                    cls.evictions += 1
+        return list(rows)
+
+    @classmethod
+    def stats(cls):
+        """
+        returns dict of hits, misses, evictions, entries and (estimated) size in bytes
+        """
+        with cls.lock:
+            return { "hits": cls.hits, "misses": cls.misses, "evictions": cls.evictions, "entries": len(cls.entries), "size": cls.size }
+
+    @classmethod
+    def clear(cls):
+        with cls.lock:
+            cls.entries = OrderedDict()
+            cls.size = cls.hits = cls.misses = cls.evictions = 0
+
+
+class WriteResult(object):
+    """
+    What sqlsend returns for a write run by the writer (see startwriter), with the parts of a cursor that are used,
+    since the writer's cursor can't be used on other threads.
+    """
+    def __init__(self, curs):
+        self.rows = curs.fetchall()     # e.g. from UPDATE ... RETURNING
+        self.rowcount = curs.rowcount
+        self.lastrowid = curs.lastrowid
+        self._next = 0
+
+    def fetchmany(self, size=1):
+        rows = self.rows[self._next:self._next + size]
+        self._next += len(rows)
+        return rows
+
+    def fetchall(self):
+        return self.fetchmany(len(self.rows))
+
+    def fetchone(self):
+        rows = self.fetchmany(1)
+        return rows[0] if rows else None
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+
+class SqliteExecutor(object):
+    """
+    Runs database operations on dedicated threads, so callers such as an event loop never block on sqlite.
+
+    Each thread has its own connection to the file, and SqliteWrap.current() returns it on that thread,
+    so normal Model and Models methods can be submitted.
+    Operations queued while a thread is busy are run together in one transaction, with one commit, and
+    a savepoint around each so a failing operation doesn't affect the others in its batch.
+    Results are set on the Futures after the commit.
+
+    Note objects returned are loaded, but any unloaded references in them (e.g. msg.gateway) will load on
+    the caller's thread when used, so should be loaded by the submitted function if that matters.
+    """
+    def __init__(self, db, threads=1, maxbatch=100, maxdelay=0, pragmas=()):
+        """
+        :param db:          SqliteWrap whose file to connect to
+        :param threads:     Number of threads (and connections)
+        :param maxbatch:    Maximum operations per transaction
+        :param maxdelay:    Seconds to wait for more operations to batch with the first, 0 to just take those queued
+        :param pragmas:     Run on each connection e.g. ("synchronous = normal",)
+        """
+        self.db = db
+        self.maxbatch = maxbatch
+        self.maxdelay = maxdelay
+        self.pragmas = pragmas
+        self.batches = 0    # Number of transactions run
+        self.queue = Queue.Queue()
+        self.threads = [threading.Thread(target=self._run, name="SqliteExecutor%d" % i) for i in range(threads)]
+        for t in self.threads:
+            t.daemon = True
+            t.start()
+
+    def submit(self, f, *args, **kwargs):
+        fut = Future()
+        self.queue.put((fut, f, args, kwargs))
+        return fut
+
+    def onthread(self):
+        """
+        True if called from one of this executor's threads, e.g. by a submitted function
+        """
+        return threading.current_thread() in self.threads
+
+    def stop(self):
+        """
+        Finish operations already queued, then stop threads
+        """
+        for t in self.threads:
+            self.queue.put(None)
+        for t in self.threads:
+            t.join()
+
+    def _run(self):
+        db = self.db.__class__(self.db.databasefile)
+        db.connect(isolation_level=None)    # Transactions are explicit, one per batch
+        for pragma in self.pragmas:
+            db.sqlsend("pragma " + pragma)
+        SqliteWrap._threaddb.db = db
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            end = time.time() + self.maxdelay
+            while len(batch) < self.maxbatch and batch[-1] is not None:
+                try:
+                    wait = end - time.time()
+                    batch.append(self.queue.get(timeout=wait) if wait > 0 else self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            if batch[-1] is None:   # Stop after this batch
+                running = False
+                batch.pop()
+            if batch:
+                self._runbatch(db, batch)
+        db.disconnect()
+
+    def _runbatch(self, db, batch):
+        results = []
+        self.batches += 1
+        try:
+            db.sqlsend("BEGIN")
+            for fut, f, args, kwargs in batch:
+                db.sqlsend("SAVEPOINT op")
+                try:
+                    results.append((fut, f(*args, **kwargs), None))
+                except Exception as e:
+                    db.sqlsend("ROLLBACK TO op")
+                    results.append((fut, None, e))
+                db.sqlsend("RELEASE op")
+            db.sqlsend("COMMIT")
+        except Exception as e:  # Failed to commit, so nothing in batch succeeded
+            try:
+                db.sqlsend("ROLLBACK")
+            except sqlite3.OperationalError:
+                pass    # No transaction was open
+            for fut, f, args, kwargs in batch:
+                fut.set_exception(e)
+            return
+        for fut, result, e in results:
+            if e is None:
+                fut.set_result(result)
+            else:
+                fut.set_exception(e)